@@ -25,6 +25,9 @@
 
 #
 # Changelog:
+# 3.11:
+#   * Cache sort keys per buffer, evaluated again only when the buffer changes.
+#   * Move only the buffers that are out of place when applying the sort order.
 # 3.10:
 #   * Fix exception in `/autosort helpers swap`.
 # 3.9:
@@ -80,6 +83,7 @@
 #
 
 
+import bisect
 import json
 import math
 import re
@@ -89,12 +93,13 @@ import weechat
 
 SCRIPT_NAME     = 'autosort'
 SCRIPT_AUTHOR   = 'Maarten de Vries <maarten@de-vri.es>'
-SCRIPT_VERSION  = '3.10'
+SCRIPT_VERSION  = '3.11'
 SCRIPT_LICENSE  = 'GPL3'
 SCRIPT_DESC     = 'Flexible automatic (or manual) buffer sorting based on eval expressions.'
 
 
 config             = None
+key_cache          = None
 hooks              = []
 signal_delay_timer = None
 sort_limit_timer   = None
@@ -397,12 +402,8 @@ def merge_buffer_list(buffers):
 		result[number].append(buffer)
 	return result.values()
 
-def sort_buffers(hdata, buffers, rules, helpers, case_sensitive):
-	for merged in buffers:
-		for buffer in merged:
-			name = weechat.hdata_string(hdata, buffer, 'name')
-
-	return sorted(buffers, key=merged_sort_key(rules, helpers, case_sensitive))
+def sort_buffers(buffers, buffer_key):
+	return sorted(buffers, key=merged_sort_key(buffer_key))
 
 def buffer_sort_key(rules, helpers, case_sensitive):
 	''' Create a sort key function for a list of lists of merged buffers. '''
@@ -419,8 +420,7 @@ def buffer_sort_key(rules, helpers, case_sensitive):
 
 	return key
 
-def merged_sort_key(rules, helpers, case_sensitive):
-	buffer_key = buffer_sort_key(rules, helpers, case_sensitive)
+def merged_sort_key(buffer_key):
 	def key(merged):
 		best = None
 		for buffer in merged:
@@ -429,10 +429,139 @@ def merged_sort_key(rules, helpers, case_sensitive):
 		return best
 	return key
 
-def apply_buffer_order(buffers):
-	''' Sort the buffers in weechat according to the given order. '''
-	for i, buffer in enumerate(buffers):
-		weechat.buffer_set(buffer[0], "number", str(i + 1))
+class SortKeyCache:
+	"""
+	Sort keys of buffers, reused across sorts.
+
+	A cached key is only evaluated again when the names, the local variables
+	or another property of the buffer used by the rules changed.
+	"""
+
+	# Expressions that depend on other objects than the buffer itself, which can't be tracked.
+	untracked_pattern = re.compile(r'\$\{(?:buffer\[|buffer\.(?!local_variables\.)\w+\.|window\b)')
+	field_pattern     = re.compile(r'\$\{buffer\.(\w+)\}')
+
+	def __init__(self):
+		self.keys       = {}
+		self.buffer_key = None
+		self.fields     = []
+		self.enabled    = True
+		self.hits       = 0
+		self.misses     = 0
+
+	def configure(self, rules, helpers, case_sensitive):
+		''' Forget all cached keys and find out which buffer properties the rules use. '''
+		self.keys       = {}
+		self.buffer_key = buffer_sort_key(rules, helpers, case_sensitive)
+		expressions     = list(rules) + list(helpers.values())
+		self.enabled    = not any(self.untracked_pattern.search(x) for x in expressions)
+
+		fields = set()
+		for expression in expressions:
+			fields.update(self.field_pattern.findall(expression))
+		fields.difference_update(['full_name', 'short_name', 'local_variables'])
+		self.fields = sorted(fields)
+
+	def clear(self):
+		self.keys = {}
+
+	def fingerprint(self, hdata, buffer):
+		''' Get the buffer properties that the sort key may depend on. '''
+		result = [
+			weechat.hdata_string(hdata, buffer, 'full_name'),
+			weechat.hdata_string(hdata, buffer, 'short_name'),
+			sorted(weechat.hdata_hashtable(hdata, buffer, 'local_variables').items()),
+		]
+		for field in self.fields:
+			kind = weechat.hdata_get_var_type_string(hdata, field)
+			if kind == 'string':
+				result.append(weechat.hdata_string(hdata, buffer, field))
+			elif kind in ('char', 'integer'):
+				result.append(weechat.hdata_integer(hdata, buffer, field))
+			elif kind == 'long':
+				result.append(weechat.hdata_long(hdata, buffer, field))
+			elif kind == 'time':
+				result.append(weechat.hdata_time(hdata, buffer, field))
+			elif kind == 'pointer':
+				result.append(weechat.hdata_pointer(hdata, buffer, field))
+		return result
+
+	def start(self, buffers):
+		''' Reset the statistics and forget buffers that are gone. '''
+		self.hits   = 0
+		self.misses = 0
+		self.keys   = dict((buffer, self.keys[buffer]) for merged in buffers for buffer in merged if buffer in self.keys)
+
+	def get(self, hdata, buffer):
+		''' Get the sort key of a buffer, evaluating the rules only if needed. '''
+		if not self.enabled:
+			self.misses += 1
+			return self.buffer_key(buffer)
+
+		fingerprint = self.fingerprint(hdata, buffer)
+		cached = self.keys.get(buffer)
+		if cached is not None and cached[0] == fingerprint:
+			self.hits += 1
+			return cached[1]
+
+		self.misses += 1
+		key = self.buffer_key(buffer)
+		self.keys[buffer] = (fingerprint, key)
+		return key
+
+def longest_increasing_subsequence(values):
+	''' Get the indices of a longest strictly increasing subsequence of values. '''
+	tails       = []  # Index of the smallest last value of an increasing subsequence of each length.
+	tail_values = []
+	previous    = [None] * len(values)
+	for i, value in enumerate(values):
+		length = bisect.bisect_left(tail_values, value)
+		if length > 0: previous[i] = tails[length - 1]
+		if length == len(tails):
+			tails.append(i)
+			tail_values.append(value)
+		else:
+			tails[length]       = i
+			tail_values[length] = value
+
+	result = []
+	i = tails[-1] if tails else None
+	while i is not None:
+		result.append(i)
+		i = previous[i]
+	result.reverse()
+	return result
+
+def apply_buffer_order(current, buffers):
+	'''
+	Sort the buffers in weechat according to the given order.
+
+	Only the buffers that are out of place are moved, since every move makes
+	weechat renumber buffers and redraw bars. Returns the number of moves.
+	'''
+	current = sorted(current, key=lambda merged: merged.number)
+	if [merged.number for merged in current] != list(range(1, len(current) + 1)):
+		# There are gaps in the buffer numbers, renumber all buffers.
+		for i, buffer in enumerate(buffers):
+			weechat.buffer_set(buffer[0], "number", str(i + 1))
+		return len(buffers)
+
+	# The buffers in the longest run that is already in the right order stay where they are.
+	target = dict((id(merged), i) for i, merged in enumerate(buffers))
+	keep   = set(id(current[i]) for i in longest_increasing_subsequence([target[id(merged)] for merged in current]))
+
+	# Move every other buffer right after the buffer that should precede it.
+	moves = 0
+	for i, merged in enumerate(buffers):
+		if id(merged) in keep: continue
+		old_index = list_find(current, merged)
+		current.pop(old_index)
+		new_index = list_find(current, buffers[i - 1]) + 1 if i > 0 else 0
+		current.insert(new_index, merged)
+		if new_index != old_index:
+			weechat.buffer_set(merged[0], "number", str(new_index + 1))
+			moves += 1
+	return moves
 
 def split_args(args, expected, optional = 0):
 	''' Split an argument string in the desired number of arguments. '''
@@ -444,19 +573,22 @@ def split_args(args, expected, optional = 0):
 def do_sort(verbose = False):
 	start = perf_counter()
 
-	hdata, buffers = get_buffers()
-	buffers = merge_buffer_list(buffers)
-	buffers = sort_buffers(hdata, buffers, config.rules, config.helpers, config.case_sensitive)
-	apply_buffer_order(buffers)
+	hdata, current = get_buffers()
+	current = merge_buffer_list(current)
+	key_cache.start(current)
+	buffers = sort_buffers(current, lambda buffer: key_cache.get(hdata, buffer))
+	moves   = apply_buffer_order(current, buffers)
 
 	elapsed = perf_counter() - start
+	message = "Finished sorting buffers in {0:.4f} seconds, {1} buffers moved ({2} cached sort keys, {3} evaluated).".format(elapsed, moves, key_cache.hits, key_cache.misses)
 	if verbose:
-		log("Finished sorting buffers in {0:.4f} seconds.".format(elapsed))
+		log(message)
 	else:
-		debug("Finished sorting buffers in {0:.4f} seconds.".format(elapsed))
+		debug(message)
 
 def command_sort(buffer, command, args):
 	''' Sort the buffers and print a confirmation. '''
+	key_cache.clear()
 	do_sort(True)
 	return weechat.WEECHAT_RC_OK
 
@@ -481,6 +613,11 @@ def command_debug(buffer, command, args):
 		log('{0}: {1}'.format(fullname, result))
 	log('Computing evaluation results took {0:.4f} seconds.'.format(elapsed))
 
+	if key_cache.enabled:
+		log('Sort key cache: {0} hits and {1} misses in the last sort, {2} buffers cached.'.format(key_cache.hits, key_cache.misses, len(key_cache.keys)))
+	else:
+		log('Sort key cache: disabled, the rules use properties of other buffers or windows.')
+
 	return weechat.WEECHAT_RC_OK
 
 def command_rule_list(buffer, command, args):
@@ -713,6 +850,8 @@ def on_sort_limit_timeout(pointer, remainin_calls):
 
 
 def apply_config():
+	key_cache.configure(config.rules, config.helpers, config.case_sensitive)
+
 	# Unhook all signals and hook the new ones.
 	for hook in hooks:
 		weechat.unhook(hook)
@@ -884,10 +1023,10 @@ def on_autosort_complete(data, name, buffer, completion):
 command_description = r'''{*white}# General commands{reset}
 
 {*white}/autosort {brown}sort{reset}
-Manually trigger the buffer sorting.
+Manually trigger the buffer sorting, evaluating the sort rules for all buffers again.
 
 {*white}/autosort {brown}debug{reset}
-Show the evaluation results of the sort rules for each buffer.
+Show the evaluation results of the sort rules for each buffer, and how many cached sort keys the last sort used.
 
 
 {*white}# Sorting rule commands{reset}
@@ -980,6 +1119,13 @@ considered for sorting purposes.
 You can debug your sort rules with the `{*default}/autosort debug{reset}` command, which will
 print the evaluation results of each rule for each buffer.
 
+The results are cached per buffer and only evaluated again when the name, the local
+variables or another property of the buffer used in the rules changes. Rules that also
+depend on something else, like options or other scripts, are updated by
+`{*default}/autosort sort{reset}`. Rules that look at other buffers or windows
+(like `{cyan}${{buffer.next_buffer.name}}{reset}` or
+`{cyan}${{buffer[irc.server.libera].number}}{reset}`) disable the cache.
+
 {*brown}NOTE:{reset} The sort rules for version 3 are not compatible with version 2 or vice
 versa. You will have to manually port your old rules to version 3 if you have any.
 
@@ -1041,6 +1187,7 @@ info_escape_arguments = 'text'
 
 if weechat.register(SCRIPT_NAME, SCRIPT_AUTHOR, SCRIPT_VERSION, SCRIPT_LICENSE, SCRIPT_DESC, "", ""):
 	config = Config('autosort')
+	key_cache = SortKeyCache()
 
 	colors = {
 		'default':  weechat.color('default'),
@@ -118,6 +118,11 @@
 #     point out clones in the channel.
 #     Valid values: 'on', 'off' Default: 'off'
 #
+#   * plugins.var.python.chanop.sync_max_requests:
+#     How many ban or quiet lists chanop asks the server for at once while
+#     fetching them. Only makes sense per server, not per channel.
+#     Default: 4
+#
 #
 #   The following configs are global and can't be defined per server or channel.
 #
@@ -196,6 +201,12 @@
 #   History:
 #
 #
+#   2026-10-18
+#   version 0.3.6: match masks through an index of masks and hostmasks,
+#                  keep mask lists in append-only files instead of a shelve,
+#                  request several mask lists at once (sync_max_requests),
+#                  ban matches bar item shows users already banned or quieted
+#
 #   2023-02-05
 #   version 0.3.5: replace command /VERSION by /version
 #                  (compatibility with WeeChat 3.9)
@@ -296,7 +307,7 @@ WEECHAT_VERSION = (0x30200, '0.3.2')
 
 SCRIPT_NAME    = "chanop"
 SCRIPT_AUTHOR  = "Elián Hanisch <lambdae2@gmail.com>"
-SCRIPT_VERSION = "0.3.5"
+SCRIPT_VERSION = "0.3.6"
 SCRIPT_LICENSE = "GPL3"
 SCRIPT_DESC    = "Helper script for IRC Channel Operators"
 
@@ -311,6 +322,7 @@ settings = {
 'enable_multi_kick'     :'off',
 'display_affected'      :'on',
 'enable_bar'            :'on',
+'sync_max_requests'     :'4',
 }
 
 try:
@@ -322,12 +334,14 @@ except ImportError:
     print("Get WeeChat now at: http://www.weechat.org/")
     import_ok = False
 
+import os
 import re
+import json
 import time
 import string
 import getopt
 from collections import defaultdict
-from shelve import DbfilenameShelf as Shelf
+from urllib.parse import quote, unquote
 
 chars = str.maketrans('', '')
 
@@ -477,30 +491,34 @@ def is_ip(s):
         return False
 
 _reCache = {}
+def maskRegexp(pattern):
+    """Returns cached regexp object or compiles a new one from pattern."""
+    try:
+        return _reCache[pattern]
+    except KeyError:
+        s = '^'
+        for c in pattern:
+            if c == '*':
+                s += '.*'
+            elif c == '?':
+                s += '.'
+            elif c in '[{':
+                s += r'[\[{]'
+            elif c in ']}':
+                s += r'[\]}]'
+            elif c in '|\\':
+                s += r'[|\\]'
+            else:
+                s += re.escape(c)
+        s += '$'
+        regexp = re.compile(s, re.I)
+        _reCache[pattern] = regexp
+        return regexp
+
 def cachedPattern(f):
     """Use cached regexp object or compile a new one from pattern."""
     def getRegexp(pattern, *arg):
-        try:
-            regexp = _reCache[pattern]
-        except KeyError:
-            s = '^'
-            for c in pattern:
-                if c == '*':
-                    s += '.*'
-                elif c == '?':
-                    s += '.'
-                elif c in '[{':
-                    s += r'[\[{]'
-                elif c in ']}':
-                    s += r'[\]}]'
-                elif c in '|\\':
-                    s += r'[|\\]'
-                else:
-                    s += re.escape(c)
-            s += '$'
-            regexp = re.compile(s, re.I)
-            _reCache[pattern] = regexp
-        return f(regexp, *arg)
+        return f(maskRegexp(pattern), *arg)
     return getRegexp
 
 def hostmaskPattern(f):
@@ -536,6 +554,175 @@ pattern_match_list = cachedPattern(match_list)
 hostmask_match = hostmaskPattern(pattern_match)
 hostmask_match_list = hostmaskPattern(pattern_match_list)
 
+# Mask indexes, for not trying every regexp against every hostmask.
+# A mask with a literal nick, user or host can only match hostmasks with that
+# same nick, user or host, a mask like *!*@*.example.com only hostmasks under
+# example.com and a mask like *!*@192.168.* only hostmasks under 192.168, so
+# masks and hostmasks are bucketed by these keys.
+
+_wildcards = re.compile(r'[*?]')
+def _indexKey(s):
+    # the regexps are case insensitive and treat []\ as {}|
+    if s.isascii():
+        return IRClower(s).lower()
+
+def mask_key(mask):
+    """Returns (kind, key) of the bucket for mask, or None if it has to be
+    tried against every hostmask."""
+    if mask.count('!') != 1 or mask.count('@') != 1:
+        return None
+    nick, _, rest = mask.partition('!')
+    user, _, host = rest.partition('@')
+    if '@' in nick:
+        return None
+
+    for kind, part in (('nick', nick), ('host', host), ('user', user)):
+        if not _wildcards.search(part):
+            key = _indexKey(part)
+            return key is not None and (kind, key) or None
+
+    wildcards = [ m.start() for m in _wildcards.finditer(host) ]
+    suffix = host[wildcards[-1] + 1:]
+    if suffix[:1] == '.':
+        domain = suffix[1:]
+    else:
+        domain = suffix.partition('.')[2]
+    if domain:
+        key = _indexKey(domain)
+        return key is not None and ('domain', key) or None
+
+    prefix = host[:wildcards[0]].rpartition('.')[0]
+    if prefix:
+        key = _indexKey(prefix)
+        return key is not None and ('prefix', key) or None
+    return None
+
+def hostmask_keys(hostmask):
+    """Returns the (kind, key) buckets hostmask belongs to, or None if it has
+    to be tried against every mask."""
+    if hostmask.count('!') != 1 or hostmask.count('@') != 1 or '$' in hostmask:
+        return None
+    key = _indexKey(hostmask)
+    if key is None:
+        return None
+    nick, _, rest = key.partition('!')
+    user, _, host = rest.partition('@')
+    if '@' in nick:
+        return None
+
+    keys = [ ('nick', nick), ('user', user), ('host', host) ]
+    labels = host.split('.')
+    for i in range(1, len(labels)):
+        keys.append(('domain', '.'.join(labels[i:])))
+        keys.append(('prefix', '.'.join(labels[:i])))
+    return keys
+
+class MaskIndex(object):
+    """Index of channel masks, for finding the ones matching a hostmask."""
+    def __init__(self, masks=()):
+        self.order = {}
+        self.buckets = defaultdict(set)
+        self.unindexed = set()
+        self._count = 0
+        self._anyRegexp = None
+        for mask in masks:
+            self.add(mask)
+
+    def add(self, mask):
+        if mask in self.order or not is_hostmask(mask):
+            # masks that aren't hostmasks (like extbans) never match
+            return
+        pattern = mask.partition('$')[0]
+        self.order[mask] = self._count
+        self._count += 1
+        key = mask_key(pattern)
+        if key:
+            self.buckets[key].add(mask)
+        else:
+            self.unindexed.add(mask)
+        self._anyRegexp = None
+
+    def remove(self, mask):
+        if self.order.pop(mask, None) is None:
+            return
+        key = mask_key(mask.partition('$')[0])
+        if key:
+            self.buckets[key].discard(mask)
+            if not self.buckets[key]:
+                del self.buckets[key]
+        else:
+            self.unindexed.discard(mask)
+        self._anyRegexp = None
+
+    def candidates(self, hostmask):
+        keys = hostmask_keys(hostmask)
+        if keys is None:
+            return set(self.order)
+        L = set(self.unindexed)
+        for key in keys:
+            if key in self.buckets:
+                L.update(self.buckets[key])
+        return L
+
+    def _combinedRegexp(self, masks):
+        """Single regexp matching whatever any of masks matches."""
+        patterns = []
+        for mask in masks:
+            pattern = mask.partition('$')[0]
+            patterns.append(maskRegexp(pattern).pattern)
+            patterns.append(maskRegexp(pattern + '$*').pattern)
+        if patterns:
+            return re.compile('|'.join(patterns), re.I)
+
+    def anyMatch(self, hostmask):
+        """Returns whether any mask matches hostmask. Masks without a bucket
+        are tried all at once with a combined regexp."""
+        if not is_hostmask(hostmask) or not self.order:
+            return False
+        if self._anyRegexp is None:
+            self._anyRegexp = (self._combinedRegexp(self.order),
+                               self._combinedRegexp(self.unindexed))
+        keys = hostmask_keys(hostmask)
+        if keys is None:
+            return self._anyRegexp[0].match(hostmask) is not None
+        if self._anyRegexp[1] and self._anyRegexp[1].match(hostmask):
+            return True
+        for key in keys:
+            for mask in self.buckets.get(key, ()):
+                if hostmask_match(mask, hostmask):
+                    return True
+        return False
+
+    def match(self, hostmask):
+        """Returns the masks matching hostmask, in the order they were added."""
+        L = [ mask for mask in self.candidates(hostmask) if hostmask_match(mask, hostmask) ]
+        L.sort(key=self.order.get)
+        return L
+
+class HostmaskIndex(object):
+    """Index of user hostmasks, for finding the ones matching a mask."""
+    def __init__(self, hostmasks):
+        self.hostmasks = hostmasks
+        self.buckets = defaultdict(list)
+        self.unindexed = []
+        for i, hostmask in enumerate(hostmasks):
+            keys = hostmask_keys(hostmask)
+            if keys is None:
+                self.unindexed.append(i)
+                continue
+            for key in keys:
+                self.buckets[key].append(i)
+
+    def match(self, mask):
+        """Same as hostmask_match_list(mask, hostmasks)"""
+        if not is_hostmask(mask):
+            return ''
+        key = mask_key(mask.partition('$')[0])
+        if key is None:
+            return hostmask_match_list(mask, self.hostmasks)
+        positions = sorted(set(self.buckets.get(key, ())).union(self.unindexed))
+        return hostmask_match_list(mask, [ self.hostmasks[i] for i in positions ])
+
 def get_nick(s):
     """':nick!user@host' => 'nick'"""
     return weechat.info_get('irc_nick_from_host', s)
@@ -1323,9 +1510,41 @@ class MaskObject(object):
 
 class MaskList(CaseInsensibleDict):
     """Single list of masks"""
+    _index = None
+    _cache = None
+
     def __init__(self, server, channel):
         self.synced = 0
 
+    def __setitem__(self, mask, ban):
+        CaseInsensibleDict.__setitem__(self, mask, ban)
+        if self._index is not None:
+            self._index.add(self.key(mask))
+        self.changed(mask)
+
+    def __delitem__(self, mask):
+        CaseInsensibleDict.__delitem__(self, mask)
+        if self._index is not None:
+            self._index.remove(self.key(mask))
+        self.changed(mask)
+
+    def pop(self, mask):
+        ban = CaseInsensibleDict.pop(self, mask)
+        if self._index is not None:
+            self._index.remove(self.key(mask))
+        self.changed(mask)
+        return ban
+
+    def changed(self, mask):
+        """Tells the store mask needs to be saved again."""
+        if self._cache is not None:
+            self._cache.store.changed(self, mask)
+
+    def index(self):
+        if self._index is None:
+            self._index = MaskIndex(self)
+        return self._index
+
     def add(self, mask, **kwargs):
         if mask in self:
             # mask exists, update it
@@ -1333,6 +1552,7 @@ class MaskList(CaseInsensibleDict):
             for attr, value in list(kwargs.items()):
                 if value and not getattr(ban, attr):
                     setattr(ban, attr, value)
+                    self.changed(mask)
         else:
             ban = self[mask] = MaskObject(mask, **kwargs)
         return ban
@@ -1346,16 +1566,77 @@ class MaskList(CaseInsensibleDict):
 
     def search(self, pattern, reverseMatch=False):
         if reverseMatch:
-            L = [ mask for mask in self if hostmask_match(mask, pattern) ]
+            L = self.index().match(pattern)
         else:
             L = pattern_match_list(pattern, list(self.keys()))
         return L
 
+    def anyMatch(self, hostmask):
+        return self.index().anyMatch(hostmask)
+
     def purge(self):
         pass
 
 class MaskCache(ServerChannelDict):
-    """Keeps a cache of masks for different channels."""
+    """Keeps a cache of masks for different channels, reading them from the
+    store when first needed."""
+    mode = None
+    store = None
+
+    def __init__(self, mode=None, store=None):
+        self.mode = mode
+        self.store = store
+
+    def _attach(self, key, masklist):
+        masklist.mode = self.mode
+        masklist.storeKey = (self.mode, self.key(key))
+        masklist._cache = self
+
+    def __getitem__(self, key):
+        try:
+            return ServerChannelDict.__getitem__(self, key)
+        except KeyError:
+            if self.store is None:
+                raise
+            masklist = self.store.load(self.mode, *key)
+            if masklist is None:
+                raise
+            self._attach(key, masklist)
+            ServerChannelDict.__setitem__(self, key, masklist)
+            return masklist
+
+    def __setitem__(self, key, masklist):
+        ServerChannelDict.__setitem__(self, key, masklist)
+        if self.store is not None:
+            self._attach(key, masklist)
+            self.store.replace(masklist)
+
+    def __delitem__(self, key):
+        stored = self.store is not None and self.store.has(self.mode, *key)
+        if stored:
+            self.store.delete(self.mode, *key)
+        try:
+            ServerChannelDict.__delitem__(self, key)
+        except KeyError:
+            if not stored:
+                raise
+
+    def __contains__(self, key):
+        if ServerChannelDict.__contains__(self, key):
+            return True
+        return self.store is not None and self.store.has(self.mode, *key)
+
+    def keys(self):
+        keys = list(ServerChannelDict.keys(self))
+        if self.store is not None:
+            loaded = set(keys)
+            keys.extend([ key for key in map(self.key, self.store.keys(self.mode))
+                          if key not in loaded ])
+        return keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
     def add(self, server, channel, mask, **kwargs):
         """Adds a ban to (server, channel) banlist."""
         key = (server, channel)
@@ -1375,29 +1656,192 @@ class MaskCache(ServerChannelDict):
         except KeyError:
             pass
 
-class ChanopCache(Shelf):
-    def __init__(self, filename):
-        options = {
-            'directory': 'data',
-        }
-        path = weechat.string_eval_path_home('%%h/%s' % filename, {}, {}, options)
-        Shelf.__init__(self, path, writeback=True)
+def chanop_data_path(filename):
+    options = {
+        'directory': 'data',
+    }
+    return weechat.string_eval_path_home('%%h/%s' % filename, {}, {}, options)
+
+class MaskStore(object):
+    """Stores mask lists in append-only files, one for each mode, server and
+    channel. A file is only read when its list is first needed, and only the
+    masks that changed are appended to it. Files are rewritten once they hold
+    too many stale records."""
+    __name__ = ''
+    flush_delay = 2000
+    compact_slack = 100
+
+    def __init__(self, dirname):
+        self.path = chanop_data_path(dirname)
+        self.records = {}
+        self.dirty = {}
+        self.rewrite = set()
+        self._keys = defaultdict(CaseInsensibleSet)
+        self._hook_flush = ''
+        for mode in self._listdir(self.path):
+            for server in self._listdir(os.path.join(self.path, mode)):
+                for channel in self._listdir(os.path.join(self.path, mode, server)):
+                    self._keys[unquote(mode)].add((unquote(server), unquote(channel)))
+
+    def _listdir(self, path):
+        try:
+            return [ name for name in os.listdir(path) if not name.endswith('.tmp') ]
+        except OSError:
+            return []
+
+    def filename(self, mode, server, channel):
+        return os.path.join(self.path, *[ quote(IRClower(s), safe='')
+                                          for s in (mode, server, channel) ])
+
+    def keys(self, mode):
+        return list(self._keys[mode])
+
+    def has(self, mode, server, channel):
+        return (server, channel) in self._keys[mode]
+
+    def load(self, mode, server, channel):
+        """Reads the list of (mode, server, channel), None if there's none."""
+        if not self.has(mode, server, channel):
+            return None
+        masklist = MaskList(server, channel)
+        count = 0
+        try:
+            with open(self.filename(mode, server, channel)) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # incomplete record of an interrupted write
+                        continue
+                    count += 1
+                    if record[0] == '+':
+                        mask, operator, date, expires, hostmask = record[1:]
+                        CaseInsensibleDict.__setitem__(masklist, mask,
+                                MaskObject(mask, hostmask, operator, date, expires))
+                    elif record[0] == '-':
+                        try:
+                            CaseInsensibleDict.__delitem__(masklist, record[1])
+                        except KeyError:
+                            pass
+        except (IOError, OSError) as e:
+            error('Failed to read %s +%s masks: %s' % (channel, mode, e))
+        self.records[mode, caseInsensibleKey((server, channel))] = count
+        debug('* loaded %s +%s masks of %s %s (%s records)', len(masklist), mode,
+              server, channel, count)
+        return masklist
+
+    def changed(self, masklist, mask):
+        masks = self.dirty.setdefault(masklist.storeKey, (masklist, set()))[1]
+        masks.add(masklist.key(mask))
+        self._schedule()
+
+    def replace(self, masklist):
+        mode, key = masklist.storeKey
+        self._keys[mode].add(key)
+        self.rewrite.add(masklist.storeKey)
+        self.dirty.setdefault(masklist.storeKey, (masklist, set()))
+        self._schedule()
+
+    def delete(self, mode, server, channel):
+        storeKey = (mode, caseInsensibleKey((server, channel)))
+        self.dirty.pop(storeKey, None)
+        self.rewrite.discard(storeKey)
+        self.records.pop(storeKey, None)
+        self._keys[mode].discard((server, channel))
+        try:
+            os.remove(self.filename(mode, server, channel))
+        except OSError:
+            pass
+
+    def _schedule(self):
+        if not self._hook_flush:
+            self._hook_flush = weechat.hook_timer(self.flush_delay, 0, 1,
+                                                  callback(self._flushCallback), '')
 
-class ModeCache(ChanopCache):
+    def _flushCallback(self, data, count):
+        self._hook_flush = ''
+        self.flush()
+        return WEECHAT_RC_OK
+
+    def _record(self, masklist, mask):
+        if mask in masklist:
+            ban = masklist[mask]
+            record = [ '+', str(mask), ban.operator or '', ban.date, ban.expires,
+                       list(ban.hostmask) ]
+        else:
+            record = [ '-', str(mask) ]
+        return json.dumps(record) + '\n'
+
+    def flush(self):
+        """Writes the changed masks."""
+        if self._hook_flush:
+            weechat.unhook(self._hook_flush)
+            self._hook_flush = ''
+        dirty, self.dirty = self.dirty, {}
+        rewrite, self.rewrite = self.rewrite, set()
+        for storeKey, (masklist, masks) in dirty.items():
+            mode, key = storeKey
+            filename = self.filename(mode, *key)
+            count = self.records.get(storeKey, 0) + len(masks)
+            try:
+                if storeKey in rewrite or count > 2 * len(masklist) + self.compact_slack:
+                    # compact
+                    dirname = os.path.dirname(filename)
+                    if not os.path.isdir(dirname):
+                        os.makedirs(dirname)
+                    with open(filename + '.tmp', 'w') as f:
+                        for mask in masklist:
+                            f.write(self._record(masklist, mask))
+                    os.replace(filename + '.tmp', filename)
+                    self.records[storeKey] = len(masklist)
+                else:
+                    with open(filename, 'a') as f:
+                        for mask in masks:
+                            f.write(self._record(masklist, mask))
+                    self.records[storeKey] = count
+            except (IOError, OSError) as e:
+                error('Failed to save +%s masks of %s: %s' % (mode, key[1], e))
+
+    def migrate(self, filename, modeCache):
+        """Moves the masks of the old shelf cache into the store."""
+        import glob
+        import shelve
+        path = chanop_data_path(filename)
+        files = [ name for name in glob.glob(path + '*') if not name.endswith('.old') ]
+        if not files:
+            return
+        try:
+            shelf = shelve.open(path, 'r')
+            try:
+                for mode in list(shelf.keys()):
+                    if mode not in modeCache:
+                        continue
+                    cache = modeCache[mode]
+                    for key, oldlist in list(shelf[mode].items()):
+                        if key not in cache:
+                            masklist = cache[key] = MaskList(*key)
+                            for mask, ban in list(oldlist.items()):
+                                masklist[mask] = ban
+            finally:
+                shelf.close()
+        except Exception as e:
+            error('Failed to migrate masks from %s: %s' % (path, e))
+            return
+        self.flush()
+        for name in files:
+            os.rename(name, name + '.old')
+        say('Masks cache moved from %s to %s' % (path, self.path))
+
+class ModeCache(dict):
     """class for store channel modes lists."""
-    def __init__(self, filename):
-        ChanopCache.__init__(self, filename)
+    def __init__(self, dirname):
+        self.store = MaskStore(dirname)
         self.modes = set()
         self.map = CaseInsensibleDict()
 
-        # reset all sync timers
-        for cache in list(self.values()):
-            for masklist in list(cache.values()):
-                masklist.synced = 0
-
     def registerMode(self, mode, *args):
         if mode not in self:
-            cache = MaskCache()
+            cache = MaskCache(mode, self.store)
             self[mode] = cache
 
         if mode not in self.modes:
@@ -1409,9 +1853,9 @@ class ModeCache(ChanopCache):
 
     def __getitem__(self, mode):
         try:
-            return ChanopCache.__getitem__(self, mode)
+            return dict.__getitem__(self, mode)
         except KeyError:
-            return ChanopCache.__getitem__(self, self.map[mode])
+            return dict.__getitem__(self, self.map[mode])
 
     def add(self, server, channel, mode, mask, **kwargs):
         assert mode in self.modes
@@ -1424,10 +1868,17 @@ class ModeCache(ChanopCache):
         for cache in list(self.values()):
             cache.purge()
 
+    def flush(self):
+        self.store.flush()
+
 class MaskSync(object):
-    """Class for fetch and sync bans of any channel and mode."""
+    """Class for fetch and sync bans of any channel and mode.
+
+    Keeps up to sync_max_requests mask lists requests in flight per server,
+    replies are matched with their request from the channel in the numeric.
+    Requests without a reply after _timeout seconds, or for a server that got
+    disconnected, are given up."""
     __name__ = ''
-    _hide_msg = False
 
     _hook_mask = ''
     _hook_end = ''
@@ -1437,10 +1888,20 @@ class MaskSync(object):
     _hook_quiet_end = ''
 
     # sync queue stuff
-    queue = []
+    _pending = CaseInsensibleDefaultDict(list)
+    _inflight = CaseInsensibleDefaultDict(dict) # request: time it was sent
     _maskbuffer = CaseInsensibleDefaultDict(list)
     _callback = CaseInsensibleDict()
 
+    _timeout = 60
+    _hook_timeout = ''
+
+    # progress of the current sync
+    _total = 0
+    _done = 0
+    _failed = 0
+    _started = 0
+
     def hook(self):
         # 367 - ban mask
         # 368 - end of ban list
@@ -1460,12 +1921,27 @@ class MaskSync(object):
         for hook in ('_hook_mask',
                      '_hook_end',
                      '_hook_quiet_mask',
-                     '_hook_quiet_end'):
+                     '_hook_quiet_end',
+                     '_hook_timeout'):
             attr = getattr(self, hook)
             if attr:
                 weechat.unhook(attr)
                 setattr(self, hook, '')
 
+    @property
+    def queue(self):
+        """(server, channel, mode) of the requests in flight or waiting."""
+        L = []
+        for requests in (self._inflight, self._pending):
+            for server, items in list(requests.items()):
+                L.extend([ (server, channel, mode) for channel, mode in items ])
+        return L
+
+    def max_requests(self, server):
+        value = get_config_int('sync_max_requests',
+                               lambda config: get_config_specific(config, server))
+        return max(1, value)
+
     def fetch(self, server, channel, mode, callback=None):
         """Fetches masks for a given server and channel."""
         buffer = weechat.buffer_search('irc', 'server.%s' %server)
@@ -1487,75 +1963,149 @@ class MaskSync(object):
         except KeyError:
             pass
 
-        if not self.queue:
-            self.queue.append((server, channel, mode))
-            self._fetch(server, channel, mode)
-        elif (server, channel, mode) not in self.queue:
-            self.queue.append((server, channel, mode))
+        request = caseInsensibleKey((channel, mode))
+        if request not in self._pending[server] and request not in self._inflight[server]:
+            if not self.queue:
+                self._total = self._done = self._failed = 0
+                self._started = time.time()
+            self._total += 1
+            self._pending[server].append(request)
 
         if callback:
-            self._callback[server, channel] = callback
+            self._callback[server, channel, mode] = callback
+
+        self._sendRequests(server)
+
+    def _sendRequests(self, server):
+        pending, inflight = self._pending[server], self._inflight[server]
+        limit = self.max_requests(server)
+        while pending and len(inflight) < limit:
+            request = pending.pop(0)
+            inflight[request] = time.time()
+            self._fetch(server, *request)
+        if inflight and not self._hook_timeout:
+            self._hook_timeout = weechat.hook_timer(10*1000, 0, 0,
+                                                    callback(self._timeoutCallback), '')
+        self._updateStatus()
+
+    def _timeoutCallback(self, data, count):
+        """Gives up on requests without reply, so they don't hold their slot."""
+        expired = time.time() - self._timeout
+        for server, inflight in list(self._inflight.items()):
+            for request, sent in list(inflight.items()):
+                if sent < expired:
+                    debug('MASK SYNC: no reply for %s %s', server, request)
+                    self._giveUp(server, request)
+            self._sendRequests(server)
+        if not any(self._inflight.values()):
+            weechat.unhook(self._hook_timeout)
+            self._hook_timeout = ''
+        return WEECHAT_RC_OK
+
+    def _giveUp(self, server, request):
+        if request in self._inflight[server]:
+            del self._inflight[server][request]
+        else:
+            self._pending[server].remove(request)
+        self._done += 1
+        self._failed += 1
+        key = (server, ) + request
+        if key in self._maskbuffer:
+            del self._maskbuffer[key]
+        if key in self._callback:
+            del self._callback[key]
+
+    def clear(self, server):
+        """Gives up on all requests for server, for when it got disconnected."""
+        requests = list(self._inflight[server]) + self._pending[server]
+        for request in requests:
+            self._giveUp(server, request)
+        if requests:
+            self._updateStatus()
 
     def _fetch(self, server, channel, mode):
         buffer = weechat.buffer_search('irc', 'server.%s' %server)
         if not buffer:
             return
         cmd = '/mode %s %s' %(channel, mode)
-        self._hide_msg = True
         weechat_command(buffer, cmd)
 
+    def _updateStatus(self):
+        """Shows the progress of syncs of several lists in the status item."""
+        if self._total < 2 or not get_config_boolean('enable_bar'):
+            return
+        global chanop_bar_status
+        elapsed = time.time() - self._started
+        if self.queue:
+            chanop_bar_status = 'Syncing masks: %s/%s lists (%.1fs)' % (self._done,
+                                                                        self._total,
+                                                                        elapsed)
+        else:
+            chanop_bar_status = 'Synced %s mask lists in %.1fs.' % (self._total - self._failed,
+                                                                   elapsed)
+            if self._failed:
+                chanop_bar_status += ' %s lists failed.' % self._failed
+            debug('MASK SYNC: %s lists in %.1fs, %s failed', self._total, elapsed, self._failed)
+        weechat.bar_item_update('chanop_status')
+        chanop_bar.popup()
+
+    def _isRequested(self, server, channel, mode):
+        return caseInsensibleKey((channel, mode)) in self._inflight[server]
+
     def _maskCallback(self, data, modifier, modifier_data, string):
         """callback for store a single mask."""
         #debug("MASK %s: %s %s", modifier, modifier_data, string)
         args = string.split()
-        if self.queue:
-            server, channel, _ = self.queue[0]
-        else:
-            server, channel = modifier_data, args[3]
+        server, channel = modifier_data, args[3]
 
         if modifier == 'irc_in_367':
+            mode = 'b'
             try:
                 mask, op, date = args[4:]
-            except IndexError:
+            except ValueError:
                 mask = args[4]
                 op = date = None
         elif modifier == 'irc_in_728':
+            mode = args[4]
             mask, op, date = args[5:]
 
         # store temporally until "end list" msg
-        self._maskbuffer[server, channel].append((mask, op, date))
-        if self._hide_msg:
+        self._maskbuffer[server, channel, mode].append((mask, op, date))
+        if self._isRequested(server, channel, mode):
             string = ''
         return string
 
     def _endCallback(self, data, modifier, modifier_data, string):
         """callback for end of channel's mask list."""
         #debug("MASK END %s: %s %s", modifier, modifier_data, string)
-        if self.queue:
-            server, channel, mode = self.queue.pop(0)
+        args = string.split()
+        server, channel = modifier_data, args[3]
+        if modifier == 'irc_in_368':
+            mode = 'b'
+        elif modifier == 'irc_in_729':
+            mode = args[4]
         else:
-            args = string.split()
-            server, channel = modifier_data, args[3]
-            if modifier == 'irc_in_368':
-                mode = args[7]
-            elif modifier == 'irc_in_729':
-                mode = args[4]
-            else:
-                return string
+            return string
+
+        requested = self._isRequested(server, channel, mode)
+        if requested:
+            del self._inflight[server][caseInsensibleKey((channel, mode))]
+            self._done += 1
 
         maskCache = modeCache[mode]
 
         # delete old masks in cache
+        key = (server, channel, mode)
         if (server, channel) in maskCache:
             masklist = maskCache[server, channel]
-            banmasks = [ L[0] for L in self._maskbuffer[server, channel] ]
+            banmasks = [ L[0] for L in self._maskbuffer[key] ]
             for mask in list(masklist.keys()):
                 if mask not in banmasks:
                     del masklist[mask]
 
-        for banmask, op, date in self._maskbuffer[server, channel]:
+        for banmask, op, date in self._maskbuffer[key]:
             maskCache.add(server, channel, banmask, operator=op, date=date)
-        del self._maskbuffer[server, channel]
+        del self._maskbuffer[key]
         try:
             maskList = maskCache[server, channel]
         except KeyError:
@@ -1563,18 +2113,13 @@ class MaskSync(object):
         maskList.synced = now()
 
         # run hooked functions if any
-        if (server, channel) in self._callback:
-            self._callback[server, channel]()
-            del self._callback[server, channel]
+        if key in self._callback:
+            self._callback[key]()
+            del self._callback[key]
 
-        if self._hide_msg:
+        self._sendRequests(server)
+        if requested:
             string = ''
-        if self.queue:
-            next = self.queue[0]
-            self._fetch(*next)
-        else:
-            assert not self._maskbuffer, "mask buffer not empty: %s" % list(self._maskbuffer.keys())
-            self._hide_msg = False
         return string
 
 maskSync = MaskSync()
@@ -1637,6 +2182,7 @@ class UserList(ServerUserList):
         self.channel = channel
         self._purge_list = CaseInsensibleDict()
         self._purge_time = 3600*2 # 2 hours
+        self._hostmaskIndex = {}
 
     def __setitem__(self, nick, user):
         #debug('%s %s: join, %s', self.server, self.channel, nick)
@@ -1672,6 +2218,15 @@ class UserList(ServerUserList):
             # only current hostmasks
             return [ user.hostmask for user in users if user._hostmask ]
 
+    def hostmaskIndex(self, all=False):
+        """Returns a HostmaskIndex of hostmasks(all=all), reused while they
+        don't change."""
+        hostmasks = self.hostmasks(all=all)
+        index = self._hostmaskIndex.get(all)
+        if index is None or index.hostmasks != hostmasks:
+            index = self._hostmaskIndex[all] = HostmaskIndex(hostmasks)
+        return index
+
     def nicks(self, *args, **kwargs):
 #        if not all(self.itervalues()):
 #            userCache.who(self.server, self.channel)
@@ -2667,7 +3222,7 @@ def mode_cb(server, channel, nick, opHostmask, signal_data):
     for action, mode, mask in chanmode_list:
         debug('MODE: %s%s %s %s', action, mode, mask, opHostmask)
         if action == '+':
-            hostmask = hostmask_match_list(mask, userCache[key].hostmasks())
+            hostmask = userCache[key].hostmaskIndex().match(mask)
             if hostmask:
                 affected_users.extend(hostmask)
             if mask != '*!*@*':
@@ -2725,6 +3280,11 @@ def nick_cb(server, channels, oldNick, oldHostmask, signal_data):
         userCache[server, channel][newNick] = user
     return WEECHAT_RC_OK
 
+def server_disconnected_cb(data, signal, signal_data):
+    # the lists requested won't come, don't wait for them
+    maskSync.clear(signal_data)
+    return WEECHAT_RC_OK
+
 # Garbage collector
 def garbage_collector_cb(data, counter):
     """This takes care of purging users and masks from channels not in watchlist, and
@@ -3046,10 +3606,10 @@ def item_ban_matches_cb(data, item, window):
     #debug('ban matches item: %s', masks)
 
     affected = []
-    hostmasks = users.hostmasks(all=True)
+    index = users.hostmaskIndex(all=True)
     for mask in masks:
         if is_hostmask(mask):
-            affected.extend(hostmask_match_list(mask, hostmasks))
+            affected.extend(index.match(mask))
         elif mask in users:
             affected.append(mask)
     #debug('ban matches item: %s', affected)
@@ -3058,7 +3618,18 @@ def item_ban_matches_cb(data, item, window):
         return format('(nobody)')
 
     L = set([ get_nick(h) for h in affected ])
-    return format('(%s) %s' % (len(L), ' '.join(L)))
+    s = format('(%s) %s' % (len(L), ' '.join(L)))
+
+    # users already affected by a mask of the channel
+    try:
+        masklist = modeCache[command[2:]][server, channel]
+    except KeyError:
+        return s
+    L = set([ get_nick(h) for h in affected if masklist.anyMatch(h) ])
+    if L:
+        s += ' (already %s: %s)' % (command[1:] == 'oban' and 'banned' or 'quieted',
+                                    ' '.join(L))
+    return s
 
 chanop_bar_status = ''
 def item_status_cb(data, item, window):
@@ -3103,6 +3674,7 @@ def input_content_cb(data, modifier, modifier_data, string):
 # Main
 
 def unload_chanop():
+    modeCache.flush()
     if chanop_bar:
         # we don't remove it, so custom options configs aren't lost
         chanop_bar.hide()
@@ -3163,12 +3735,13 @@ if __name__ == '__main__' and import_ok and \
         if not weechat.config_is_set_plugin(opt):
             weechat.config_set_plugin(opt, val)
 
-    modeCache = ModeCache('chanop_mode_cache.dat')
+    modeCache = ModeCache('chanop_masks')
     modeCache.registerMode('b', 'ban', 'bans')
     modeCache.registerMode('q', 'quiet', 'quiets')
+    modeCache.store.migrate('chanop_mode_cache.dat', modeCache)
 
     # -------------------------------------------------------------------------
-    # remove old chanmask config and save them in shelf
+    # remove old chanmask config and save them in the cache
 
     prefix = 'python.%s.chanmask' % SCRIPT_NAME
     infolist = Infolist('option', 'plugins.var.%s.*' % prefix)
@@ -3187,6 +3760,7 @@ if __name__ == '__main__' and import_ok and \
         else:
             obj = masklist[mask] = MaskObject(mask)
             obj.deserialize(infolist['value'])
+        masklist.changed(mask)
         weechat.config_unset_plugin('chanmask.%s.%s.%s.%s' \
                 % (server, channel, mode, mask))
     del infolist
@@ -3238,6 +3812,7 @@ if __name__ == '__main__' and import_ok and \
     weechat.hook_signal('*,irc_in_quit', 'quit_cb', '')
     weechat.hook_signal('*,irc_in_nick', 'nick_cb', '')
     weechat.hook_signal('*,irc_in_mode', 'mode_cb', '')
+    weechat.hook_signal('irc_server_disconnected', 'server_disconnected_cb', '')
 
     # run our cleaner function every 30 min.
     weechat.hook_timer(1000 * 60 * 30, 0, 0, 'garbage_collector_cb', '')
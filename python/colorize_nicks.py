@@ -21,6 +21,9 @@
 #
 #
 # History:
+# 2026-10-18:
+#   version 33: find longer nicks in a word with a per-buffer trie,
+#               populate the nicks of a buffer when first needed
 # 2023-10-30: Sébastien Helleu <flashcode@flashtux.org>
 #   version 32: revert to info "nick_color" with WeeChat >= 4.1.1
 # 2023-10-16: Sébastien Helleu <flashcode@flashtux.org>
@@ -100,7 +103,7 @@ w = weechat
 
 SCRIPT_NAME    = "colorize_nicks"
 SCRIPT_AUTHOR  = "xt <xt@bash.no>"
-SCRIPT_VERSION = "32"
+SCRIPT_VERSION = "33"
 SCRIPT_LICENSE = "GPL"
 SCRIPT_DESC    = "Use the weechat nick colors in the chat area"
 
@@ -113,12 +116,62 @@ ignore_nicks = []
 
 # Dict with every nick on every channel with its color as lookup value
 colored_nicks = {}
+# Buffers whose nicks were already added to colored_nicks
+populated_buffers = set()
+
+class NickColors(dict):
+    ''' Colors of the nicks in a buffer. Also keeps the nicks in a trie, so
+    all the nicks inside a word can be found without checking every nick. '''
+
+    def __init__(self):
+        dict.__init__(self)
+        self.trie = {}
+
+    def __setitem__(self, nick, color):
+        if nick not in self:
+            node = self.trie
+            for char in nick:
+                node = node.setdefault(char, {})
+            node[None] = nick
+        dict.__setitem__(self, nick, color)
+
+    def __delitem__(self, nick):
+        dict.__delitem__(self, nick)
+        path = []
+        node = self.trie
+        for char in nick:
+            path.append((node, char))
+            node = node[char]
+        del node[None]
+        # Remove the nodes that were only used by this nick
+        for parent, char in reversed(path):
+            if parent[char]:
+                break
+            del parent[char]
+
+    def nicks_in(self, word):
+        ''' Return every nick that appears in word. '''
+        found = []
+        trie = self.trie
+        length = len(word)
+        for start in range(length):
+            node = trie
+            for i in range(start, length):
+                node = node.get(word[i])
+                if node is None:
+                    break
+                if None in node:
+                    found.append(node[None])
+        return found
 
 CONFIG_FILE_NAME = "colorize_nicks"
 
 # config file and options
 colorize_config_file = ""
 colorize_config_option = {}
+# values of the options used for every line, updated when options change
+colorize_config = {}
+weechat_version = 0
 
 def colorize_config_init():
     '''
@@ -175,13 +228,22 @@ def colorize_config_read():
     global colorize_config_file
     return weechat.config_read(colorize_config_file)
 
+def colorize_config_update(*args):
+    ''' Cache the values of the options used when colorizing lines. '''
+    for name in ('min_nick_length', 'match_limit'):
+        colorize_config[name] = w.config_integer(colorize_config_option[name])
+    for name in ('colorize_input', 'greedy_matching', 'ignore_nicks_in_urls'):
+        colorize_config[name] = w.config_boolean(colorize_config_option[name])
+    colorize_config['ignore_tags'] = set(w.config_string(colorize_config_option['ignore_tags']).split(','))
+    colorize_config['reset'] = w.color('reset')
+    return w.WEECHAT_RC_OK
+
 def colorize_nick_color(buffer, nick, my_nick):
     ''' Retrieve nick color from weechat. '''
     if nick == my_nick:
         return w.color(w.config_string(w.config_get('weechat.color.chat_nick_self')))
     else:
-        version = int(w.info_get('version_number', '') or 0)
-        if w.buffer_get_string(buffer, 'plugin') == 'irc' and version == 0x4010000:
+        if weechat_version == 0x4010000 and w.buffer_get_string(buffer, 'plugin') == 'irc':
             server = w.buffer_get_string(buffer, 'localvar_server')
             return w.info_get('irc_nick_color', '%s,%s' % (server, nick))
         return w.info_get('nick_color', nick)
@@ -202,6 +264,9 @@ def colorize_cb(data, modifier, modifier_data, line):
     channel = w.buffer_get_string(buffer, 'localvar_channel')
     tags = tags.split(',')
 
+    if buffer not in populated_buffers:
+        populate_buffer(buffer)
+
     # Check if buffer has colorized nicks
     if buffer not in colored_nicks:
         return line
@@ -209,11 +274,11 @@ def colorize_cb(data, modifier, modifier_data, line):
     if channel and channel in ignore_channels:
         return line
 
-    min_length = w.config_integer(colorize_config_option['min_nick_length'])
-    reset = w.color('reset')
+    min_length = colorize_config['min_nick_length']
+    reset = colorize_config['reset']
 
     # Don't colorize if the ignored tag is present in message
-    tag_ignores = w.config_string(colorize_config_option['ignore_tags']).split(',')
+    tag_ignores = colorize_config['ignore_tags']
     for tag in tags:
         if tag in tag_ignores:
             return line
@@ -246,9 +311,9 @@ def colorize_cb(data, modifier, modifier_data, line):
 
             try:
                 # Let's use greedy matching. Will check against every word in a line.
-                if w.config_boolean(colorize_config_option['greedy_matching']):
+                if colorize_config['greedy_matching']:
                     cnt = 0
-                    limit = w.config_integer(colorize_config_option['match_limit'])
+                    limit = colorize_config['match_limit']
 
                     for word in line.split():
                         cnt += 1
@@ -256,7 +321,7 @@ def colorize_cb(data, modifier, modifier_data, line):
                         #  if cnt > limit:
                             #  raise RuntimeError('Exceeded colorize_nicks.look.match_limit.');
 
-                        if w.config_boolean(colorize_config_option['ignore_nicks_in_urls']) and \
+                        if colorize_config['ignore_nicks_in_urls'] and \
                               word.startswith(('http://', 'https://')):
                             continue
 
@@ -264,15 +329,14 @@ def colorize_cb(data, modifier, modifier_data, line):
                             # Is there a nick that contains nick and has a greater lenght?
                             # If so let's save that nick into var biggest_nick
                             biggest_nick = ""
-                            for i in colored_nicks[buffer]:
+                            for i in colored_nicks[buffer].nicks_in(word):
                                 cnt += 1
                                 assert cnt < limit
 
-                                if nick in i and nick != i and len(i) > len(nick):
-                                    if i in word:
-                                        # If a nick with greater len is found, and that word
-                                        # also happens to be in word, then let's save this nick
-                                        biggest_nick = i
+                                if nick in i and len(i) > len(nick) and len(i) > len(biggest_nick):
+                                    # If a nick with greater len is found in word,
+                                    # then let's save this nick
+                                    biggest_nick = i
                             # If there's a nick with greater len, then let's skip this
                             # As we will have the chance to colorize when biggest_nick
                             # iterates being nick.
@@ -304,12 +368,15 @@ def colorize_input_cb(data, modifier, modifier_data, line):
 
     global ignore_nicks, ignore_channels, colored_nicks
 
-    min_length = w.config_integer(colorize_config_option['min_nick_length'])
+    min_length = colorize_config['min_nick_length']
 
-    if not w.config_boolean(colorize_config_option['colorize_input']):
+    if not colorize_config['colorize_input']:
         return line
 
     buffer = w.current_buffer()
+    if buffer not in populated_buffers:
+        populate_buffer(buffer)
+
     # Check if buffer has colorized nicks
     if buffer not in colored_nicks:
         return line
@@ -318,7 +385,7 @@ def colorize_input_cb(data, modifier, modifier_data, line):
     if channel and channel in ignore_channels:
         return line
 
-    reset = w.color('reset')
+    reset = colorize_config['reset']
 
     for words in valid_nick_re.findall(line):
         nick = words[1]
@@ -332,33 +399,47 @@ def colorize_input_cb(data, modifier, modifier_data, line):
     return line
 
 def populate_nicks(*args):
-    ''' Fills entire dict with all nicks weechat can see and what color it has
-    assigned to it. '''
+    ''' Forget the nicks of all buffers, so they are added again with their
+    current colors the next time each buffer is used. '''
     global colored_nicks
 
     colored_nicks = {}
+    populated_buffers.clear()
 
-    buffers = w.infolist_get('buffer', '', '')
-    while w.infolist_next(buffers):
-        buffer_ptr = w.infolist_pointer(buffers, 'pointer')
-        my_nick = w.buffer_get_string(buffer_ptr, 'localvar_nick')
-        nicklist = w.infolist_get('nicklist', buffer_ptr, '')
-        while w.infolist_next(nicklist):
-            if buffer_ptr not in colored_nicks:
-                colored_nicks[buffer_ptr] = {}
+    return w.WEECHAT_RC_OK
 
-            if w.infolist_string(nicklist, 'type') != 'nick':
-                continue
+def populate_buffer(buffer_ptr):
+    ''' Fills dict with all nicks in the nicklist of a buffer and what color
+    it has assigned to it. '''
+    global colored_nicks
 
-            nick = w.infolist_string(nicklist, 'name')
-            nick_color = colorize_nick_color(buffer_ptr, nick, my_nick)
+    populated_buffers.add(buffer_ptr)
+    my_nick = w.buffer_get_string(buffer_ptr, 'localvar_nick')
+    nicklist = w.infolist_get('nicklist', buffer_ptr, '')
+    while w.infolist_next(nicklist):
+        if buffer_ptr not in colored_nicks:
+            colored_nicks[buffer_ptr] = NickColors()
 
-            colored_nicks[buffer_ptr][nick] = nick_color
+        if w.infolist_string(nicklist, 'type') != 'nick':
+            continue
+
+        nick = w.infolist_string(nicklist, 'name')
+        nick_color = colorize_nick_color(buffer_ptr, nick, my_nick)
 
-        w.infolist_free(nicklist)
+        colored_nicks[buffer_ptr][nick] = nick_color
 
-    w.infolist_free(buffers)
+    w.infolist_free(nicklist)
 
+def buffer_switch_cb(data, signal, buffer_ptr):
+    ''' Add the nicks of a buffer when it's displayed, for colorizing input. '''
+    if buffer_ptr not in populated_buffers:
+        populate_buffer(buffer_ptr)
+    return w.WEECHAT_RC_OK
+
+def buffer_closed_cb(data, signal, buffer_ptr):
+    ''' Forget the nicks of a closed buffer. '''
+    populated_buffers.discard(buffer_ptr)
+    colored_nicks.pop(buffer_ptr, None)
     return w.WEECHAT_RC_OK
 
 def add_nick(data, signal, type_data):
@@ -369,8 +450,12 @@ def add_nick(data, signal, type_data):
     splitted = type_data.split(',')
     pointer = splitted[0]
     nick = ",".join(splitted[1:])
+    # The whole nicklist is added when the buffer is first used
+    if pointer not in populated_buffers:
+        return w.WEECHAT_RC_OK
+
     if pointer not in colored_nicks:
-        colored_nicks[pointer] = {}
+        colored_nicks[pointer] = NickColors()
 
     my_nick = w.buffer_get_string(pointer, 'localvar_nick')
     nick_color = colorize_nick_color(pointer, nick, my_nick)
@@ -405,13 +490,17 @@ if __name__ == "__main__":
                   SCRIPT_DESC, "", ""):
         colorize_config_init()
         colorize_config_read()
+        weechat_version = int(w.info_get('version_number', '') or 0)
 
-        # Run once to get data ready
+        # Run once to get data ready, nicks of each buffer are added
+        # when the buffer is first used
         update_blacklist()
-        populate_nicks()
+        colorize_config_update()
 
         w.hook_signal('nicklist_nick_added', 'add_nick', '')
         w.hook_signal('nicklist_nick_removed', 'remove_nick', '')
+        w.hook_signal('buffer_switch', 'buffer_switch_cb', '')
+        w.hook_signal('buffer_closed', 'buffer_closed_cb', '')
         w.hook_modifier('weechat_print', 'colorize_cb', '')
         # Hook config for changing colors
         w.hook_config('weechat.color.chat_nick_colors', 'populate_nicks', '')
@@ -422,3 +511,5 @@ if __name__ == "__main__":
         w.hook_modifier('250|input_text_display', 'colorize_input_cb', '')
         # Hook for updating blacklist (this could be improved to use fnmatch)
         weechat.hook_config('%s.look.blacklist*' % SCRIPT_NAME, 'update_blacklist', '')
+        # Hook for updating the cached values of the other options
+        weechat.hook_config('%s.look.*' % SCRIPT_NAME, 'colorize_config_update', '')
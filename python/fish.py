@@ -57,15 +57,23 @@ import struct
 import hashlib
 import base64
 import sys
+import time
 from os import urandom
 
 SCRIPT_NAME = "fish"
 SCRIPT_AUTHOR = "David Flatz <david@upcs.at>"
-SCRIPT_VERSION = "0.15"
+SCRIPT_VERSION = "0.16"
 SCRIPT_LICENSE = "GPL3"
 SCRIPT_DESC = "FiSH for weechat"
 CONFIG_FILE_NAME = SCRIPT_NAME
 
+# number of DH1080 keypairs generated in advance
+DH1080_KEYPAIRS = 2
+# max number of key exchanges waiting for a keypair
+DH1080_MAX_PENDING = 8
+# min delay (in seconds) between two DH1080_INIT from the same peer
+DH1080_INIT_DELAY = 5
+
 import_ok = True
 
 try:
@@ -95,6 +103,11 @@ fish_config_option = {}
 fish_keys = {}
 fish_cyphers = {}
 fish_DH1080ctx = {}
+fish_DH1080_keypairs = []
+fish_DH1080_pending = []
+fish_DH1080_hook = None
+fish_DH1080_stdout = ""
+fish_DH1080_last_init = {}
 fish_encryption_announced = {}
 
 fish_secure_key = ""
@@ -246,39 +259,47 @@ class Blowfish:
         return self.blowfish.encrypt(data)
 
 
+B64_BLOWCRYPT = (
+    "./0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ")
+# two chars for each 12 bits value, least significant 6 bits first
+B64_BLOWCRYPT_ENCODE = [B64_BLOWCRYPT[i & 0x3f] + B64_BLOWCRYPT[i >> 6]
+                        for i in range(4096)]
+# 6 bits value of each char (0xFF for invalid chars)
+B64_BLOWCRYPT_DECODE = bytes(
+    B64_BLOWCRYPT.index(chr(i)) if chr(i) in B64_BLOWCRYPT else 0xFF
+    for i in range(256))
+
+
 # XXX: Unstable.
 def blowcrypt_b64encode(s):
     """A non-standard base64-encode."""
-    B64 = "./0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
-    res = ''
-    while s:
-        left, right = struct.unpack('>LL', s[:8])
-        for i in range(6):
-            res += B64[right & 0x3f]
-            right >>= 6
-        for i in range(6):
-            res += B64[left & 0x3f]
-            left >>= 6
-        s = s[8:]
-    return res
+    # each 8 bytes block is two 32 bits words (left, right), each word is
+    # encoded as 6 chars, right word first
+    words = struct.unpack('>%dL' % (len(s) // 4), s)
+    if len(words) % 2:
+        raise struct.error('length must be a multiple of 8')
+    table = B64_BLOWCRYPT_ENCODE
+    return ''.join([
+        table[right & 0xfff] + table[right >> 12 & 0xfff] + table[right >> 24] +
+        table[left & 0xfff] + table[left >> 12 & 0xfff] + table[left >> 24]
+        for left, right in zip(words[0::2], words[1::2])])
 
 
 def blowcrypt_b64decode(s):
     """A non-standard base64-decode."""
-    B64 = "./0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
-    res = []
-    while s:
-        left, right = 0, 0
-        for i, p in enumerate(s[0:6]):
-            right |= B64.index(p) << (i * 6)
-        for i, p in enumerate(s[6:12]):
-            left |= B64.index(p) << (i * 6)
-        for i in range(0, 4):
-            res.append((left & (0xFF << ((3 - i) * 8))) >> ((3 - i) * 8))
-        for i in range(0, 4):
-            res.append((right & (0xFF << ((3 - i) * 8))) >> ((3 - i) * 8))
-        s = s[12:]
-    return bytes(res)
+    values = s.encode('ascii').translate(B64_BLOWCRYPT_DECODE)
+    if b'\xff' in values:
+        raise ValueError('invalid char in blowcrypt base64 string')
+    if len(values) % 12:
+        values += b'\x00' * (12 - len(values) % 12)
+    # 6 chars for each 32 bits word (bits over 32 are ignored)
+    words = [(values[i] | values[i + 1] << 6 | values[i + 2] << 12 |
+              values[i + 3] << 18 | values[i + 4] << 24 |
+              values[i + 5] << 30) & 0xffffffff
+             for i in range(0, len(values), 6)]
+    # right word is encoded first
+    words[0::2], words[1::2] = words[1::2], words[0::2]
+    return struct.pack('>%dL' % len(words), *words)
 
 
 def padto(msg, length):
@@ -296,7 +317,19 @@ def blowcrypt_pack(msg, cipher):
     return '+OK ' + blowcrypt_b64encode(cipher.encrypt(padto(msg, 8)))
 
 
-def blowcrypt_unpack(msg, cipher, key):
+def blowcrypt_cbc_decrypt(cipher, iv, data):
+    """CBC decryption with the ECB cipher (no new key schedule)."""
+    if len(iv) != 8:
+        raise ValueError
+    if not data:
+        return b''
+    # each plain block is decrypted block xor previous encrypted block
+    plain = int.from_bytes(cipher.decrypt(data), 'big')
+    mask = int.from_bytes(iv + data[:-8], 'big')
+    return (plain ^ mask).to_bytes(len(data), 'big')
+
+
+def blowcrypt_unpack(msg, cipher):
     """."""
     if not (msg.startswith('+OK ') or msg.startswith('mcps ')):
         raise ValueError
@@ -311,10 +344,7 @@ def blowcrypt_unpack(msg, cipher, key):
         iv = raw[:8]
         raw = raw[8:]
 
-        cbcCipher = CryptoBlowfish.new(
-                key.encode('utf-8'), CryptoBlowfish.MODE_CBC, iv)
-
-        plain = cbcCipher.decrypt(padto(raw, 8))
+        plain = blowcrypt_cbc_decrypt(cipher, iv, padto(raw, 8))
 
     else:
 
@@ -455,13 +485,17 @@ def dh_validate_public(public, q, p):
 
 
 class DH1080Ctx:
-    """DH1080 context."""
-    def __init__(self):
+    """DH1080 context (keypair is (private, public) generated before)."""
+    def __init__(self, keypair=None):
         self.public = 0
         self.private = 0
         self.secret = 0
         self.state = 0
 
+        if keypair:
+            self.private, self.public = keypair
+            return
+
         bits = 1080
         while True:
             self.private = bytes2int(urandom(bits // 8))
@@ -575,6 +609,19 @@ def fish_secure_key_cb(data, option, value):
     return weechat.WEECHAT_RC_OK
 
 
+def fish_cipher(targetl):
+    """Return the cipher for target, cached until its key changes."""
+    global fish_keys, fish_cyphers
+
+    key = fish_keys[targetl]
+    cached = fish_cyphers.get(targetl)
+    if cached is None or cached[0] != key:
+        cached = (key, Blowfish(key))
+        fish_cyphers[targetl] = cached
+
+    return cached[1]
+
+
 def fish_modifier_in_notice_cb(data, modifier, server_name, string):
     global fish_DH1080ctx, fish_keys, fish_cyphers
 
@@ -617,25 +664,13 @@ def fish_modifier_in_notice_cb(data, modifier, server_name, string):
         return ""
 
     if match.group(5) == "DH1080_INIT ":
-        fish_DH1080ctx[targetl] = DH1080Ctx()
+        if not fish_dh1080_init_allowed(targetl):
+            return ""
 
         msg = ' '.join(match.group(4).split()[0:2])
 
-        if not dh1080_unpack(msg, fish_DH1080ctx[targetl]):
-            fish_announce_unencrypted(buffer, target)
-            return string
-
-        reply = dh1080_pack(fish_DH1080ctx[targetl])
-
-        fish_alert(buffer, "Key exchange initiated by %s. Key set." % target)
-
-        weechat.command(buffer, "/mute -all notice %s %s" % (
-                match.group(2), reply))
-
-        fish_keys[targetl] = dh1080_secret(fish_DH1080ctx[targetl])
-        if targetl in fish_cyphers:
-            del fish_cyphers[targetl]
-        del fish_DH1080ctx[targetl]
+        fish_dh1080_with_ctx(buffer, target, fish_dh1080_reply_init,
+                             buffer, match.group(2), target, targetl, msg)
 
         return ""
 
@@ -644,16 +679,10 @@ def fish_modifier_in_notice_cb(data, modifier, server_name, string):
             fish_announce_unencrypted(buffer, target)
             return string
 
-        key = fish_keys[targetl]
-
         try:
-            if targetl not in fish_cyphers:
-                b = Blowfish(key)
-                fish_cyphers[targetl] = b
-            else:
-                b = fish_cyphers[targetl]
+            b = fish_cipher(targetl)
 
-            clean = blowcrypt_unpack(match.group(4), b, key)
+            clean = blowcrypt_unpack(match.group(4), b)
 
             fish_announce_encrypted(buffer, target)
 
@@ -707,16 +736,10 @@ def fish_modifier_in_privmsg_cb(data, modifier, server_name, string):
 
         return string
 
-    key = fish_keys[targetl]
-
     try:
-        if targetl not in fish_cyphers:
-            b = Blowfish(key)
-            fish_cyphers[targetl] = b
-        else:
-            b = fish_cyphers[targetl]
+        b = fish_cipher(targetl)
 
-        clean = blowcrypt_unpack(match.group(5), b, key)
+        clean = blowcrypt_unpack(match.group(5), b)
 
         fish_announce_encrypted(buffer, target)
 
@@ -759,16 +782,10 @@ def fish_modifier_in_topic_cb(data, modifier, server_name, string):
 
         return string
 
-    key = fish_keys[targetl]
-
     try:
-        if targetl not in fish_cyphers:
-            b = Blowfish(key)
-            fish_cyphers[targetl] = b
-        else:
-            b = fish_cyphers[targetl]
+        b = fish_cipher(targetl)
 
-        clean = blowcrypt_unpack(match.group(3), b, key)
+        clean = blowcrypt_unpack(match.group(3), b)
 
         fish_announce_encrypted(buffer, target)
 
@@ -799,16 +816,10 @@ def fish_modifier_in_332_cb(data, modifier, server_name, string):
 
         return string
 
-    key = fish_keys[targetl]
-
     try:
-        if targetl not in fish_cyphers:
-            b = Blowfish(key)
-            fish_cyphers[targetl] = b
-        else:
-            b = fish_cyphers[targetl]
+        b = fish_cipher(targetl)
 
-        clean = blowcrypt_unpack(match.group(3), b, key)
+        clean = blowcrypt_unpack(match.group(3), b)
 
         fish_announce_encrypted(buffer, target)
 
@@ -839,11 +850,7 @@ def fish_modifier_out_privmsg_cb(data, modifier, server_name, string):
 
         return string
 
-    if targetl not in fish_cyphers:
-        b = Blowfish(fish_keys[targetl])
-        fish_cyphers[targetl] = b
-    else:
-        b = fish_cyphers[targetl]
+    b = fish_cipher(targetl)
     cypher = blowcrypt_pack(fish_msg_wo_marker(match.group(3)).encode(), b)
 
     fish_announce_encrypted(buffer, target)
@@ -873,11 +880,7 @@ def fish_modifier_out_topic_cb(data, modifier, server_name, string):
 
         return string
 
-    if targetl not in fish_cyphers:
-        b = Blowfish(fish_keys[targetl])
-        fish_cyphers[targetl] = b
-    else:
-        b = fish_cyphers[targetl]
+    b = fish_cipher(targetl)
     cypher = blowcrypt_pack(match.group(3).encode(), b)
 
     fish_announce_encrypted(buffer, target)
@@ -990,10 +993,8 @@ def fish_cmd_blowkey(data, buffer, args):
             return weechat.WEECHAT_RC_ERROR
 
         weechat.prnt(buffer, "Initiating DH1080 Exchange with %s" % target)
-        fish_DH1080ctx[targetl] = DH1080Ctx()
-        msg = dh1080_pack(fish_DH1080ctx[targetl])
-        weechat.command(buffer, "/mute -all notice -server %s %s %s" % (
-            server_name, target_user, msg))
+        fish_dh1080_with_ctx(buffer, target, fish_dh1080_send_init,
+                             buffer, server_name, target_user, targetl)
 
         return weechat.WEECHAT_RC_OK
 
@@ -1082,6 +1083,139 @@ def fish_secure_genkey(buffer):
         weechat.command(buffer, "/secure set fish %s" % newKey)
 
 
+def fish_dh1080_reply_init(buffer, nick, target, targetl, msg, ctx):
+    global fish_DH1080ctx, fish_keys, fish_cyphers
+
+    fish_DH1080ctx[targetl] = ctx
+
+    try:
+        dh1080_unpack(msg, ctx)
+    except ValueError:
+        del fish_DH1080ctx[targetl]
+        fish_alert(buffer, "Invalid key exchange from %s" % target)
+        fish_announce_unencrypted(buffer, target)
+        return
+
+    reply = dh1080_pack(ctx)
+
+    fish_alert(buffer, "Key exchange initiated by %s. Key set." % target)
+
+    weechat.command(buffer, "/mute -all notice %s %s" % (nick, reply))
+
+    fish_keys[targetl] = dh1080_secret(ctx)
+    if targetl in fish_cyphers:
+        del fish_cyphers[targetl]
+    del fish_DH1080ctx[targetl]
+
+
+def fish_dh1080_send_init(buffer, server_name, target_user, targetl, ctx):
+    global fish_DH1080ctx
+
+    fish_DH1080ctx[targetl] = ctx
+    msg = dh1080_pack(ctx)
+    weechat.command(buffer, "/mute -all notice -server %s %s %s" % (
+        server_name, target_user, msg))
+
+
+def fish_dh1080_init_allowed(targetl):
+    """Rate limit DH1080_INIT received from a peer."""
+    global fish_DH1080_last_init
+
+    now = time.time()
+    if now - fish_DH1080_last_init.get(targetl, 0) < DH1080_INIT_DELAY:
+        return False
+
+    if len(fish_DH1080_last_init) > 1000:
+        fish_DH1080_last_init = dict(
+            (peer, last) for peer, last in fish_DH1080_last_init.items()
+            if now - last < DH1080_INIT_DELAY)
+    fish_DH1080_last_init[targetl] = now
+
+    return True
+
+
+def fish_dh1080_with_ctx(buffer, target, callback, *args):
+    """Call callback with a new DH1080 context as last argument: now if a
+    keypair is ready, otherwise when the keypairs are generated."""
+    global fish_DH1080_keypairs, fish_DH1080_pending
+
+    if fish_DH1080_keypairs:
+        callback(*(args + (DH1080Ctx(fish_DH1080_keypairs.pop(0)),)))
+    elif len(fish_DH1080_pending) < DH1080_MAX_PENDING:
+        fish_DH1080_pending.append((callback, args))
+    else:
+        fish_alert(buffer, "Key exchange with %s ignored: too many key "
+                   "exchanges in progress" % target)
+
+    fish_dh1080_generate_keypairs()
+
+
+def fish_dh1080_generate_keypairs():
+    """Generate missing DH1080 keypairs in a background process."""
+    global fish_DH1080_keypairs, fish_DH1080_pending, fish_DH1080_hook
+
+    count = (DH1080_KEYPAIRS + len(fish_DH1080_pending) -
+             len(fish_DH1080_keypairs))
+    if fish_DH1080_hook or count <= 0:
+        return
+
+    fish_DH1080_hook = weechat.hook_process(
+            "func:fish_dh1080_keypairs_process", 0,
+            "fish_dh1080_keypairs_cb", str(count))
+
+
+def fish_dh1080_keypairs_process(data):
+    """Return DH1080 keypairs (private and public in hex, one per line), in
+    a forked process."""
+    lines = []
+    for i in range(int(data)):
+        ctx = DH1080Ctx()
+        lines.append("%x %x\n" % (ctx.private, ctx.public))
+
+    return "".join(lines)
+
+
+def fish_dh1080_keypairs_cb(data, command, return_code, out, err):
+    global fish_DH1080_keypairs, fish_DH1080_pending, fish_DH1080_hook
+    global fish_DH1080_stdout
+
+    fish_DH1080_stdout += out
+    if return_code == weechat.WEECHAT_HOOK_PROCESS_RUNNING:
+        return weechat.WEECHAT_RC_OK
+
+    fish_DH1080_hook = None
+    keypairs = fish_DH1080_stdout.split("\n")
+    fish_DH1080_stdout = ""
+    generated = 0
+    for keypair in keypairs:
+        try:
+            private, public = [int(x, 16) for x in keypair.split(" ")]
+        except ValueError:
+            continue
+        fish_DH1080_keypairs.append((private, public))
+        generated += 1
+
+    failed = generated < int(data)
+    if failed:
+        weechat.prnt("", "%sfish: error generating DH1080 keypairs%s" % (
+                weechat.prefix("error"), ": " + err if err else ""))
+
+    # exchanges queued while the process was running wait for the next one,
+    # unless generating keypairs in the background doesn't work
+    while fish_DH1080_pending and (fish_DH1080_keypairs or failed):
+        callback, args = fish_DH1080_pending.pop(0)
+        if fish_DH1080_keypairs:
+            ctx = DH1080Ctx(fish_DH1080_keypairs.pop(0))
+        else:
+            ctx = DH1080Ctx()
+        callback(*(args + (ctx,)))
+
+    if not failed:
+        fish_dh1080_generate_keypairs()
+
+    return weechat.WEECHAT_RC_OK
+
+
 def fish_announce_encrypted(buffer, target):
     global fish_encryption_announced, fish_config_option
 
@@ -1207,7 +1341,9 @@ if (__name__ == "__main__" and import_ok and
     weechat.hook_modifier(
             "input_text_for_buffer", "fish_modifier_input_text", "")
     weechat.hook_config("fish.secure.key", "fish_secure_key_cb", "")
+
+    fish_dh1080_generate_keypairs()
 elif (__name__ == "__main__" and len(sys.argv) == 3):
     key = sys.argv[1]
     msg = sys.argv[2]
-    print(blowcrypt_unpack(msg, Blowfish(key), key))
+    print(blowcrypt_unpack(msg, Blowfish(key)))
@@ -27,7 +27,7 @@
 #   * /grep
 #     Search in logs or buffers, see /help grep
 #   * /logs:
-#     Lists logs in ~/.weechat/logs, see /help logs
+#     Lists logs in ~/.weechat/logs and manages the log index, see /help logs
 #
 #   Settings:
 #   * plugins.var.python.grep.clear_buffer:
@@ -45,7 +45,8 @@
 #     Shows summary for each log. Valid values: on, off
 #
 #   * plugins.var.python.grep.max_lines:
-#     Grep will only print the last matched lines that don't surpass the value defined here.
+#     Grep will only print the last matched lines that don't surpass the value defined here. When
+#     grepping several logs in background, the first matched lines are printed instead.
 #
 #   * plugins.var.python.grep.size_limit:
 #     Size limit in KiB, is used for decide whenever grepping should run in background or not. If
@@ -56,19 +57,33 @@
 #   * plugins.var.python.grep.timeout_secs:
 #     Timeout (in seconds) for background grepping.
 #
+#   * plugins.var.python.grep.max_processes:
+#     Number of processes used for background grepping, logs are split among them and each
+#     log is shown as soon as it's done. Empty string (default) uses the number of CPUs.
+#
+#   * plugins.var.python.grep.index:
+#     Keep a trigram index of the logs in the 'grep_index' directory of WeeChat's data dir, so
+#     only the parts of a log that can match are read. The index is updated with what logger
+#     appended on each search, use '/logs index build' for index all logs at once. Valid values:
+#     on, off
+#
 #   * plugins.var.python.grep.default_tail_head:
 #     Config option for define default number of lines returned when using --head or --tail options.
 #     Can be overriden in the command with --number option.
 #
 #
 #   TODO:
-#   * try to figure out why hook_process chokes in long outputs (using a tempfile as a
-#   workaround now)
 #   * possibly add option for defining time intervals
 #
 #
 #   History:
 #
+#   2026-10-18
+#   version 0.9.0: stream logs for --tail and --before-context, split background grep among
+#                  processes (new option 'max_processes') and show each log as soon as it's done,
+#                  optional trigram index of logs (new option 'index', '/logs index build'),
+#                  read buffers with hdata instead of an infolist
+#
 #   2022-11-11, anonymous2ch
 #   version 0.8.6: ignore utf-8 decoding errors
 #
@@ -226,13 +241,19 @@
 ###
 
 from os import path
-import sys, getopt, time, os, re
+import sys, getopt, time, os, re, tempfile, shutil, io, codecs, hashlib, locale
+from collections import deque
 
 try:
     import cPickle as pickle
 except ImportError:
     import pickle
 
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
 try:
     import weechat
     from weechat import WEECHAT_RC_OK, prnt, prnt_date_tags
@@ -242,7 +263,7 @@ except ImportError:
 
 SCRIPT_NAME    = "grep"
 SCRIPT_AUTHOR  = "Elián Hanisch <lambdae2@gmail.com>"
-SCRIPT_VERSION = "0.8.6"
+SCRIPT_VERSION = "0.9.0"
 SCRIPT_LICENSE = "GPL3"
 SCRIPT_DESC    = "Search in buffers and logs"
 SCRIPT_COMMAND = "grep"
@@ -257,6 +278,8 @@ settings = {
     'size_limit'        : '2048',
     'default_tail_head' : '10',
     'timeout_secs'      : '300',
+    'max_processes'     : '',
+    'index'             : 'off',
 }
 
 ### Class definitions ###
@@ -714,7 +737,50 @@ def check_string(s, regexp, hilight='', exact=False):
     elif regexp.search(s):
         return s
 
-def grep_file(file, head, tail, after_context, before_context, count, regexp, hilight, exact, invert):
+def reversed_lines(file_object, encoding, block_size=64 * 1024):
+    """Yields the lines of a binary file from last to first, reading blocks from its end."""
+    file_object.seek(0, os.SEEK_END)
+    position = file_object.tell()
+    rest = b''  # start of the line whose end we already read
+    end = b''   # the last line has no newline
+    def decode(line):
+        if line[-2:] == b'\r\n':
+            line = line[:-2] + b'\n'
+        return line.decode(encoding, 'ignore')
+    while position > 0:
+        size = min(block_size, position)
+        position -= size
+        file_object.seek(position)
+        parts = (file_object.read(size) + rest).split(b'\n')
+        rest = parts[0]
+        if len(parts) > 1:
+            if parts[-1] or end:
+                yield decode(parts[-1] + end)
+            end = b'\n'
+            for i in range(len(parts) - 2, 0, -1):
+                yield decode(parts[i] + end)
+    if rest or end:
+        yield decode(rest + end)
+
+def read_ranges(file_object, encoding, ranges, reverse=False):
+    """Yields the lines in the (start, end) byte ranges of a binary file, from last to first if
+    reverse is True. Ranges must start and end at line boundaries."""
+    if reverse:
+        ranges = reversed(ranges)
+    for start, end in ranges:
+        file_object.seek(start)
+        if end is None:
+            data = file_object.read()
+        else:
+            data = file_object.read(end - start)
+        lines = io.TextIOWrapper(io.BytesIO(data), encoding, errors='ignore').readlines()
+        if reverse:
+            lines.reverse()
+        for line in lines:
+            yield line
+
+def grep_file(file, head, tail, after_context, before_context, count, regexp, hilight, exact, invert,
+        index_dir=''):
     """Return a list of lines that match 'regexp' in 'file', if no regexp returns all lines."""
     if count:
         tail = head = after_context = before_context = False
@@ -726,11 +792,6 @@ def grep_file(file, head, tail, after_context, before_context, count, regexp, hi
         hilight = ''
     #debug(' '.join(map(str, (file, head, tail, after_context, before_context))))
 
-    lines = linesList()
-    # define these locally as it makes the loop run slightly faster
-    append = lines.append
-    count_match = lines.count_match
-    separator = lines.append_separator
     if invert:
         def check(s):
             if check_string(s, regexp, hilight, exact):
@@ -744,76 +805,99 @@ def grep_file(file, head, tail, after_context, before_context, count, regexp, hi
         file_object = open(file, 'r', errors='ignore')
     except IOError:
         # file doesn't exist
-        return lines
-    if tail or before_context:
-        # for these options, I need to seek in the file, but is slower and uses a good deal of
-        # memory if the log is too big, so we do this *only* for these options.
-        file_lines = file_object.readlines()
-
-        if tail:
-            # instead of searching in the whole file and later pick the last few lines, we
-            # reverse the log, search until count reached and reverse it again, that way is a lot
-            # faster
-            file_lines.reverse()
-            # don't invert context switches
-            before_context, after_context = after_context, before_context
+        return linesList()
+    ranges = None
+    if index_dir and regexp and not invert:
+        ranges = get_log_ranges(file, regexp, index_dir, file_object.encoding)
+        if ranges == []:
+            # nothing to find here
+            file_object.close()
+            return linesList()
+        elif after_context or before_context:
+            # context lines can be outside of the ranges, grep the whole log
+            ranges = None
+    if tail:
+        # instead of searching in the whole file and later pick the last few lines, we read the
+        # log backwards, search until count reached and reverse the result, that way is a lot
+        # faster
+        if ranges is None:
+            file_lines = reversed_lines(file_object.buffer, file_object.encoding)
+        else:
+            file_lines = read_ranges(file_object.buffer, file_object.encoding, ranges,
+                                     reverse=True)
+        # don't invert context switches
+        before_context, after_context = after_context, before_context
+    elif ranges is None:
+        file_lines = iter(file_object)
+    else:
+        file_lines = read_ranges(file_object.buffer, file_object.encoding, ranges)
 
-        if before_context:
-            before_context_range = list(range(1, before_context + 1))
-            before_context_range.reverse()
+    lines = grep_lines(file_lines, check, tail or head, after_context, before_context, count)
+    file_object.close()
 
-        limit = tail or head
+    if tail:
+        lines.reverse()
+    return lines
 
-        line_idx = 0
-        while line_idx < len(file_lines):
-            line = file_lines[line_idx]
+def grep_lines(file_lines, check, limit, after_context, before_context, count):
+    """Returns a linesList with the lines from the iterator 'file_lines' that pass 'check' and their
+    context lines, stops after 'limit' matches."""
+    lines = linesList()
+    # define these locally as it makes the loop run slightly faster
+    append = lines.append
+    count_match = lines.count_match
+    separator = lines.append_separator
+    if before_context:
+        # for before context we need to look back at previous lines, instead of reading the whole
+        # log we keep the last few lines read in a ring buffer.
+        previous_lines = deque(maxlen=before_context)
+        before_context_range = list(range(1, before_context + 1))
+        before_context_range.reverse()
+
+        for line in file_lines:
+            previous_line = line
             line = check(line)
             if line:
-                if before_context:
-                    separator()
-                    trimmed = False
-                    for id in before_context_range:
-                        try:
-                            context_line = file_lines[line_idx - id]
-                            if check(context_line):
-                                # match in before context, that means we appended these same lines in a
-                                # previous match, so we delete them merging both paragraphs
-                                if not trimmed:
-                                    del lines[id - before_context - 1:]
-                                    trimmed = True
-                            else:
-                                append(context_line)
-                        except IndexError:
-                            pass
+                separator()
+                trimmed = False
+                for id in before_context_range:
+                    if id > len(previous_lines):
+                        continue
+                    context_line = previous_lines[-id]
+                    if check(context_line):
+                        # match in before context, that means we appended these same lines in a
+                        # previous match, so we delete them merging both paragraphs
+                        if not trimmed:
+                            del lines[id - before_context - 1:]
+                            trimmed = True
+                    else:
+                        append(context_line)
                 append(line)
                 count_match(line)
+                previous_lines.append(previous_line)
                 if after_context:
                     id, offset = 0, 0
                     while id < after_context + offset:
                         id += 1
                         try:
-                            context_line = file_lines[line_idx + id]
+                            context_line = next(file_lines)
+                            previous_lines.append(context_line)
                             _context_line = check(context_line)
                             if _context_line:
                                 offset = id
                                 context_line = _context_line # so match is hilighted with --hilight
                                 count_match()
                             append(context_line)
-                        except IndexError:
+                        except StopIteration:
                             pass
                     separator()
-                    line_idx += id
                 if limit and lines.matches_count >= limit:
                     break
-            line_idx += 1
-
-        if tail:
-            lines.reverse()
+            else:
+                previous_lines.append(previous_line)
     else:
         # do a normal grep
-        limit = head
-
-        for line in file_object:
+        for line in file_lines:
             line = check(line)
             if line:
                 count or append(line)
@@ -823,7 +907,7 @@ def grep_file(file, head, tail, after_context, before_context, count, regexp, hi
                     while id < after_context + offset:
                         id += 1
                         try:
-                            context_line = next(file_object)
+                            context_line = next(file_lines)
                             _context_line = check(context_line)
                             if _context_line:
                                 offset = id
@@ -835,14 +919,27 @@ def grep_file(file, head, tail, after_context, before_context, count, regexp, hi
                     separator()
                 if limit and lines.matches_count >= limit:
                     break
-
-    file_object.close()
     return lines
 
+def buffer_lines(buffer, reverse=False):
+    """Yields the line data pointers of 'buffer', from last to first if reverse is True. Lines are
+    walked with hdata, so they aren't copied like with the 'buffer_lines' infolist."""
+    hdata_line = weechat.hdata_get('line')
+    hdata_move = weechat.hdata_move
+    hdata_pointer = weechat.hdata_pointer
+    own_lines = hdata_pointer(weechat.hdata_get('buffer'), buffer, 'own_lines')
+    if not own_lines:
+        return
+    line = hdata_pointer(weechat.hdata_get('lines'), own_lines,
+                         reverse and 'last_line' or 'first_line')
+    step = reverse and -1 or 1
+    while line:
+        yield hdata_pointer(hdata_line, line, 'data')
+        line = hdata_move(hdata_line, line, step)
+
 def grep_buffer(buffer, head, tail, after_context, before_context, count, regexp, hilight, exact,
         invert):
     """Return a list of lines that match 'regexp' in 'buffer', if no regexp returns all lines."""
-    lines = linesList()
     if count:
         tail = head = after_context = before_context = False
         hilight = ''
@@ -853,47 +950,39 @@ def grep_buffer(buffer, head, tail, after_context, before_context, count, regexp
     # Using /grep in grep's buffer can lead to some funny effects
     # We should take measures if that's the case
     def make_get_line_funcion():
-        """Returns a function for get lines from the infolist, depending if the buffer is grep's or
+        """Returns a function for get lines from line data, depending if the buffer is grep's or
         not."""
         string_remove_color = weechat.string_remove_color
-        infolist_string = weechat.infolist_string
+        hdata_line_data = weechat.hdata_get('line_data')
+        hdata_string = weechat.hdata_string
         grep_buffer = weechat.buffer_search('python', SCRIPT_NAME)
         if grep_buffer and buffer == grep_buffer:
-            def function(infolist):
-                prefix = infolist_string(infolist, 'prefix')
-                message = infolist_string(infolist, 'message')
-                if prefix: # only our messages have prefix, ignore it
+            def function(data):
+                if hdata_string(hdata_line_data, data, 'prefix'):
+                    # only our messages have prefix, ignore it
                     return None
-                return message
+                return hdata_string(hdata_line_data, data, 'message')
         else:
-            infolist_time = weechat.infolist_time
-            def function(infolist):
-                prefix = string_remove_color(infolist_string(infolist, 'prefix'), '')
-                message = string_remove_color(infolist_string(infolist, 'message'), '')
-                date = infolist_time(infolist, 'date')
-                # since WeeChat 2.2, infolist_time returns a long integer
-                # instead of a string
-                if not isinstance(date, str):
-                    date = time.strftime('%F %T', time.localtime(int(date)))
-                return '%s\t%s\t%s' %(date, prefix, message)
+            hdata_time = weechat.hdata_time
+            strftime = time.strftime
+            localtime = time.localtime
+            last_date = [None, '']
+            def remove_color(s):
+                # most messages don't have colors, skip the API call for them
+                if '\x19' in s or '\x1a' in s or '\x1b' in s or '\x1c' in s:
+                    return string_remove_color(s, '')
+                return s
+            def function(data):
+                prefix = remove_color(hdata_string(hdata_line_data, data, 'prefix'))
+                message = remove_color(hdata_string(hdata_line_data, data, 'message'))
+                date = hdata_time(hdata_line_data, data, 'date')
+                if date != last_date[0]:
+                    # consecutive lines often have the same date
+                    last_date[:] = date, strftime('%F %T', localtime(date))
+                return '%s\t%s\t%s' %(last_date[1], prefix, message)
         return function
     get_line = make_get_line_funcion()
 
-    infolist = weechat.infolist_get('buffer_lines', buffer, '')
-    if tail:
-        # like with grep_file() if we need the last few matching lines, we move the cursor to
-        # the end and search backwards
-        infolist_next = weechat.infolist_prev
-        infolist_prev = weechat.infolist_next
-    else:
-        infolist_next = weechat.infolist_next
-        infolist_prev = weechat.infolist_prev
-    limit = head or tail
-
-    # define these locally as it makes the loop run slightly faster
-    append = lines.append
-    count_match = lines.count_match
-    separator = lines.append_separator
     if invert:
         def check(s):
             if check_string(s, regexp, hilight, exact):
@@ -903,58 +992,317 @@ def grep_buffer(buffer, head, tail, after_context, before_context, count, regexp
     else:
         check = lambda s: check_string(s, regexp, hilight, exact)
 
-    if before_context:
-        before_context_range = reversed(range(1, before_context + 1))
-
-    while infolist_next(infolist):
-        line = get_line(infolist)
-        if line is None: continue
-        line = check(line)
-        if line:
-            if before_context:
-                separator()
-                trimmed = False
-                for id in before_context_range:
-                    if not infolist_prev(infolist):
-                        trimmed = True
-                for id in before_context_range:
-                    context_line = get_line(infolist)
-                    if check(context_line):
-                        if not trimmed:
-                            del lines[id - before_context - 1:]
-                            trimmed = True
-                    else:
-                        append(context_line)
-                    infolist_next(infolist)
-            count or append(line)
-            count_match(line)
-            if after_context:
-                id, offset = 0, 0
-                while id < after_context + offset:
-                    id += 1
-                    if infolist_next(infolist):
-                        context_line = get_line(infolist)
-                        _context_line = check(context_line)
-                        if _context_line:
-                            context_line = _context_line
-                            offset = id
-                            count_match()
-                        append(context_line)
-                    else:
-                        # in the main loop infolist_next will start again an cause an infinite loop
-                        # this will avoid it
-                        infolist_next = lambda x: 0
-                separator()
-            if limit and lines.matches_count >= limit:
-                break
-    weechat.infolist_free(infolist)
+    if tail:
+        # like with grep_file() if we need the last few matching lines, we walk the lines
+        # backwards and don't invert context switches
+        before_context, after_context = after_context, before_context
+    # lines are formatted as they're needed, so we stop walking the buffer once limit is reached
+    file_lines = (line for line in map(get_line, buffer_lines(buffer, tail)) if line is not None)
+    lines = grep_lines(file_lines, check, tail or head, after_context, before_context, count)
 
     if tail:
         lines.reverse()
     return lines
 
+### Log index ###
+index_version = 1
+index_block_size = 256 * 1024
+index_head_size = 1024
+# characters that match an ascii letter with re.IGNORECASE, the index stores them as that letter
+index_case_fixes = [('İ', 'i'), ('ı', 'i'), ('K', 'k'), ('ſ', 's')]
+
+def get_index_dir():
+    """Returns the dir where log indexes are kept."""
+    options = {
+        'directory': 'data',
+    }
+    return path.join(weechat.string_eval_path_home('%h', {}, {}, options), 'grep_index')
+
+def normalize_index_bytes(data, encoding):
+    """Folds the case of 'data' the way the index stores it."""
+    if codecs.lookup(encoding).name == 'utf-8':
+        for c, letter in index_case_fixes:
+            c = c.encode(encoding)
+            if c in data:
+                data = data.replace(c, letter.encode(encoding))
+    return data.lower()
+
+def bytes_trigrams(data):
+    """Returns the set of trigrams in the words of 'data', as integers. Words repeat a lot in logs,
+    so we only look at each one once."""
+    data = b' '.join(set(data.split()))
+    return set([(a << 16) | (b << 8) | c for a, b, c in set(zip(data, data[1:], data[2:]))
+                if a != 32 and b != 32 and c != 32])
+
+def block_trigrams(data, encoding):
+    """Returns the set of trigrams of a block of lines of a log."""
+    try:
+        data.decode(encoding)
+    except UnicodeDecodeError:
+        # grep ignores undecodable bytes, so must the index
+        data = data.decode(encoding, 'ignore').encode(encoding)
+    return bytes_trigrams(normalize_index_bytes(data, encoding))
+
+def required_literals(items, ignorecase, literals):
+    """Appends to 'literals' the strings that any match of the parsed regexp 'items' must contain.
+    Returns the string 'items' matches if it's just a literal string, None otherwise."""
+    run = ''
+    pure = True
+    for op, av in items:
+        if op is sre_parse.LITERAL and not (ignorecase and av > 127):
+            run += chr(av)
+        elif op is sre_parse.AT:
+            # zero width, doesn't break the string
+            continue
+        elif op is sre_parse.SUBPATTERN:
+            flags = len(av) == 4 and av[1] or 0
+            s = required_literals(av[-1], ignorecase or flags & re.IGNORECASE, literals)
+            if s is None:
+                literals.append(run)
+                run = ''
+                pure = False
+            else:
+                run += s
+        else:
+            literals.append(run)
+            run = ''
+            pure = False
+            if op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and av[0] >= 1:
+                s = required_literals(av[2], ignorecase, literals)
+                if s:
+                    literals.append(s)
+    if pure:
+        return run
+    literals.append(run)
+
+def pattern_trigrams(regexp, encoding):
+    """Returns the trigrams that every line matched by 'regexp' contains, an empty set if it can't
+    tell."""
+    try:
+        parsed = sre_parse.parse(regexp.pattern, regexp.flags)
+    except Exception:
+        return set()
+    state = getattr(parsed, 'state', None) or parsed.pattern
+    literals = []
+    s = required_literals(parsed, state.flags & re.IGNORECASE, literals)
+    if s:
+        literals.append(s)
+    trigrams = set()
+    for s in literals:
+        if len(s) < 3:
+            continue
+        try:
+            data = s.encode(encoding)
+        except UnicodeError:
+            continue
+        trigrams.update(bytes_trigrams(normalize_index_bytes(data, encoding)))
+    return trigrams
+
+class logIndex(object):
+    """Trigram index of a log. The log is split in blocks of whole lines and for each trigram we
+    keep a bitmask of the blocks that contain it, so only the blocks that contain all the trigrams
+    of a pattern need to be grepped. Since logs only grow, updating the index only indexes what was
+    appended since the last time."""
+    def __init__(self, log, index_dir, encoding):
+        self.log = log
+        self.encoding = encoding
+        self.filename = path.join(index_dir,
+                hashlib.sha1(log.encode('utf-8', 'surrogateescape')).hexdigest())
+        self.clear()
+
+    def clear(self):
+        self.size = self.mtime = self.end = 0
+        self.head = b''   # first bytes of the log, for notice if it was replaced
+        self.blocks = []  # offset of each block
+        self.postings = {}
+
+    def header(self):
+        return {'version': index_version, 'log': self.log, 'encoding': self.encoding,
+                'size': self.size, 'mtime': self.mtime, 'end': self.end, 'head': self.head,
+                'blocks': self.blocks}
+
+    def load(self):
+        """Loads the index from disk, returns False if there isn't a valid one."""
+        try:
+            with open(self.filename, 'rb') as f:
+                header = pickle.load(f)
+                if header.get('version') != index_version or header.get('log') != self.log \
+                        or header.get('encoding') != self.encoding:
+                    return False
+                postings = pickle.load(f)
+        except Exception:
+            return False
+        for key in ('size', 'mtime', 'end', 'head', 'blocks'):
+            setattr(self, key, header[key])
+        self.postings = postings
+        return True
+
+    def save(self):
+        dirname = path.dirname(self.filename)
+        if not path.isdir(dirname):
+            os.makedirs(dirname)
+        fd, filename = tempfile.mkstemp(suffix='.tmp', dir=dirname)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(self.header(), f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(self.postings, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(filename, self.filename)
+
+    def is_stale(self, stat=None):
+        if stat is None:
+            stat = os.stat(self.log)
+        return stat.st_size != self.size or stat.st_mtime != self.mtime
+
+    def update(self):
+        """Indexes what was appended to the log, returns True if the index changed."""
+        try:
+            stat = os.stat(self.log)
+            if not self.is_stale(stat):
+                return False
+            f = open(self.log, 'rb')
+        except (IOError, OSError):
+            changed = bool(self.blocks)
+            self.clear()
+            return changed
+        with f:
+            if stat.st_size < self.end or f.read(len(self.head)) != self.head:
+                # log was replaced or truncated
+                self.clear()
+            if not self.head:
+                f.seek(0)
+                self.head = f.read(index_head_size)
+            position = self.end
+            if self.blocks and self.end - self.blocks[-1] < index_block_size:
+                # last block isn't full, index it again along with the new lines
+                position = self.blocks.pop()
+                mask = ~(1 << len(self.blocks))
+                for trigram, blocks in list(self.postings.items()):
+                    blocks &= mask
+                    if blocks:
+                        self.postings[trigram] = blocks
+                    else:
+                        del self.postings[trigram]
+            f.seek(position)
+            postings = self.postings
+            while True:
+                data = f.read(index_block_size)
+                if data and data[-1:] != b'\n':
+                    # finish the line
+                    data += f.readline()
+                if data[-1:] != b'\n':
+                    # don't index the last line until it's complete
+                    data = data[:data.rfind(b'\n') + 1]
+                if not data:
+                    break
+                bit = 1 << len(self.blocks)
+                self.blocks.append(position)
+                for trigram in block_trigrams(data, self.encoding):
+                    postings[trigram] = postings.get(trigram, 0) | bit
+                position += len(data)
+        self.end = position
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime
+        return True
+
+    def ranges(self, trigrams):
+        """Returns the (start, end) byte ranges of the log that can have lines with all
+        'trigrams'."""
+        blocks = (1 << len(self.blocks)) - 1
+        for trigram in trigrams:
+            blocks &= self.postings.get(trigram, 0)
+            if not blocks:
+                break
+        ends = self.blocks[1:] + [self.end]
+        ranges = [ (start, end) for i, (start, end) in enumerate(zip(self.blocks, ends))
+                   if blocks >> i & 1 ]
+        if self.size > self.end:
+            # last line isn't indexed
+            ranges.append((self.end, None))
+        return ranges
+
+def get_log_ranges(log, regexp, index_dir, encoding):
+    """Returns the byte ranges of 'log' where 'regexp' can match, or None if the index can't
+    help."""
+    trigrams = pattern_trigrams(regexp, encoding)
+    if not trigrams:
+        return None
+    index = logIndex(log, index_dir, encoding)
+    index.load()
+    if index.update():
+        try:
+            index.save()
+        except (IOError, OSError):
+            pass
+    return index.ranges(trigrams)
+
+def index_process(data):
+    """Builds or verifies the index of index_logs, runs in a forked process."""
+    global index_logs, index_dir
+    encoding = locale.getpreferredencoding(False)
+    updated = rebuilt = errors = 0
+    for log in index_logs:
+        try:
+            index = logIndex(log, index_dir, encoding)
+            loaded = index.load()
+            if data == 'verify' and loaded:
+                new_index = logIndex(log, index_dir, encoding)
+                new_index.update()
+                index.update()
+                if index.blocks != new_index.blocks or index.postings != new_index.postings:
+                    new_index.save()
+                    rebuilt += 1
+                    continue
+            if index.update():
+                index.save()
+                updated += 1
+        except Exception as e:
+            sys.stderr.write('%s: %s\n' %(log, e))
+            errors += 1
+    removed = 0
+    if data == 'verify':
+        # remove indexes of logs that don't exist anymore
+        for filename in get_index_files():
+            header = read_index_header(filename)
+            if not header or not path.exists(header['log']):
+                os.remove(filename)
+                removed += 1
+    s = '%s logs, %s indexes updated' %(len(index_logs), updated)
+    if data == 'verify':
+        s += ', %s rebuilt, %s removed' %(rebuilt, removed)
+    if errors:
+        s += ', %s errors' %errors
+    return s
+
+def index_process_cb(data, command, return_code, out, err):
+    global hook_index, index_stdout
+    if isinstance(out, bytes):
+        out = out.decode('utf-8', 'ignore')
+    index_stdout += out
+    if return_code == weechat.WEECHAT_HOOK_PROCESS_ERROR:
+        hook_index = None
+        error('Indexing logs timed out')
+    elif return_code >= 0:
+        hook_index = None
+        if err:
+            error(err if isinstance(err, str) else err.decode('utf-8', 'ignore'))
+        print_line('Index %s done: %s.' %(data, index_stdout), display=True)
+    return WEECHAT_RC_OK
+
+def get_index_files():
+    index_dir = get_index_dir()
+    try:
+        return [ path.join(index_dir, f) for f in os.listdir(index_dir) if '.' not in f ]
+    except OSError:
+        return []
+
+def read_index_header(filename):
+    try:
+        with open(filename, 'rb') as f:
+            return pickle.load(f)
+    except Exception:
+        return None
+
 ### this is our main grep function
-hook_file_grep = None
+hook_file_grep = {}
 def show_matching_lines():
     """
     Greps buffers in search_in_buffers or files in search_in_files and updates grep buffer with the
@@ -990,8 +1338,12 @@ def show_matching_lines():
         regexp = make_regexp(pattern, matchcase)
 
         global grep_options, log_pairs
+        if get_config_boolean('index'):
+            index_dir = get_index_dir()
+        else:
+            index_dir = ''
         grep_options = (head, tail, after_context, before_context,
-                        count, regexp, hilight, exact, invert)
+                        count, regexp, hilight, exact, invert, index_dir)
 
         log_pairs = [(strip_home(log), log) for log in search_in_files]
 
@@ -1001,44 +1353,101 @@ def show_matching_lines():
                 matched_lines[log_name] = grep_file(log, *grep_options)
             buffer_update()
         else:
-            global hook_file_grep, grep_stdout, grep_stderr, pattern_tmpl
-            grep_stdout = grep_stderr = b''
-            hook_file_grep = weechat.hook_process(
-                'func:grep_process',
-                get_config_int('timeout_secs') * 1000,
-                'grep_process_cb',
-                ''
-            )
-            if hook_file_grep:
-                buffer_create("Searching for '%s' in %s worth of data..." % (
-                    pattern_tmpl,
-                    human_readable_size(size)
-                ))
+            grep_background(size)
     else:
         buffer_update()
 
+def get_max_processes(n):
+    """Returns the number of processes used for grepping n logs in background."""
+    processes = get_config_int('max_processes', allow_empty_string=True)
+    if not processes:
+        processes = os.cpu_count() or 1
+    return max(1, min(processes, n))
+
+def split_logs(log_pairs, n):
+    """Splits log_pairs in n shards of about the same size. Each shard is sorted from the smallest
+    log to the biggest one, so the first results come up quickly."""
+    shards = [[] for i in range(n)]
+    sizes = [0] * n
+    for size, log_pair in sorted(((get_size(log), (log_name, log)) for log_name, log in log_pairs),
+                                 reverse=True):
+        i = sizes.index(min(sizes))
+        shards[i].append((size, log_pair))
+        sizes[i] += size
+    for shard in shards:
+        shard.reverse()
+    return [shard for shard in shards if shard]
+
+def grep_background(size):
+    """Greps log_pairs in background, split among several processes. Results are printed in the
+    grep buffer as each log is done."""
+    global hook_file_grep, grep_shards, grep_tmpdir, grep_stdout, grep_stderr
+    global grep_progress, grep_lines_left, grep_formatters
+    global pattern_tmpl, invert, log_pairs
+    grep_shards = split_logs(log_pairs, get_max_processes(len(log_pairs)))
+    grep_tmpdir = tempfile.mkdtemp(prefix='weechat_grep_')
+    grep_stdout = {}
+    grep_stderr = {}
+    grep_progress = {'logs': 0, 'size': 0, 'total_logs': len(log_pairs), 'total_size': size}
+    grep_lines_left = get_config_int('max_lines')
+    grep_formatters = make_formatters(shown='first')
+    for i in range(len(grep_shards)):
+        data = str(i)
+        hook = weechat.hook_process(
+            'func:grep_process',
+            get_config_int('timeout_secs') * 1000,
+            'grep_process_cb',
+            data
+        )
+        if hook:
+            grep_stdout[data] = grep_stderr[data] = b''
+            hook_file_grep[data] = hook
 
-def grep_process(*args):
-    result = {}
-    try:
-        global grep_options, log_pairs
-        for log_name, log in log_pairs:
-            result[log_name] = grep_file(log, *grep_options)
-    except Exception as e:
-        result = e
-
-    return pickle.dumps(result, 0)
+    if hook_file_grep:
+        buffer = buffer_create()
+        if get_config_boolean('clear_buffer'):
+            weechat.buffer_clear(buffer)
+        if len(log_pairs) == 1:
+            logs = log_pairs[0][0]
+        else:
+            logs = '%s logs' %len(log_pairs)
+        print_search_header(buffer, logs)
+        buffer_set_progress(buffer)
+    else:
+        grep_cleanup()
+
+def grep_process(data):
+    """Greps the logs of shard 'data', runs in a forked process. Each log's result is pickled into
+    its own file in grep_tmpdir and the file's path is written to stdout as soon as it's done, this
+    keeps binary data out of the hook_process pipe."""
+    global grep_options, grep_shards, grep_tmpdir
+    for size, (log_name, log) in grep_shards[int(data)]:
+        try:
+            result = (log_name, size, grep_file(log, *grep_options))
+        except Exception as e:
+            result = e
+        fd, filename = tempfile.mkstemp(dir=grep_tmpdir)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(result, f, pickle.HIGHEST_PROTOCOL)
+        os.write(1, (filename + '\n').encode())
+        if isinstance(result, Exception):
+            break
+    return ''
 
 def grep_process_cb(data, command, return_code, out, err):
-    global grep_stdout, grep_stderr, matched_lines, hook_file_grep
+    global grep_stdout, grep_stderr, matched_lines, hook_file_grep, grep_progress
+
+    if data not in hook_file_grep:
+        # search was stopped
+        return WEECHAT_RC_OK
 
     if isinstance(out, str):
         out = out.encode()
-    grep_stdout += out
+    grep_stdout[data] += out
 
     if isinstance(err, str):
         err = err.encode()
-    grep_stderr += err
+    grep_stderr[data] += err
 
     def set_buffer_error(message):
         error(message)
@@ -1047,56 +1456,90 @@ def grep_process_cb(data, command, return_code, out, err):
         title = title + ' %serror' % color_title
         weechat.buffer_set(grep_buffer, 'title', title)
 
+    buffer = buffer_create()
+    filenames = grep_stdout[data].split(b'\n')
+    grep_stdout[data] = filenames.pop()
+    for filename in filenames:
+        try:
+            with open(filename, 'rb') as f:
+                result = pickle.load(f)
+            os.remove(filename)
+            if isinstance(result, Exception):
+                raise result
+        except Exception as e:
+            set_buffer_error(repr(e))
+            continue
+        log_name, size, lines = result
+        matched_lines[log_name] = lines
+        grep_progress['logs'] += 1
+        grep_progress['size'] += size
+        buffer_print_log(buffer, log_name, lines)
+
     if return_code == weechat.WEECHAT_HOOK_PROCESS_ERROR:
         set_buffer_error("Background grep timed out")
-        hook_file_grep = None
-        return WEECHAT_RC_OK
+        grep_process_done(data)
 
     elif return_code >= 0:
-        hook_file_grep = None
-        if grep_stderr:
-            set_buffer_error(grep_stderr)
-            return WEECHAT_RC_OK
+        if grep_stderr[data]:
+            set_buffer_error(grep_stderr[data])
+        grep_process_done(data)
 
-        try:
-            data = pickle.loads(grep_stdout)
-            if isinstance(data, Exception):
-                raise data
-            matched_lines.update(data)
-        except Exception as e:
-            set_buffer_error(repr(e))
-            return WEECHAT_RC_OK
-        else:
-            buffer_update()
+    elif filenames:
+        buffer_set_progress(buffer)
 
     return WEECHAT_RC_OK
 
+def grep_process_done(data):
+    """Removes background process 'data', when it's the last one the search is over."""
+    global hook_file_grep, matched_lines, time_start
+    del hook_file_grep[data]
+    if hook_file_grep:
+        buffer_set_progress(buffer_create())
+        return
+    grep_cleanup()
+    time_grep = now()
+    buffer = buffer_create()
+    if not matched_lines.get_matches_count():
+        print_line('No matches found.', buffer)
+    stripped_lines = sum([L.stripped_lines for L in matched_lines.values()])
+    if not count and stripped_lines:
+        note = ' (first %s lines shown)' %len(matched_lines)
+    else:
+        note = ''
+    buffer_set_title(buffer, time_grep, note)
+
+    if get_config_boolean('go_to_buffer'):
+        weechat.buffer_set(buffer, 'display', '1')
+
+    # free matched_lines so it can be removed from memory
+    matched_lines = linesDict()
+
+def grep_cleanup():
+    """Removes the temporal files of background grepping."""
+    global grep_tmpdir
+    if grep_tmpdir:
+        shutil.rmtree(grep_tmpdir, ignore_errors=True)
+        grep_tmpdir = None
+grep_tmpdir = None
+
 def get_grep_file_status():
-    global search_in_files, matched_lines, time_start
+    global search_in_files, matched_lines, time_start, grep_progress
     elapsed = now() - time_start
     if len(search_in_files) == 1:
         log = '%s (%s)' %(strip_home(search_in_files[0]),
                 human_readable_size(get_size(search_in_files[0])))
     else:
-        size = sum(map(get_size, search_in_files))
-        log = '%s log files (%s)' %(len(search_in_files), human_readable_size(size))
+        log = '%s of %s log files (%s of %s)' %(grep_progress['logs'], grep_progress['total_logs'],
+                human_readable_size(grep_progress['size']),
+                human_readable_size(grep_progress['total_size']))
     return 'Searching in %s, running for %.4f seconds. Interrupt it with "/grep stop" or "stop"' \
         ' in grep buffer.' %(log, elapsed)
 
 ### Grep buffer ###
-def buffer_update():
-    """Updates our buffer with new lines."""
-    global pattern_tmpl, matched_lines, pattern, count, hilight, invert, exact
-    time_grep = now()
-
-    buffer = buffer_create()
-    if get_config_boolean('clear_buffer'):
-        weechat.buffer_clear(buffer)
-    matched_lines.strip_separator() # remove first and last separators of each list
-    len_total_lines = len(matched_lines)
-    max_lines = get_config_int('max_lines')
-    if not count and len_total_lines > max_lines:
-        weechat.buffer_clear(buffer)
+def make_formatters(shown='last'):
+    """Returns the functions used for formatting log summaries and matched lines, 'shown' tells
+    which lines are kept when there are too many."""
+    global pattern_tmpl, count, hilight, invert
 
     def _make_summary(log, lines, note):
         return '%s matches "%s%s%s"%s in %s%s%s%s' \
@@ -1110,14 +1553,13 @@ def buffer_update():
         def make_summary(log, lines):
             if lines.stripped_lines:
                 if lines:
-                    note = ' (last %s lines shown)' %len(lines)
+                    note = ' (%s %s lines shown)' %(shown, len(lines))
                 else:
                     note = ' (not shown)'
             else:
                 note = ''
             return _make_summary(log, lines, note)
 
-    global weechat_format
     if hilight:
         # we don't want colors if there's match highlighting
         format_line = lambda s : '%s %s %s' %split_line(s)
@@ -1138,10 +1580,107 @@ def buffer_update():
                 #no formatting
                 return msg
 
+    return make_summary, format_line
+
+def print_search_header(buffer, logs):
+    global pattern_tmpl, invert
     prnt(buffer, '\n')
     print_line('Search for "%s%s%s"%s in %s%s%s.' %(color_summary, pattern_tmpl, color_info,
-        invert and ' (inverted)' or '', color_summary, matched_lines, color_reset),
+        invert and ' (inverted)' or '', color_summary, logs, color_reset),
             buffer)
+
+def print_log_lines(buffer, log, lines, make_summary, format_line):
+    """Prints the matched lines of a log followed by its summary."""
+    global count, exact, weechat_format
+    if lines.matches_count:
+        # matched lines
+        if not count:
+            # print lines
+            weechat_format = True
+            if exact:
+                lines.onlyUniq()
+            for line in lines:
+                #debug(repr(line))
+                if line == linesList._sep:
+                    # separator
+                    prnt(buffer, context_sep)
+                else:
+                    if '\x00' in line:
+                        # log was corrupted
+                        error("Found garbage in log '%s', maybe it's corrupted" %log)
+                        line = line.replace('\x00', '')
+                    prnt_date_tags(buffer, 0, 'no_highlight', format_line(line))
+
+        # summary
+        if count or get_config_boolean('show_summary'):
+            summary = make_summary(log, lines)
+            print_line(summary, buffer)
+
+    # separator
+    if not count and lines:
+        prnt(buffer, '\n')
+
+def buffer_print_log(buffer, log, lines):
+    """Prints the result of a log grepped in background, only the lines left before reaching
+    'max_lines'."""
+    global count, grep_lines_left, grep_formatters
+    lines.strip_separator()
+    if not count:
+        l = len(lines)
+        if l > grep_lines_left:
+            lines.stripped_lines = l - max(grep_lines_left, 0)
+            del lines[max(grep_lines_left, 0):]
+            lines.strip_separator()
+        grep_lines_left -= l
+    print_log_lines(buffer, log, lines, *grep_formatters)
+
+def buffer_set_progress(buffer):
+    """Sets buffer's title with the progress of background grepping."""
+    global pattern_tmpl, grep_progress, matched_lines, time_start
+    elapsed = now() - time_start
+    done, total = grep_progress['size'], grep_progress['total_size']
+    if done:
+        eta = '%.0f seconds' %(elapsed * max(total - done, 0) / done)
+    else:
+        eta = 'unknown'
+    title = "Searching for '%s%s%s' | %s/%s logs, %s of %s | %s matches | %.1f seconds, ETA %s" \
+            %(color_title, pattern_tmpl, color_reset, grep_progress['logs'],
+              grep_progress['total_logs'], human_readable_size(done), human_readable_size(total),
+              matched_lines.get_matches_count(), elapsed, eta)
+    weechat.buffer_set(buffer, 'title', title)
+
+def buffer_set_title(buffer, time_grep, note):
+    """Sets buffer's title with the search stats."""
+    global pattern_tmpl, matched_lines, invert, time_start
+    time_end = now()
+    # total time
+    time_total = time_end - time_start
+    # percent of the total time used for grepping
+    time_grep_pct = (time_grep - time_start)/time_total*100
+    #debug('time: %.4f seconds (%.2f%%)' %(time_total, time_grep_pct))
+    title = "'q': close buffer | Search in %s%s%s %s matches%s | pattern \"%s%s%s\"%s %s | %.4f seconds (%.2f%%)" \
+            %(color_title, matched_lines, color_reset, matched_lines.get_matches_count(), note,
+              color_title, pattern_tmpl, color_reset, invert and ' (inverted)' or '', format_options(),
+              time_total, time_grep_pct)
+    weechat.buffer_set(buffer, 'title', title)
+
+def buffer_update():
+    """Updates our buffer with new lines."""
+    global matched_lines, count
+    time_grep = now()
+
+    buffer = buffer_create()
+    if get_config_boolean('clear_buffer'):
+        weechat.buffer_clear(buffer)
+    matched_lines.strip_separator() # remove first and last separators of each list
+    len_total_lines = len(matched_lines)
+    max_lines = get_config_int('max_lines')
+    if not count and len_total_lines > max_lines:
+        weechat.buffer_clear(buffer)
+
+    make_summary, format_line = make_formatters()
+
+    print_search_header(buffer, matched_lines)
     # print last <max_lines> lines
     if matched_lines.get_matches_count():
         if count:
@@ -1152,53 +1691,16 @@ def buffer_update():
 
         matched_lines.get_last_lines(max_lines)
         for log, lines in matched_lines_items:
-            if lines.matches_count:
-                # matched lines
-                if not count:
-                    # print lines
-                    weechat_format = True
-                    if exact:
-                        lines.onlyUniq()
-                    for line in lines:
-                        #debug(repr(line))
-                        if line == linesList._sep:
-                            # separator
-                            prnt(buffer, context_sep)
-                        else:
-                            if '\x00' in line:
-                                # log was corrupted
-                                error("Found garbage in log '%s', maybe it's corrupted" %log)
-                                line = line.replace('\x00', '')
-                            prnt_date_tags(buffer, 0, 'no_highlight', format_line(line))
-
-                # summary
-                if count or get_config_boolean('show_summary'):
-                    summary = make_summary(log, lines)
-                    print_line(summary, buffer)
-
-            # separator
-            if not count and lines:
-                prnt(buffer, '\n')
+            print_log_lines(buffer, log, lines, make_summary, format_line)
     else:
         print_line('No matches found.', buffer)
 
     # set title
-    global time_start
-    time_end = now()
-    # total time
-    time_total = time_end - time_start
-    # percent of the total time used for grepping
-    time_grep_pct = (time_grep - time_start)/time_total*100
-    #debug('time: %.4f seconds (%.2f%%)' %(time_total, time_grep_pct))
     if not count and len_total_lines > max_lines:
         note = ' (last %s lines shown)' %len(matched_lines)
     else:
         note = ''
-    title = "'q': close buffer | Search in %s%s%s %s matches%s | pattern \"%s%s%s\"%s %s | %.4f seconds (%.2f%%)" \
-            %(color_title, matched_lines, color_reset, matched_lines.get_matches_count(), note,
-              color_title, pattern_tmpl, color_reset, invert and ' (inverted)' or '', format_options(),
-              time_total, time_grep_pct)
-    weechat.buffer_set(buffer, 'title', title)
+    buffer_set_title(buffer, time_grep, note)
 
     if get_config_boolean('go_to_buffer'):
         weechat.buffer_set(buffer, 'display', '1')
@@ -1446,8 +1948,10 @@ def cmd_grep_stop(buffer, args):
     global hook_file_grep, pattern, matched_lines
     if hook_file_grep:
         if args == 'stop':
-            weechat.unhook(hook_file_grep)
-            hook_file_grep = None
+            for hook in hook_file_grep.values():
+                weechat.unhook(hook)
+            hook_file_grep = {}
+            grep_cleanup()
 
             s = 'Search for \'%s\' stopped.' % pattern
             say(s, buffer)
@@ -1537,6 +2041,10 @@ def cmd_logs(data, buffer, args):
     sort_by_size = False
     filter = []
 
+    if args.split()[:1] == ['index']:
+        cmd_logs_index(args.split()[1:])
+        return WEECHAT_RC_OK
+
     try:
         opts, args = getopt.gnu_getopt(args.split(), 's', ['size'])
         if args:
@@ -1580,6 +2088,61 @@ def cmd_logs(data, buffer, args):
         print_line(msg, buffer)
     return WEECHAT_RC_OK
 
+hook_index = None
+def cmd_logs_index(args):
+    """Shows index stats, or builds/verifies the index of logs in background."""
+    global home_dir, hook_index, index_logs, index_dir, index_stdout
+    action = ''
+    if args and args[0] in ('build', 'verify'):
+        action = args.pop(0)
+    file_list = dir_list(home_dir, args, filter_excludes=not args)
+
+    if action:
+        if hook_index:
+            error('Logs are already being indexed.')
+            return
+        index_logs = file_list
+        index_dir = get_index_dir()
+        index_stdout = ''
+        hook_index = weechat.hook_process('func:index_process', 0, 'index_process_cb', action)
+        if hook_index:
+            print_line('Indexing %s logs in background...' %len(file_list), display=True)
+        return
+
+    headers = {}
+    index_size = 0
+    missing = 0
+    for filename in get_index_files():
+        header = read_index_header(filename)
+        if header:
+            headers[header['log']] = header
+            index_size += get_size(filename)
+            if not path.exists(header['log']):
+                missing += 1
+    indexed = stale = 0
+    size = indexed_size = 0
+    for log in file_list:
+        log_size = get_size(log)
+        size += log_size
+        if log in headers:
+            indexed += 1
+            indexed_size += log_size
+            try:
+                stat = os.stat(log)
+            except OSError:
+                continue
+            header = headers[log]
+            if stat.st_size != header['size'] or stat.st_mtime != header['mtime']:
+                stale += 1
+
+    buffer = buffer_create()
+    print_line('Index is %s, stored in %s' %(weechat.config_get_plugin('index'), get_index_dir()),
+            buffer, display=True)
+    print_line('%s of %s logs indexed (%s of %s), %s need an update. Index size: %s%s.' %(
+        indexed, len(file_list), human_readable_size(indexed_size), human_readable_size(size),
+        stale, human_readable_size(index_size),
+        missing and ', %s indexes of removed logs' %missing or ''), buffer)
+
 
 ### Completion ###
 def completion_log_files(data, completion_item, buffer, completion):
@@ -1718,9 +2281,15 @@ Examples:
             "||stop"
             "||%(grep_arguments)|%*",
             'cmd_grep' ,'')
-    weechat.hook_command('logs', cmd_logs.__doc__, "[-s|--size] [<filter>]",
+    weechat.hook_command('logs', cmd_logs.__doc__, "[-s|--size] [<filter>]"
+            " || index [build|verify] [<filter>]",
             "-s --size: Sort logs by size.\n"
-            " <filter>: Only show logs that match <filter>. Use '*' and '?' as wildcards.", '--size', 'cmd_logs', '')
+            " <filter>: Only show logs that match <filter>. Use '*' and '?' as wildcards.\n"
+            "    index: Show stats of the log index (see option plugins.var.python.grep.index).\n"
+            "    build: Index logs, or update their index, in background.\n"
+            "   verify: Index logs again from scratch, fix indexes that don't match and remove\n"
+            "           indexes of logs that don't exist anymore.",
+            '--size||index build|verify', 'cmd_logs', '')
 
     weechat.hook_completion('grep_log_files', "list of log files",
             'completion_log_files', '')
@@ -5,12 +5,12 @@
 
 from __future__ import print_function, unicode_literals
 
-from collections import OrderedDict, namedtuple
+from collections import OrderedDict, deque, namedtuple
 from datetime import date, datetime, timedelta
 from functools import partial, wraps
-from io import StringIO
 from itertools import chain, count, islice
 
+import bisect
 import copy
 import errno
 import textwrap
@@ -76,7 +76,7 @@ except ImportError:
 
 SCRIPT_NAME = "slack"
 SCRIPT_AUTHOR = "Trygve Aaberge <trygveaa@gmail.com>"
-SCRIPT_VERSION = "2.11.0"
+SCRIPT_VERSION = "2.12.0"
 SCRIPT_LICENSE = "MIT"
 SCRIPT_DESC = "Extends WeeChat for typing notification/search/etc on slack.com"
 REPO_URL = "https://github.com/wee-slack/wee-slack"
@@ -85,6 +85,8 @@ TYPING_DURATION = 6
 
 RECORD_DIR = "/tmp/weeslack-debug"
 
+TEAM_CACHE_VERSION = 1
+
 SLACK_API_TRANSLATOR = {
     "channel": {
         "history": "conversations.history",
@@ -499,6 +501,50 @@ def replace_emoji_with_string(text):
 ###### New central Event router
 
 
+class HTTPResponse(object):
+    """
+    Accumulates an HTTP response (including headers) which WeeChat delivers
+    in fragments. The headers are parsed once, as soon as they are complete,
+    and the body fragments are only joined when the body is requested.
+    """
+
+    def __init__(self):
+        self.header_data = ""
+        self.status = None
+        self.headers = {}
+        self.body_parts = []
+
+    def write(self, data):
+        if self.status is not None:
+            self.body_parts.append(data)
+        else:
+            self.header_data += data
+            self.parse_headers()
+
+    def parse_headers(self, complete=False):
+        while self.status is None and "\r\n\r\n" in self.header_data:
+            header_part, rest = self.header_data.split("\r\n\r\n", 1)
+            # Interim responses (e.g. 100 Continue, or a proxy's response to
+            # CONNECT) are followed by the headers of the actual response
+            if rest.startswith("HTTP/"):
+                self.header_data = rest
+                continue
+            if not complete and "HTTP/".startswith(rest):
+                return
+
+            header_lines = header_part.split("\r\n")
+            self.status = header_lines[0].split(" ")[1]
+            for header in header_lines[1:]:
+                name, value = header.split(":", 1)
+                self.headers[name.lower()] = value.strip()
+            self.header_data = ""
+            self.body_parts.append(rest)
+
+    def body(self):
+        self.parse_headers(complete=True)
+        return "".join(self.body_parts)
+
+
 class EventRouter(object):
     def __init__(self):
         """
@@ -510,9 +556,10 @@ class EventRouter(object):
         It has a recorder that, when enabled, logs most events
         to the location specified in RECORD_DIR.
         """
-        self.queue = []
-        self.slow_queue = []
+        self.queue = deque()
+        self.slow_queue = deque()
         self.slow_queue_timer = 0
+        self.queue_stats = EventQueueStats()
         self.teams = {}
         self.subteams = {}
         self.context = {}
@@ -567,6 +614,70 @@ class EventRouter(object):
         f.write("{}".format(json.dumps(message_json)))
         f.close()
 
+    def replay(self, directory, team):
+        """
+        Replays the websocket events and HTTP replies recorded in directory
+        by record_event as events for team, and returns an EventReplayStats
+        with the time spent in each event handler. This should be called on
+        an EventRouter of its own, with a team created by create_replay_team,
+        as the events are processed right away and the requests to Slack
+        made while processing them are dropped.
+        """
+        files = []
+        for root, _, names in os.walk(directory):
+            for name in names:
+                try:
+                    recorded_at = float(name.split("-", 1)[0])
+                except ValueError:
+                    continue
+                if name.endswith(".json"):
+                    files.append((recorded_at, os.path.join(root, name)))
+        files.sort()
+
+        stats = EventReplayStats()
+        stats.start()
+        try:
+            for _, path in files:
+                with open(path, "r") as f:
+                    message_json = json.load(f)
+                if "wee_slack_process_method" in message_json:
+                    request = SlackRequest.from_record(
+                        team, message_json.pop("wee_slack_request", None)
+                    )
+                    # Replies recorded without their request, or for a request
+                    # with a callback that isn't a plain function, can't be
+                    # processed
+                    if request is None:
+                        stats.skipped += 1
+                        continue
+                    message_json["wee_slack_request_metadata"] = request
+                else:
+                    message_json["wee_slack_metadata_team"] = team
+                self.receive(message_json)
+                while len(self.queue) > 0:
+                    _, j = self.queue.popleft()
+                    if isinstance(j, SlackRequest):
+                        stats.dropped_requests += 1
+                        continue
+                    function_name = self.event_function_name(j)
+                    start = time.time()
+                    try:
+                        self.handle_event(j)
+                    except Exception:
+                        stats.add_error(function_name)
+                        dbg(
+                            "replaying {} failed:\n{}".format(
+                                function_name, format_exc_tb()
+                            ),
+                            level=5,
+                        )
+                    stats.add(function_name, time.time() - start)
+        finally:
+            stats.stop()
+            stats.dropped_requests += len(self.slow_queue)
+            self.slow_queue.clear()
+        return stats
+
     def store_context(self, data):
         """
         A place to store data and vars needed by callback returns. We need this because
@@ -669,20 +780,14 @@ class EventRouter(object):
             self.receive(message_json)
 
     def http_check_ratelimited(self, request_metadata, response):
-        parts = response.split("\r\n\r\nHTTP/")
-        last_header_part, body = parts[-1].split("\r\n\r\n", 1)
-        header_lines = last_header_part.split("\r\n")
-        http_status = header_lines[0].split(" ")[1]
-
-        if http_status == "429":
-            for header in header_lines[1:]:
-                name, value = header.split(":", 1)
-                if name.lower() == "retry-after":
-                    retry_after = int(value.strip())
-                    request_metadata.retry_time = time.time() + retry_after
-                    return "", "ratelimited"
+        response.parse_headers(complete=True)
+        if response.status == "429":
+            retry_after = response.headers.get("retry-after")
+            if retry_after is not None:
+                request_metadata.retry_time = time.time() + int(retry_after)
+                return "", "ratelimited"
 
-        return body, ""
+        return response.body(), ""
 
     def retry_request(self, request_metadata, data, return_code, err):
         self.reply_buffer.pop(request_metadata.response_id, None)
@@ -743,10 +848,10 @@ class EventRouter(object):
         if return_code == 0:
             if len(out) > 0:
                 if request_metadata.response_id not in self.reply_buffer:
-                    self.reply_buffer[request_metadata.response_id] = StringIO()
-                self.reply_buffer[request_metadata.response_id].write(out)
+                    self.reply_buffer[request_metadata.response_id] = HTTPResponse()
+                response = self.reply_buffer[request_metadata.response_id]
+                response.write(out)
 
-                response = self.reply_buffer[request_metadata.response_id].getvalue()
                 body, error = self.http_check_ratelimited(request_metadata, response)
                 if error:
                     self.retry_request(request_metadata, data, return_code, error)
@@ -759,7 +864,7 @@ class EventRouter(object):
                         ] = request_metadata.request_normalized
                         if self.recording:
                             self.record_event(
-                                j,
+                                dict(j, wee_slack_request=request_metadata.record()),
                                 request_metadata.team,
                                 "wee_slack_process_method",
                                 "http",
@@ -777,7 +882,7 @@ class EventRouter(object):
                 self.receive(request_metadata)
         elif return_code == -1:
             if request_metadata.response_id not in self.reply_buffer:
-                self.reply_buffer[request_metadata.response_id] = StringIO()
+                self.reply_buffer[request_metadata.response_id] = HTTPResponse()
             self.reply_buffer[request_metadata.response_id].write(out)
         else:
             self.retry_request(request_metadata, data, return_code, err)
@@ -793,14 +898,16 @@ class EventRouter(object):
         if slow:
             self.slow_queue.append(dataobj)
         else:
-            self.queue.append(dataobj)
+            self.queue.append((time.time(), dataobj))
+            self.queue_stats.update_depth(len(self.queue))
 
     def handle_next(self):
         """
         complete
         Main handler of the EventRouter. This is called repeatedly
-        via callback to drain events from the queue. It also attaches
-        useful metadata and context to events as they are processed.
+        via callback to drain events from the queue. As many events
+        as fit in the event_drain_budget setting are processed on
+        each call, and at least one if the queue isn't empty.
         """
         wanted_interval = 100
         if len(self.slow_queue) > 0 or len(self.queue) > 0:
@@ -818,76 +925,214 @@ class EventRouter(object):
 
         if len(self.slow_queue) > 0 and ((self.slow_queue_timer + 1) < time.time()):
             dbg("from slow queue", 0)
-            self.queue.append(self.slow_queue.pop())
+            self.queue.append((time.time(), self.slow_queue.pop()))
             self.slow_queue_timer = time.time()
-        if len(self.queue) > 0:
-            j = self.queue.pop(0)
-            # Reply is a special case of a json reply from websocket.
-            if isinstance(j, SlackRequest):
-                if j.should_try():
-                    if j.retry_ready():
-                        local_process_async_slack_api_request(j, self)
-                    else:
-                        self.slow_queue.append(j)
+
+        start = time.time()
+        deadline = start + config.event_drain_budget / 1000.0
+        handled = 0
+        while len(self.queue) > 0:
+            queued_at, j = self.queue.popleft()
+            self.queue_stats.add_latency(time.time() - queued_at)
+            handled += 1
+            self.handle_event(j)
+            if time.time() >= deadline:
+                break
+        if handled:
+            self.queue_stats.add_drain(handled, time.time() - start, len(self.queue))
+
+    def event_function_name(self, j):
+        """
+        Returns the name of the function that should process the event,
+        without the process_/handle_ prefix.
+        """
+        # Reply is a special case of a json reply from websocket.
+        if "reply_to" in j:
+            dbg("SET FROM REPLY")
+            return "reply"
+        elif "type" in j:
+            dbg("SET FROM type")
+            return j["type"]
+        elif "wee_slack_process_method" in j:
+            dbg("SET FROM META")
+            return j["wee_slack_process_method"]
+        else:
+            dbg("SET FROM NADA")
+            return "unknown"
+
+    def handle_event(self, j):
+        """
+        Dispatches a single event taken from the queue. It attaches
+        useful metadata and context to the event before it is
+        processed.
+        """
+        if isinstance(j, SlackRequest):
+            if j.should_try():
+                if j.retry_ready():
+                    local_process_async_slack_api_request(j, self)
                 else:
-                    dbg("Max retries for Slackrequest")
+                    self.slow_queue.append(j)
+            else:
+                dbg("Max retries for Slackrequest")
 
+        else:
+            function_name = self.event_function_name(j)
+
+            request = j.get("wee_slack_request_metadata")
+            if request:
+                team = request.team
+                channel = request.channel
+                metadata = request.metadata
+                callback = request.callback
             else:
-                if "reply_to" in j:
-                    dbg("SET FROM REPLY")
-                    function_name = "reply"
-                elif "type" in j:
-                    dbg("SET FROM type")
-                    function_name = j["type"]
-                elif "wee_slack_process_method" in j:
-                    dbg("SET FROM META")
-                    function_name = j["wee_slack_process_method"]
-                else:
-                    dbg("SET FROM NADA")
-                    function_name = "unknown"
-
-                request = j.get("wee_slack_request_metadata")
-                if request:
-                    team = request.team
-                    channel = request.channel
-                    metadata = request.metadata
-                    callback = request.callback
-                else:
-                    team = j.get("wee_slack_metadata_team")
-                    channel = None
-                    metadata = {}
-                    callback = None
-
-                if team:
-                    if "channel" in j:
-                        channel_id = (
-                            j["channel"]["id"]
-                            if isinstance(j["channel"], dict)
-                            else j["channel"]
-                        )
-                        channel = team.channels.get(channel_id, channel)
-                    if "user" in j:
-                        user_id = (
-                            j["user"]["id"]
-                            if isinstance(j["user"], dict)
-                            else j["user"]
-                        )
-                        metadata["user"] = team.users.get(user_id)
+                team = j.get("wee_slack_metadata_team")
+                channel = None
+                metadata = {}
+                callback = None
+
+            if team:
+                if "channel" in j:
+                    channel_id = (
+                        j["channel"]["id"]
+                        if isinstance(j["channel"], dict)
+                        else j["channel"]
+                    )
+                    channel = team.channels.get(channel_id, channel)
+                if "user" in j:
+                    user_id = (
+                        j["user"]["id"] if isinstance(j["user"], dict) else j["user"]
+                    )
+                    metadata["user"] = team.users.get(user_id)
+
+            dbg("running {}".format(function_name))
+            if callable(callback):
+                callback(j, self, team, channel, metadata)
+            elif function_name.startswith("local_") and function_name in self.local_proc:
+                self.local_proc[function_name](j, self, team, channel, metadata)
+            elif function_name in self.proc:
+                self.proc[function_name](j, self, team, channel, metadata)
+            elif function_name in self.handlers:
+                self.handlers[function_name](j, self, team, channel, metadata)
+            else:
+                dbg("Callback not implemented for event: {}".format(function_name))
 
-                dbg("running {}".format(function_name))
-                if callable(callback):
-                    callback(j, self, team, channel, metadata)
-                elif (
-                    function_name.startswith("local_")
-                    and function_name in self.local_proc
-                ):
-                    self.local_proc[function_name](j, self, team, channel, metadata)
-                elif function_name in self.proc:
-                    self.proc[function_name](j, self, team, channel, metadata)
-                elif function_name in self.handlers:
-                    self.handlers[function_name](j, self, team, channel, metadata)
-                else:
-                    dbg("Callback not implemented for event: {}".format(function_name))
+
+class EventReplayStats(object):
+    """
+    Timings of the events replayed by EventRouter.replay.
+    """
+
+    # Upper bounds (in seconds) of the buckets of the latency histograms
+    buckets = [0.001, 0.01, 0.1]
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.skipped = 0
+        self.dropped_requests = 0
+        self.duration = 0.0
+        self.peak_memory = None
+        self.started_at = None
+        self.tracing_memory = False
+
+    def start(self):
+        try:
+            import tracemalloc
+
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.tracing_memory = True
+        except ImportError:
+            pass
+        self.started_at = time.time()
+
+    def stop(self):
+        self.duration = time.time() - self.started_at
+        if self.tracing_memory:
+            import tracemalloc
+
+            self.peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    def add(self, function_name, latency):
+        self.latencies.setdefault(function_name, []).append(latency)
+
+    def add_error(self, function_name):
+        self.errors[function_name] = self.errors.get(function_name, 0) + 1
+
+    def handled(self):
+        return sum(len(latencies) for latencies in self.latencies.values())
+
+    def events_per_second(self):
+        return self.handled() / self.duration if self.duration else 0.0
+
+    def histogram(self, function_name):
+        counts = [0] * (len(self.buckets) + 1)
+        for latency in self.latencies[function_name]:
+            counts[bisect.bisect(self.buckets, latency)] += 1
+        return counts
+
+
+class EventReplayWebSocket(object):
+    """
+    Stands in for the websocket of a team replaying events, counting the
+    messages sent instead of sending them.
+    """
+
+    def __init__(self):
+        self.sent = 0
+
+    def send(self, data):
+        self.sent += 1
+
+    def ping(self):
+        pass
+
+    def shutdown(self):
+        pass
+
+
+class EventQueueStats(object):
+    """
+    Counters for the EventRouter queue, so the backlog can be inspected
+    with /slack queue, e.g. during a reconnect.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.handled = 0
+        self.drains = 0
+        self.max_depth = 0
+        self.max_batch = 0
+        self.last_depth = 0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+        self.total_latency = 0.0
+        self.total_drain_time = 0.0
+
+    def update_depth(self, depth):
+        self.last_depth = depth
+        self.max_depth = max(self.max_depth, depth)
+
+    def add_latency(self, latency):
+        self.last_latency = latency
+        self.max_latency = max(self.max_latency, latency)
+        self.total_latency += latency
+
+    def add_drain(self, handled, duration, remaining):
+        self.handled += handled
+        self.drains += 1
+        self.max_batch = max(self.max_batch, handled)
+        self.total_drain_time += duration
+        self.last_depth = remaining
+
+    def average_latency(self):
+        return self.total_latency / self.handled if self.handled else 0.0
+
+    def average_batch(self):
+        return float(self.handled) / self.drains if self.drains else 0.0
 
 
 def handle_next(data, remaining_calls):
@@ -910,6 +1155,7 @@ class WeechatController(object):
         self.eventrouter = eventrouter
         self.buffers = {}
         self.previous_buffer = None
+        self.temporary_buffers = False
 
     def iter_buffers(self):
         for b in self.buffers:
@@ -924,6 +1170,10 @@ class WeechatController(object):
             self.buffers[buffer_ptr] = channel
         else:
             raise InvalidType(type(buffer_ptr))
+        if self.temporary_buffers:
+            w.buffer_set(buffer_ptr, "print_hooks_enabled", "0")
+            w.buffer_set(buffer_ptr, "notify", "0")
+            w.buffer_set(buffer_ptr, "localvar_set_no_log", "1")
 
     def unregister_buffer(self, buffer_ptr, update_remote=False, close_buffer=False):
         """
@@ -1020,6 +1270,14 @@ def buffer_renamed_cb(data, signal, current_buffer):
     return w.WEECHAT_RC_OK
 
 
+@utf8_decode
+def buffer_cleared_cb(data, signal, current_buffer):
+    channel = EVENTROUTER.weechat_controller.buffers.get(current_buffer)
+    if isinstance(channel, SlackChannelCommon):
+        channel.line_index.clear()
+    return w.WEECHAT_RC_OK
+
+
 @utf8_decode
 def buffer_closing_callback(data, signal, current_buffer):
     """
@@ -1521,6 +1779,42 @@ class SlackRequest(object):
     def request_string(self):
         return "{}".format(self.url)
 
+    def record(self):
+        """
+        Returns what is needed to process a reply to this request again,
+        for EventRouter.record_event.
+        """
+        callback = getattr(self.callback, "__name__", None)
+        return {
+            "request": self.request,
+            "post_data": self.post_data,
+            "channel": self.channel.identifier if self.channel else None,
+            "metadata": {
+                key: value
+                for key, value in self.metadata.items()
+                if value is None or isinstance(value, (basestring, int, float))
+            },
+            "callback": callback if globals().get(callback) is self.callback else "",
+        }
+
+    @classmethod
+    def from_record(cls, team, record):
+        """
+        Creates a request for team from the output of record, or returns
+        None if the request can't be recreated.
+        """
+        if not record or record["callback"] == "":
+            return None
+        callback = globals().get(record["callback"]) if record["callback"] else None
+        return cls(
+            team,
+            record["request"],
+            record["post_data"],
+            channel=team.channels.get(record["channel"]),
+            metadata=record["metadata"],
+            callback=callback,
+        )
+
     def options(self):
         cookies = "; ".join(
             [
@@ -1634,6 +1928,9 @@ class SlackTeam(object):
         self.channel_buffer = None
         self.got_history = True
         self.history_needs_update = False
+        self.cached_at = kwargs.get("cached_at")
+        self.custom_emoji = kwargs.get("custom_emoji", [])
+        self.files_download_location = kwargs.get("files_download_location")
         self.create_buffer()
         self.set_muted_channels(kwargs.get("muted_channels", ""))
         self.set_highlight_words(kwargs.get("highlight_words", ""))
@@ -1664,6 +1961,7 @@ class SlackTeam(object):
     def load_emoji_completions(self):
         self.emoji_completions = list(EMOJI.keys())
         if self.emoji_completions:
+            self.emoji_completions.extend(self.custom_emoji)
             s = SlackRequest(self, "emoji.list")
             self.eventrouter.receive(s)
 
@@ -1910,6 +2208,7 @@ class SlackChannelCommon(object):
         self.label_short_drop_prefix = False
         self.label_short = None
         self.buffer_rename_in_progress = False
+        self.line_index = SlackLineIndex()
 
     def prnt_message(
         self, message, history_message=False, no_log=False, force_render=False
@@ -1962,14 +2261,22 @@ class SlackChannelCommon(object):
         if self.channel_buffer:
             ts = SlackTS()
             w.buffer_set(self.channel_buffer, "print_hooks_enabled", "0")
-            w.prnt_date_tags(
-                self.channel_buffer,
-                ts.major,
-                tag(ts, backlog=True, no_log=True),
-                "\tgetting channel history...",
+            self.prnt_date_tags_indexed(
+                ts, tag(ts, backlog=True, no_log=True), "\tgetting channel history..."
             )
             w.buffer_set(self.channel_buffer, "print_hooks_enabled", "1")
 
+    def prnt_date_tags_indexed(self, ts, tags, data):
+        """
+        Prints data in the channel buffer and adds the printed lines to the
+        line index, so they can be found by ts later.
+        """
+        last_line = self.line_index.last_line(self.channel_buffer)
+        w.prnt_date_tags(self.channel_buffer, ts.major, tags, data)
+        self.line_index.add_printed(
+            self.channel_buffer, ts, last_line, data.count("\n") + 1
+        )
+
     def reprint_messages(self, history_message=False, no_log=True, force_render=False):
         if self.channel_buffer:
             w.buffer_clear(self.channel_buffer)
@@ -2120,7 +2427,7 @@ class SlackChannelCommon(object):
             or config.thread_messages_in_channel
         ):
             new_text = self.render(m, force=True)
-            modify_buffer_line(self.channel_buffer, ts, new_text)
+            modify_buffer_line(self.channel_buffer, ts, new_text, self.line_index)
         if isinstance(m, SlackThreadMessage) or m.thread_channel is not None:
             thread_channel = (
                 m.parent_message.thread_channel
@@ -2129,7 +2436,12 @@ class SlackChannelCommon(object):
             )
             if thread_channel and thread_channel.active:
                 new_text = thread_channel.render(m, force=True)
-                modify_buffer_line(thread_channel.channel_buffer, ts, new_text)
+                modify_buffer_line(
+                    thread_channel.channel_buffer,
+                    ts,
+                    new_text,
+                    thread_channel.line_index,
+                )
 
     def mark_read(self, ts=None, update_remote=True, force=False, post_data={}):
         if self.new_messages or force:
@@ -2151,6 +2463,7 @@ class SlackChannelCommon(object):
 
     def destroy_buffer(self, update_remote):
         self.channel_buffer = None
+        self.line_index.clear()
         self.got_history = False
         self.active = False
 
@@ -2178,7 +2491,7 @@ class SlackChannel(SlackChannelCommon):
         self.got_members = False
         self.history_needs_update = False
         self.pending_history_requests = set()
-        self.messages = OrderedDict()
+        self.messages = SlackSortedMessages()
         self.visible_messages = SlackChannelVisibleMessages(self)
         self.hashed_messages = SlackChannelHashedMessages(self)
         self.thread_channels = {}
@@ -2468,7 +2781,7 @@ class SlackChannel(SlackChannelCommon):
 
     def destroy_buffer(self, update_remote):
         super(SlackChannel, self).destroy_buffer(update_remote)
-        self.messages = OrderedDict()
+        self.messages = SlackSortedMessages()
         if update_remote and not self.eventrouter.shutting_down:
             s = SlackRequest(
                 self.team,
@@ -2523,7 +2836,7 @@ class SlackChannel(SlackChannelCommon):
 
             if no_log:
                 w.buffer_set(self.channel_buffer, "print_hooks_enabled", "0")
-            w.prnt_date_tags(self.channel_buffer, ts.major, tags, data)
+            self.prnt_date_tags_indexed(ts, tags, data)
             if no_log:
                 w.buffer_set(self.channel_buffer, "print_hooks_enabled", "1")
             if backlog or (self_msg and tagset != "join"):
@@ -2538,11 +2851,13 @@ class SlackChannel(SlackChannelCommon):
             message_to_store.submessages = old_message.submessages
 
         self.messages[message_to_store.ts] = message_to_store
-        self.messages = OrderedDict(sorted(self.messages.items()))
 
         max_history = w.config_integer(
             w.config_get("weechat.history.max_buffer_lines_number")
         )
+        if len(self.messages) <= max(max_history, self.messages.trim_threshold):
+            return
+
         messages_to_check = islice(
             self.messages.items(), max(0, len(self.messages) - max_history)
         )
@@ -2569,7 +2884,11 @@ class SlackChannel(SlackChannelCommon):
             if message_hash:
                 del self.hashed_messages[ts]
                 del self.hashed_messages[message_hash]
-            del self.messages[ts]
+        self.messages.delete_many(messages_to_delete)
+
+        # Let the store grow a bit past max_history before trimming again, so
+        # the cost of trimming is spread over many stored messages.
+        self.messages.trim_threshold = len(self.messages) + max(1, max_history // 10)
 
     def is_visible(self):
         return w.buffer_get_integer(self.channel_buffer, "hidden") == 0
@@ -2797,6 +3116,58 @@ class SlackChannel(SlackChannelCommon):
         return text
 
 
+class SlackSortedMessages(MappingReversible):
+    """
+    Mapping of SlackTS to messages which keeps the keys sorted (like an
+    OrderedDict that is always sorted). Messages with a newer ts than all the
+    stored ones are appended in O(1), others are inserted with a binary search.
+    """
+
+    def __init__(self):
+        self._messages = {}
+        self._keys = []
+        # Number of messages the store may hold before SlackChannel trims it
+        self.trim_threshold = 0
+
+    def __getitem__(self, key):
+        return self._messages[key]
+
+    def __setitem__(self, key, value):
+        if key not in self._messages:
+            if not self._keys or self._keys[-1] < key:
+                self._keys.append(key)
+            else:
+                bisect.insort(self._keys, key)
+        self._messages[key] = value
+
+    def __delitem__(self, key):
+        del self._messages[key]
+        del self._keys[bisect.bisect_left(self._keys, key)]
+
+    def __contains__(self, key):
+        return key in self._messages
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __reversed__(self):
+        return reversed(self._keys)
+
+    def delete_many(self, keys):
+        """
+        Deletes several messages at once, in linear time regardless of how
+        many keys are given.
+        """
+        if not keys:
+            return
+        for key in keys:
+            del self._messages[key]
+        self._keys = [key for key in self._keys if key in self._messages]
+
+
 class SlackChannelVisibleMessages(MappingReversible):
     """
     Class with a reversible mapping interface (like a read-only OrderedDict)
@@ -2844,18 +3215,47 @@ class SlackChannelVisibleMessages(MappingReversible):
 
 
 class SlackChannelHashedMessages(dict):
+    min_hash_len = 3
+
     def __init__(self, channel):
         self.channel = channel
+        # The number of short hashes starting with each prefix, so we don't
+        # have to check every short hash when allocating a new one
+        self.prefix_counts = {}
+
+    def __setitem__(self, key, value):
+        if isinstance(key, str) and key not in self:
+            self._count_prefixes(key, 1)
+        super(SlackChannelHashedMessages, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        super(SlackChannelHashedMessages, self).__delitem__(key)
+        if isinstance(key, str):
+            self._count_prefixes(key, -1)
+
+    def pop(self, key, *args):
+        if isinstance(key, str) and key in self:
+            self._count_prefixes(key, -1)
+        return super(SlackChannelHashedMessages, self).pop(key, *args)
+
+    def _count_prefixes(self, short_hash, change):
+        for i in range(self.min_hash_len, len(short_hash) + 1):
+            prefix = short_hash[:i]
+            count = self.prefix_counts.get(prefix, 0) + change
+            if count:
+                self.prefix_counts[prefix] = count
+            else:
+                del self.prefix_counts[prefix]
 
     def __missing__(self, key):
         if not isinstance(key, SlackTS):
             raise KeyError(key)
 
-        hash_len = 3
+        hash_len = self.min_hash_len
         full_hash = sha1_hex(str(key))
         short_hash = full_hash[:hash_len]
 
-        while any(x.startswith(short_hash) for x in self if isinstance(x, str)):
+        while short_hash in self.prefix_counts:
             hash_len += 1
             short_hash = full_hash[:hash_len]
 
@@ -3139,7 +3539,7 @@ class SlackThreadChannel(SlackChannelCommon):
 
             if no_log:
                 w.buffer_set(self.channel_buffer, "print_hooks_enabled", "0")
-            w.prnt_date_tags(self.channel_buffer, ts.major, tags, data)
+            self.prnt_date_tags_indexed(ts, tags, data)
             if no_log:
                 w.buffer_set(self.channel_buffer, "print_hooks_enabled", "1")
             if backlog or self_msg:
@@ -3384,7 +3784,7 @@ class SlackMessage(object):
     def open_thread(self, switch=False):
         if not self.thread_channel or not self.thread_channel.active:
             self.channel.thread_channels[self.ts] = SlackThreadChannel(
-                EVENTROUTER, self.channel, self.ts
+                self.channel.eventrouter, self.channel, self.ts
             )
             self.thread_channel.open()
         if switch:
@@ -3817,7 +4217,11 @@ def handle_rtmconnect(login_data, eventrouter, team, channel, metadata):
 
 def handle_emojilist(emoji_json, eventrouter, team, channel, metadata):
     if emoji_json["ok"]:
-        team.emoji_completions.extend(emoji_json["emoji"].keys())
+        custom_emoji = list(emoji_json["emoji"].keys())
+        team.emoji_completions = list(EMOJI.keys()) + custom_emoji
+        if config.cache_team_data and set(custom_emoji) != set(team.custom_emoji):
+            update_team_cache(team.token, emoji=custom_emoji)
+        team.custom_emoji = custom_emoji
 
 
 def handle_conversationsinfo(channel_json, eventrouter, team, channel, metadata):
@@ -4200,7 +4604,9 @@ def process_message(
 
 
 def download_files(message_json, channel):
-    download_location = config.files_download_location
+    download_location = channel.team.files_download_location
+    if download_location is None:
+        download_location = config.files_download_location
     if not download_location:
         return
     options = {
@@ -5203,35 +5609,136 @@ def hdata_line_ts(line_pointer):
     return None
 
 
-def modify_buffer_line(buffer_pointer, ts, new_text):
-    own_lines = w.hdata_pointer(hdata.buffer, buffer_pointer, "own_lines")
-    line_pointer = w.hdata_pointer(hdata.lines, own_lines, "last_line")
-
-    # Find the last line with this ts
-    is_last_line = True
+def find_buffer_lines(last_line, ts):
+    """
+    Finds the pointers of the last lines printed for ts by walking the buffer
+    backwards from last_line. Used when a line index can't answer.
+    """
+    line_pointer = last_line
     while line_pointer and hdata_line_ts(line_pointer) != ts:
-        is_last_line = False
         line_pointer = w.hdata_move(hdata.line, line_pointer, -1)
 
-    if not line_pointer:
-        return w.WEECHAT_RC_OK
-
-    if weechat_version >= 0x04000000:
-        data = w.hdata_pointer(hdata.line, line_pointer, "data")
-        w.hdata_update(hdata.line_data, data, {"message": new_text})
-        return w.WEECHAT_RC_OK
-
-    # Find all lines for the message
     pointers = []
     while line_pointer and hdata_line_ts(line_pointer) == ts:
         pointers.append(line_pointer)
         line_pointer = w.hdata_move(hdata.line, line_pointer, -1)
     pointers.reverse()
+    return pointers
+
+
+class SlackLineIndex(object):
+    """
+    Index from SlackTS to the pointers of the buffer lines printed for it, so
+    the lines of a message can be found without walking the whole buffer.
+
+    WeeChat only removes lines from the start of a buffer (when the buffer
+    reaches weechat.history.max_buffer_lines_*), so the lines which are gone
+    are dropped by looking at the first line of the buffer. The index is
+    cleared when the buffer is cleared or closed.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.lines = {}
+        self.line_ts = OrderedDict()
+        self.first_line = None
+
+    def last_line(self, buffer_pointer):
+        own_lines = w.hdata_pointer(hdata.buffer, buffer_pointer, "own_lines")
+        return w.hdata_pointer(hdata.lines, own_lines, "last_line")
+
+    def add_printed(self, buffer_pointer, ts, previous_last_line, max_lines):
+        """
+        Indexes the lines printed for ts since previous_last_line was the last
+        line of the buffer, which are at most max_lines.
+        """
+        pointers = []
+        line_pointer = self.last_line(buffer_pointer)
+        while (
+            line_pointer
+            and line_pointer != previous_last_line
+            and len(pointers) < max_lines
+        ):
+            pointers.append(line_pointer)
+            line_pointer = w.hdata_move(hdata.line, line_pointer, -1)
+        if pointers:
+            pointers.reverse()
+            self.set_lines(ts, pointers)
+
+    def set_lines(self, ts, pointers):
+        for pointer in self.lines.pop(ts, []):
+            self.line_ts.pop(pointer, None)
+        for pointer in pointers:
+            if pointer in self.line_ts:
+                # The memory of a removed line has been reused, so this line
+                # and every line printed before it are gone.
+                self._drop_until(pointer)
+                self._drop_first()
+            self.line_ts[pointer] = ts
+        self.lines[ts] = list(pointers)
+
+    def lookup(self, buffer_pointer, ts):
+        """
+        Returns the pointers of the lines for ts, an empty list if they aren't
+        in the buffer, or None if the index is out of sync with the buffer.
+        """
+        self._prune(buffer_pointer)
+        pointers = self.lines.get(ts, [])
+        if pointers and hdata_line_ts(pointers[-1]) != ts:
+            self.clear()
+            return None
+        return list(pointers)
+
+    def _prune(self, buffer_pointer):
+        own_lines = w.hdata_pointer(hdata.buffer, buffer_pointer, "own_lines")
+        first_line = w.hdata_pointer(hdata.lines, own_lines, "first_line")
+        if first_line == self.first_line:
+            return
+        self.first_line = first_line
+        if not self.line_ts:
+            return
+
+        line_pointer = first_line
+        while line_pointer and line_pointer not in self.line_ts:
+            line_pointer = w.hdata_move(hdata.line, line_pointer, 1)
+        if line_pointer:
+            self._drop_until(line_pointer)
+        else:
+            self.lines = {}
+            self.line_ts = OrderedDict()
+
+    def _drop_until(self, pointer):
+        while self.line_ts and next(iter(self.line_ts)) != pointer:
+            self._drop_first()
+
+    def _drop_first(self):
+        pointer, ts = self.line_ts.popitem(last=False)
+        pointers = self.lines.get(ts)
+        if pointers and pointer in pointers:
+            pointers.remove(pointer)
+            if not pointers:
+                del self.lines[ts]
+
+
+def modify_buffer_line(buffer_pointer, ts, new_text, line_index=None):
+    own_lines = w.hdata_pointer(hdata.buffer, buffer_pointer, "own_lines")
+    last_line = w.hdata_pointer(hdata.lines, own_lines, "last_line")
+
+    pointers = line_index.lookup(buffer_pointer, ts) if line_index else None
+    if pointers is None:
+        pointers = find_buffer_lines(last_line, ts)
 
     if not pointers:
         return w.WEECHAT_RC_OK
 
-    if is_last_line:
+    if weechat_version >= 0x04000000:
+        data = w.hdata_pointer(hdata.line, pointers[-1], "data")
+        w.hdata_update(hdata.line_data, data, {"message": new_text})
+        return w.WEECHAT_RC_OK
+
+    if pointers[-1] == last_line:
         lines = new_text.split("\n")
         extra_lines_count = len(lines) - len(pointers)
         if extra_lines_count > 0:
@@ -5251,6 +5758,8 @@ def modify_buffer_line(buffer_pointer, ts, new_text):
             for _ in range(extra_lines_count):
                 w.prnt_date_tags(buffer_pointer, ts.major, tags_str, " \t ")
                 pointers.append(w.hdata_pointer(hdata.lines, own_lines, "last_line"))
+            if line_index:
+                line_index.set_lines(ts, pointers)
             if should_set_unread:
                 w.buffer_set(buffer_pointer, "unread", "")
             w.buffer_set(buffer_pointer, "print_hooks_enabled", "1")
@@ -5704,7 +6213,10 @@ def command_teams(data, current_buffer, args):
     """
     team = EVENTROUTER.weechat_controller.buffers[current_buffer].team
     teams = EVENTROUTER.teams.values()
-    extra_info_function = lambda team: "token: {}".format(token_for_print(team.token))
+    extra_info_function = lambda team: "token: {}{}".format(
+        token_for_print(team.token),
+        ", using cached data (refreshing)" if team.cached_at else "",
+    )
     return print_team_items_info(team, "Slack teams", teams, extra_info_function)
 
 
@@ -6161,6 +6673,173 @@ def command_help(data, current_buffer, args):
     return w.WEECHAT_RC_OK
 
 
+@utf8_decode
+def command_cache(data, current_buffer, args):
+    """
+    /slack cache [-clear]
+    Show the age of the cached data of each team. Use -clear to delete the
+    cached data, so everything is fetched from Slack on the next load.
+    """
+    tokens = [token.strip() for token in config.slack_api_token.split(",") if token]
+    if args == "-clear":
+        for token in tokens:
+            delete_team_cache(token)
+        w.prnt("", "Cleared the cached team data")
+        return w.WEECHAT_RC_OK_EAT
+
+    for token in tokens:
+        team = next(
+            (team for team in EVENTROUTER.teams.values() if team.token == token),
+            None,
+        )
+        name = team.domain if team else token_for_print(token)
+        path = team_cache_path(token)
+        if os.path.exists(path):
+            saved_at = datetime.fromtimestamp(os.path.getmtime(path))
+            status = "saved {}".format(saved_at.strftime("%Y-%m-%d %H:%M:%S"))
+            if team and team.cached_at:
+                status += ", in use until fresh data is fetched"
+        else:
+            status = "no cached data"
+        w.prnt("", "{}: {}".format(name, status))
+    return w.WEECHAT_RC_OK_EAT
+
+
+command_cache.completion = "-clear"
+
+
+@slack_buffer_required
+@utf8_decode
+def command_replay(data, current_buffer, args):
+    """
+    /slack replay <directory>
+    Replay the websocket events and HTTP replies recorded with the
+    record_events setting in directory, and print how long each event handler
+    took. The events are replayed for a copy of the team of the current
+    buffer, created from its cached team data (see the cache_team_data
+    setting) in temporary buffers of its own, which are closed when the replay
+    is done. Files are not downloaded for the events.
+    Nothing is sent to Slack for the events.
+    """
+    team = EVENTROUTER.weechat_controller.buffers[current_buffer].team
+    directory = os.path.expanduser(args)
+    if not os.path.isdir(directory):
+        w.prnt("", "ERROR: Could not find directory: {}".format(directory))
+        return w.WEECHAT_RC_ERROR
+
+    eventrouter = EventRouter()
+    try:
+        replay_team = create_replay_team(eventrouter, team.token)
+        if not replay_team:
+            w.prnt(
+                "",
+                "ERROR: No cached team data for {}, enable the cache_team_data"
+                " setting and reconnect to replay events".format(team.domain),
+            )
+            return w.WEECHAT_RC_ERROR
+        stats = eventrouter.replay(directory, replay_team)
+    finally:
+        for buffer_ptr in list(eventrouter.weechat_controller.buffers):
+            eventrouter.weechat_controller.unregister_buffer(buffer_ptr, False, True)
+
+    peak_memory = (
+        "{:.1f} MiB".format(stats.peak_memory / 1024.0 / 1024.0)
+        if stats.peak_memory is not None
+        else "unknown"
+    )
+    w.prnt(
+        "",
+        "Replayed {} events in {:.2f}s ({:.0f} events/s), {} failed, skipped {} http"
+        " replies, dropped {} requests and {} websocket messages, peak memory {}".format(
+            stats.handled(),
+            stats.duration,
+            stats.events_per_second(),
+            sum(stats.errors.values()),
+            stats.skipped,
+            stats.dropped_requests,
+            replay_team.ws.sent,
+            peak_memory,
+        ),
+    )
+    w.prnt(
+        "",
+        "{:<28} {:>7} {:>7} {:>10} {:>7} {:>7} {:>7} {:>7} {:>8}".format(
+            "handler",
+            "count",
+            "failed",
+            "total ms",
+            "<1ms",
+            "<10ms",
+            "<100ms",
+            ">=100ms",
+            "max ms",
+        ),
+    )
+    for function_name, latencies in sorted(
+        stats.latencies.items(), key=lambda item: -sum(item[1])
+    ):
+        w.prnt(
+            "",
+            "{:<28} {:>7} {:>7} {:>10.1f} {:>7} {:>7} {:>7} {:>7} {:>8.1f}".format(
+                function_name,
+                len(latencies),
+                stats.errors.get(function_name, 0),
+                sum(latencies) * 1000,
+                *(stats.histogram(function_name) + [max(latencies) * 1000])
+            ),
+        )
+    if stats.errors:
+        w.prnt("", "Enable debug_mode to see why events failed")
+    return w.WEECHAT_RC_OK_EAT
+
+
+command_replay.completion = "%(filename) %-"
+
+
+@utf8_decode
+def command_queue(data, current_buffer, args):
+    """
+    /slack queue [-reset]
+    Print the depth of the event queue and how long events wait in it
+    before being processed. Use -reset to reset the counters.
+    """
+    stats = EVENTROUTER.queue_stats
+    if args == "-reset":
+        stats.reset()
+        w.prnt("", "Event queue counters reset")
+        return w.WEECHAT_RC_OK_EAT
+
+    w.prnt(
+        "",
+        "Event queue: {} queued ({} slow), max depth {}".format(
+            len(EVENTROUTER.queue), len(EVENTROUTER.slow_queue), stats.max_depth
+        ),
+    )
+    w.prnt(
+        "",
+        "Processed {} events in {} drains (avg {:.1f}, max {} per drain, {:.0f} ms"
+        " total)".format(
+            stats.handled,
+            stats.drains,
+            stats.average_batch(),
+            stats.max_batch,
+            stats.total_drain_time * 1000,
+        ),
+    )
+    w.prnt(
+        "",
+        "Queue latency: last {:.0f} ms, avg {:.0f} ms, max {:.0f} ms".format(
+            stats.last_latency * 1000,
+            stats.average_latency() * 1000,
+            stats.max_latency * 1000,
+        ),
+    )
+    return w.WEECHAT_RC_OK_EAT
+
+
+command_queue.completion = "-reset"
+
+
 @slack_buffer_required
 @utf8_decode
 def command_distracting(data, current_buffer, args):
@@ -6621,6 +7300,7 @@ def setup_hooks():
     w.hook_timer(1000 * 60 * 5, 0, 0, "slack_never_away_cb", "")
 
     w.hook_signal("buffer_closing", "buffer_closing_callback", "")
+    w.hook_signal("buffer_cleared", "buffer_cleared_cb", "")
     w.hook_signal("buffer_renamed", "buffer_renamed_cb", "")
     w.hook_signal("buffer_switch", "buffer_switch_callback", "")
     w.hook_signal("window_switch", "buffer_switch_callback", "")
@@ -6777,6 +7457,13 @@ class PluginConfig(object):
             " you experience performance issues, however that causes some loss of functionality,"
             " see known issues in the readme.",
         ),
+        "cache_team_data": Setting(
+            default="true",
+            desc="Store the users, channels, usergroups and custom emoji of each"
+            ' team in the "slack_cache" directory in the WeeChat data directory,'
+            " and create the teams from this data when the script is loaded while"
+            " fresh data is fetched from Slack in the background.",
+        ),
         "channel_name_typing_indicator": Setting(
             default="true",
             desc="Change the prefix of a channel from # to > when someone is"
@@ -6829,6 +7516,13 @@ class PluginConfig(object):
             " to it. How verbose the logging is depends on log_level.",
         ),
         "distracting_channels": Setting(default="", desc="List of channels to hide."),
+        "event_drain_budget": Setting(
+            default="20",
+            desc="How long (ms) to spend processing queued events each time the"
+            " event queue is drained. At least one event is always processed. A"
+            " higher value empties a large backlog (e.g. when reconnecting to big"
+            " teams) faster, at the cost of WeeChat being less responsive meanwhile.",
+        ),
         "external_user_suffix": Setting(
             default="*", desc="The suffix appended to nicks to indicate external users."
         ),
@@ -7068,6 +7762,7 @@ class PluginConfig(object):
     get_color_typing_notice = get_string
     get_colorize_attachments = get_string
     get_debug_level = get_int
+    get_event_drain_budget = get_int
     get_external_user_suffix = get_string
     get_files_download_location = get_string
     get_group_name_prefix = get_string
@@ -7186,7 +7881,83 @@ def get_next_page(response_json):
         return False
 
 
+def team_cache_path(token):
+    weechat_dir = w.info_get("weechat_data_dir", "") or w.info_get("weechat_dir", "")
+    return os.path.join(weechat_dir, "slack_cache", "{}.json".format(sha1_hex(token)))
+
+
+def load_team_cache(token):
+    try:
+        with open(team_cache_path(token), "r") as f:
+            cache = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if cache.get("version") != TEAM_CACHE_VERSION:
+        return None
+    return cache
+
+
+def save_team_cache(token, team_data, initial_data, emoji=None):
+    if emoji is None:
+        emoji = []
+    cache = {
+        "saved_at": time.time(),
+        "team": team_data,
+        "initial_data": {
+            key: initial_data[key]
+            for key in ["channels", "members", "usergroups", "prefs", "presence"]
+        },
+        "emoji": emoji,
+    }
+    write_team_cache(token, cache)
+
+
+def write_team_cache(token, cache):
+    path = team_cache_path(token)
+    cache["version"] = TEAM_CACHE_VERSION
+    try:
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), 0o700)
+        tmp_path = path + ".tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(cache, f)
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        dbg("Couldn't save team cache: {}".format(format_exc_only()), 5)
+
+
+def update_team_cache(token, **kwargs):
+    cache = load_team_cache(token)
+    if cache:
+        cache.update(kwargs)
+        write_team_cache(token, cache)
+
+
+def delete_team_cache(token):
+    try:
+        os.remove(team_cache_path(token))
+    except OSError:
+        pass
+
+
 def initiate_connection(token):
+    if config.cache_team_data:
+        cache = load_team_cache(token)
+        if cache:
+            try:
+                create_team_from_data(
+                    EVENTROUTER,
+                    token,
+                    cache["team"],
+                    cache["initial_data"],
+                    None,
+                    cached_at=cache["saved_at"],
+                    custom_emoji=cache.get("emoji", []),
+                )
+            except:
+                dbg("Couldn't create team from cache: {}".format(format_exc_tb()), 5)
+
     initial_data = {
         "channels": [],
         "members": [],
@@ -7244,7 +8015,7 @@ def initiate_connection(token):
             create_team(token, initial_data)
             return
 
-        initial_data["presence"] = response_json
+        initial_data["presence"] = {"manual_away": response_json["manual_away"]}
         initial_data["remaining"]["presence"] -= 1
         create_team(token, initial_data)
 
@@ -7323,6 +8094,15 @@ def create_channel_from_info(eventrouter, channel_info, team, myidentifier, user
 
 def create_team(token, initial_data):
     if not any(initial_data["remaining"].values()):
+        cached_team = next(
+            (
+                team
+                for team in EVENTROUTER.teams.values()
+                if team.token == token and team.cached_at
+            ),
+            None,
+        )
+
         if initial_data["errors"]:
             w.prnt(
                 "",
@@ -7336,7 +8116,16 @@ def create_team(token, initial_data):
                     "ERROR: Token does not look like a valid Slack token. "
                     "Ensure it is a valid token and not just a OAuth code.",
                 )
+            if cached_team:
+                cached_team.cached_at = None
+                cached_team.buffer_prnt(
+                    "Failed fetching fresh team data from Slack, keeping the cached data"
+                )
+
+            return
 
+        if cached_team:
+            update_team_from_data(cached_team, initial_data)
             return
 
         def handle_rtmconnect(response_json, eventrouter, team, channel, metadata):
@@ -7344,116 +8133,261 @@ def create_team(token, initial_data):
                 print(response_json["error"])
                 return
 
-            team_id = response_json["team"]["id"]
-            myidentifier = response_json["self"]["id"]
+            team_data = {
+                "id": response_json["team"]["id"],
+                "domain": response_json["team"]["domain"],
+                "self_id": response_json["self"]["id"],
+                "self_name": response_json["self"]["name"],
+            }
+            if config.cache_team_data:
+                save_team_cache(token, team_data, initial_data)
+            create_team_from_data(
+                eventrouter, token, team_data, initial_data, response_json["url"]
+            )
 
-            users = {}
-            bots = {}
-            for member in initial_data["members"]:
-                if member.get("is_bot"):
-                    bots[member["id"]] = SlackBot(team_id, **member)
-                else:
-                    users[member["id"]] = SlackUser(team_id, **member)
+        s = get_rtm_connect_request(token, callback=handle_rtmconnect)
+        EVENTROUTER.receive(s)
 
-            self_nick = nick_from_profile(
-                users[myidentifier].profile, response_json["self"]["name"]
-            )
 
-            channels = {}
-            for channel_info in initial_data["channels"]:
-                channels[channel_info["id"]] = create_channel_from_info(
-                    eventrouter, channel_info, None, myidentifier, users
-                )
+def create_users_from_members(team_id, members):
+    users = {}
+    bots = {}
+    for member in members:
+        if member.get("is_bot"):
+            bots[member["id"]] = SlackBot(team_id, **member)
+        else:
+            users[member["id"]] = SlackUser(team_id, **member)
+    return users, bots
 
-            subteams = {}
-            for usergroup in initial_data["usergroups"]:
-                is_member = myidentifier in usergroup["users"]
-                subteams[usergroup["id"]] = SlackSubteam(
-                    team_id, is_member=is_member, **usergroup
-                )
 
-            manual_presence = (
-                "away" if initial_data["presence"]["manual_away"] else "active"
-            )
+def create_subteams_from_usergroups(team_id, usergroups, myidentifier):
+    subteams = {}
+    for usergroup in usergroups:
+        is_member = myidentifier in usergroup["users"]
+        subteams[usergroup["id"]] = SlackSubteam(
+            team_id, is_member=is_member, **usergroup
+        )
+    return subteams
 
-            try:
-                all_notifications_prefs = json.loads(
-                    initial_data["prefs"].get("all_notifications_prefs")
-                )
-                global_keywords = all_notifications_prefs.get("global", {}).get(
-                    "global_keywords"
-                )
-            except json.decoder.JSONDecodeError:
-                global_keywords = None
 
-            if global_keywords is None:
-                print_error(
-                    "global_keywords not found in users.prefs.get", warning=True
-                )
-                dbg(
-                    "global_keywords not found in users.prefs.get. Response of users.prefs.get: {}".format(
-                        json.dumps(initial_data["prefs"])
-                    ),
-                    level=5,
-                )
-                global_keywords = ""
+def get_global_keywords(prefs):
+    try:
+        all_notifications_prefs = json.loads(prefs.get("all_notifications_prefs"))
+        global_keywords = all_notifications_prefs.get("global", {}).get(
+            "global_keywords"
+        )
+    except json.decoder.JSONDecodeError:
+        global_keywords = None
 
-            team_info = {
-                "id": team_id,
-                "name": response_json["team"]["id"],
-                "domain": response_json["team"]["domain"],
-            }
+    if global_keywords is None:
+        print_error("global_keywords not found in users.prefs.get", warning=True)
+        dbg(
+            "global_keywords not found in users.prefs.get. Response of users.prefs.get: {}".format(
+                json.dumps(prefs)
+            ),
+            level=5,
+        )
+        global_keywords = ""
+    return global_keywords
+
+
+def create_team_from_data(
+    eventrouter,
+    token,
+    team_data,
+    initial_data,
+    websocket_url,
+    cached_at=None,
+    custom_emoji=None,
+    connect=True,
+):
+    if custom_emoji is None:
+        custom_emoji = []
+    team_id = team_data["id"]
+    myidentifier = team_data["self_id"]
+
+    users, bots = create_users_from_members(team_id, initial_data["members"])
+
+    self_nick = nick_from_profile(users[myidentifier].profile, team_data["self_name"])
 
-            team_hash = SlackTeam.generate_team_hash(
-                team_id, response_json["team"]["domain"]
+    channels = {}
+    for channel_info in initial_data["channels"]:
+        channels[channel_info["id"]] = create_channel_from_info(
+            eventrouter, channel_info, None, myidentifier, users
+        )
+
+    subteams = create_subteams_from_usergroups(
+        team_id, initial_data["usergroups"], myidentifier
+    )
+
+    manual_presence = "away" if initial_data["presence"]["manual_away"] else "active"
+
+    global_keywords = get_global_keywords(initial_data["prefs"])
+
+    team_info = {
+        "id": team_id,
+        "name": team_id,
+        "domain": team_data["domain"],
+    }
+
+    team_hash = SlackTeam.generate_team_hash(team_id, team_data["domain"])
+    if not eventrouter.teams.get(team_hash):
+        team = SlackTeam(
+            eventrouter,
+            token,
+            team_hash,
+            websocket_url,
+            team_info,
+            subteams,
+            self_nick,
+            myidentifier,
+            manual_presence,
+            users,
+            bots,
+            channels,
+            muted_channels=initial_data["prefs"]["muted_channels"],
+            highlight_words=global_keywords,
+            cached_at=cached_at,
+            custom_emoji=custom_emoji,
+        )
+        eventrouter.register_team(team)
+        if cached_at:
+            team.buffer_prnt(
+                "Using cached team data from {}, fetching fresh data from Slack".format(
+                    datetime.fromtimestamp(cached_at).strftime("%Y-%m-%d %H:%M:%S")
+                )
             )
-            if not eventrouter.teams.get(team_hash):
-                team = SlackTeam(
-                    eventrouter,
-                    token,
-                    team_hash,
-                    response_json["url"],
-                    team_info,
-                    subteams,
+        if connect:
+            team.connect()
+    else:
+        team = eventrouter.teams.get(team_hash)
+        if team.myidentifier != myidentifier:
+            print_error(
+                "The Slack team {} has tokens for two different users, this is not supported. The "
+                "token {} is for user {}, and the token {} is for user {}. Please remove one of "
+                "them.".format(
+                    team.team_info["name"],
+                    token_for_print(team.token),
+                    team.nick,
+                    token_for_print(token),
                     self_nick,
-                    myidentifier,
-                    manual_presence,
-                    users,
-                    bots,
-                    channels,
-                    muted_channels=initial_data["prefs"]["muted_channels"],
-                    highlight_words=global_keywords,
                 )
-                eventrouter.register_team(team)
-                team.connect()
-            else:
-                team = eventrouter.teams.get(team_hash)
-                if team.myidentifier != myidentifier:
-                    print_error(
-                        "The Slack team {} has tokens for two different users, this is not supported. The "
-                        "token {} is for user {}, and the token {} is for user {}. Please remove one of "
-                        "them.".format(
-                            team.team_info["name"],
-                            token_for_print(team.token),
-                            team.nick,
-                            token_for_print(token),
-                            self_nick,
-                        )
-                    )
-                else:
-                    print_error(
-                        "Ignoring duplicate Slack tokens for the same team ({}) and user ({}). The two "
-                        "tokens are {} and {}.".format(
-                            team.team_info["name"],
-                            team.nick,
-                            token_for_print(team.token),
-                            token_for_print(token),
-                        ),
-                        warning=True,
-                    )
+            )
+        else:
+            print_error(
+                "Ignoring duplicate Slack tokens for the same team ({}) and user ({}). The two "
+                "tokens are {} and {}.".format(
+                    team.team_info["name"],
+                    team.nick,
+                    token_for_print(team.token),
+                    token_for_print(token),
+                ),
+                warning=True,
+            )
+    return team
 
-        s = get_rtm_connect_request(token, callback=handle_rtmconnect)
-        EVENTROUTER.receive(s)
+
+def create_replay_team(eventrouter, token):
+    """
+    Creates a team for eventrouter from the cached data of the team with
+    token, to replay events for with EventRouter.replay. The team gets a
+    domain of its own so its buffers don't clash with the ones of the real
+    team, its buffers aren't logged, notified or seen by other scripts, it
+    doesn't download files and it never connects to Slack.
+    """
+    cache = load_team_cache(token)
+    if not cache:
+        return None
+    eventrouter.weechat_controller.temporary_buffers = True
+    team_data = dict(cache["team"], domain=cache["team"]["domain"] + "-replay")
+    team = create_team_from_data(
+        eventrouter,
+        token,
+        team_data,
+        cache["initial_data"],
+        None,
+        custom_emoji=cache.get("emoji", []),
+        connect=False,
+    )
+    team.ws = EventReplayWebSocket()
+    team.files_download_location = ""
+    # Drop the requests made while creating the team
+    eventrouter.queue.clear()
+    eventrouter.slow_queue.clear()
+    return team
+
+
+def update_team_from_data(team, initial_data):
+    """
+    Reconciles a team created from cached data with the data fetched from
+    Slack, and replaces the cached data with it.
+    """
+    users, bots = create_users_from_members(team.identifier, initial_data["members"])
+    for user_id, user in users.items():
+        old_user = team.users.get(user_id)
+        if old_user and user.presence == "unknown":
+            user.presence = old_user.presence
+    team.users.update(users)
+    team.bots.update(bots)
+    myself = team.users[team.myidentifier]
+    team.nick = nick_from_profile(myself.profile, myself.username)
+    myself.force_color(w.config_string(w.config_get("weechat.color.chat_nick_self")))
+
+    channel_ids = {channel_info["id"] for channel_info in initial_data["channels"]}
+    for channel_id, channel in list(team.channels.items()):
+        if channel_id not in channel_ids:
+            # Gone since the data was cached, e.g. left or archived
+            for thread_channel in channel.thread_channels.values():
+                team.eventrouter.weechat_controller.unregister_buffer(
+                    thread_channel.channel_buffer, False, True
+                )
+            team.eventrouter.weechat_controller.unregister_buffer(
+                channel.channel_buffer, False, True
+            )
+            del team.channels[channel_id]
+
+    for channel_info in initial_data["channels"]:
+        channel = team.channels.get(channel_info["id"])
+        if channel is None:
+            channel = create_channel_from_info(
+                team.eventrouter, channel_info, team, team.myidentifier, team.users
+            )
+            team.channels[channel_info["id"]] = channel
+            channel.set_related_server(team)
+            channel.check_should_open()
+            continue
+
+        if channel.type not in ["im", "mpim"] and "name" in channel_info:
+            if channel_info["name"] != channel.slack_name:
+                channel.set_name(channel_info["name"])
+        should_open = False
+        for key in ["is_member", "is_open"]:
+            if channel_info.get(key) and not getattr(channel, key, False):
+                should_open = True
+            if key in channel_info:
+                setattr(channel, key, channel_info[key])
+        if should_open:
+            channel.check_should_open()
+
+    team.subteams = create_subteams_from_usergroups(
+        team.identifier, initial_data["usergroups"], team.myidentifier
+    )
+    team.my_manual_presence = (
+        "away" if initial_data["presence"]["manual_away"] else "active"
+    )
+    team.set_muted_channels(initial_data["prefs"]["muted_channels"])
+    team.set_highlight_words(get_global_keywords(initial_data["prefs"]))
+
+    team.cached_at = None
+    team.buffer_prnt("Fetched fresh team data from Slack")
+
+    team_data = {
+        "id": team.identifier,
+        "domain": team.subdomain,
+        "self_id": team.myidentifier,
+        "self_name": myself.username,
+    }
+    save_team_cache(team.token, team_data, initial_data, team.custom_emoji)
 
 
 if __name__ == "__main__":
@@ -28,8 +28,8 @@
 #
 # How does it work?
 #
-# 1. The URLs displayed in buffers are shortened and stored in memory (saved in
-#    a file when script is unloaded).
+# 1. The URLs displayed in buffers are shortened and stored in memory (and
+#    appended to a file, so that they are kept when script is unloaded).
 # 2. URLs shortened can be displayed below messages, in a dedicated buffer, or
 #    as HTML page in your browser.
 # 3. This script embeds an HTTP server, which will redirect shortened URLs
@@ -44,6 +44,11 @@
 #
 # History:
 #
+# 2026-10-18:
+#     v2.7: non-blocking HTTP server with keep-alive (new options
+#           http_keep_alive, http_timeout, http_max_connections),
+#           paginated list of URLs (new option http_page_size),
+#           append-only file of URLs
 # 2021-05-06, Sébastien Helleu <flashcode@flashtux.org>:
 #     v2.6: add compatibility with WeeChat >= 3.2 (XDG directories)
 # 2021-03-06, Sébastien Helleu <flashcode@flashtux.org>:
@@ -120,7 +125,7 @@
 
 SCRIPT_NAME = 'urlserver'
 SCRIPT_AUTHOR = 'Sébastien Helleu <flashcode@flashtux.org>'
-SCRIPT_VERSION = '2.6'
+SCRIPT_VERSION = '2.7'
 SCRIPT_LICENSE = 'GPL3'
 SCRIPT_DESC = 'Shorten URLs with own HTTP server'
 
@@ -144,12 +149,16 @@ except ImportError:
 try:
     import ast
     import base64
+    import bisect
+    import collections
     import datetime
+    import errno
     import os
     import re
     import socket
     import string
     import sys
+    import time
 except ImportError as message:
     print('Missing package(s) for %s: %s' % (SCRIPT_NAME, message))
     import_ok = False
@@ -213,8 +222,16 @@ url_full = r'(?P<url>(?:%s)://(?:%s)(?:%s)(?:\?%s)?(?:#%s)?)(?P<trailer>.)?' % (
 urlserver = {
     'socket': None,
     'hook_fd': None,
+    'hook_timer': None,
+    'clients': {},
     'regex': re.compile(url_full, re.IGNORECASE),
     'urls': {},
+    'index': {'time': [], 'nick': [], 'buffer': []},
+    'rows': {},
+    'journal': None,
+    'journal_lines': 0,
+    'hook_compact': None,
+    'compact_pos': 0,
     'number': 0,
     'buffer': '',
 }
@@ -242,6 +259,17 @@ urlserver_settings_default = {
         '',
         'display this port in shortened URLs. Useful if you forward '
         'a different external port to the internal port'),
+    'http_keep_alive': (
+        'on',
+        'keep connections open after a reply, for next requests of the '
+        'same client'),
+    'http_timeout': (
+        '15',
+        'close client connections idle for this number of seconds'),
+    'http_max_connections': (
+        '20',
+        'maximum number of client connections open at same time '
+        '(0 = no limit)'),
     'http_allowed_ips': (
         '',
         'regex for IPs allowed to use server '
@@ -292,6 +320,11 @@ urlserver_settings_default = {
     'http_open_in_new_page': (
         'on',
         'open links in new pages/tabs'),
+    'http_page_size': (
+        '100',
+        'number of URLs displayed by page in the HTML page (0 = all URLs '
+        'on one page); the page and size can be given in the URL with '
+        '"?page=N&limit=N"'),
     # message filter settings
     'msg_ignore_buffers': (
         'core.weechat,python.grep',
@@ -363,6 +396,15 @@ def base62_encode(number):
     return ''.join(l) or '0'
 
 
+def urlserver_setting_int(name, default):
+    """Return value of an integer option (default if value is invalid)."""
+    global urlserver_settings
+    try:
+        return int(urlserver_settings[name])
+    except:
+        return default
+
+
 def base62_decode(str_value):
     """Decode a base62 string (all digits + a-z + A-Z) to a number."""
     base62chars = string.digits + string.ascii_letters
@@ -418,36 +460,55 @@ def urlserver_short_url(number, full=True):
                      base62_encode(number))
 
 
-def urlserver_server_reply(conn, code, extra_header, message,
+def urlserver_server_reply(client, code, extra_header, message,
                            mimetype='text/html'):
-    """Send a HTTP reply to client."""
+    """
+    Queue a HTTP reply for client (sent by urlserver_client_flush), message
+    can be a string or a list of strings.
+    """
     global urlserver_settings
     if extra_header:
         extra_header += '\r\n'
+    if type(message) is not list:
+        message = [message]
+    if sys.version_info >= (3,):
+        # python 3.x
+        message = [part if type(part) is bytes else part.encode('utf-8')
+                   for part in message]
+    length = sum([len(part) for part in message])
     s = 'HTTP/1.1 %s\r\n' \
         '%s' \
         'Content-Type: %s\r\n' \
         'Content-Length: %d\r\n' \
+        'Connection: %s\r\n' \
         '\r\n' \
-        % (code, extra_header, mimetype, len(message))
-    msg = None
+        % (code, extra_header, mimetype, length,
+           'close' if client['close'] else 'keep-alive')
     if sys.version_info >= (3,):
         # python 3.x
-        if type(message) is bytes:
-            msg = s.encode('utf-8') + message
-        else:
-            msg = s.encode('utf-8') + message.encode('utf-8')
-    else:
-        # python 2.x
-        msg = s + message
+        s = s.encode('utf-8')
     if urlserver_settings['debug'] == 'on':
-        weechat.prnt('', 'urlserver: sending %d bytes' % len(msg))
-    conn.sendall(msg)
-
-
-def urlserver_server_reply_auth_required(conn):
+        weechat.prnt('', 'urlserver: sending %d bytes' % (len(s) + length))
+    client['outbuf'].append(s)
+    # big pages are queued in chunks, so that a partial send does not copy
+    # the whole rest of the page
+    chunk = []
+    chunk_size = 0
+    for part in message:
+        for pos in range(0, len(part), 65536):
+            chunk.append(part[pos:pos + 65536])
+            chunk_size += len(chunk[-1])
+            if chunk_size >= 65536:
+                client['outbuf'].append(b''.join(chunk))
+                chunk = []
+                chunk_size = 0
+    if chunk:
+        client['outbuf'].append(b''.join(chunk))
+
+
+def urlserver_server_reply_auth_required(client):
     """Reply a 401 (authorization required)."""
-    urlserver_server_reply(conn,
+    urlserver_server_reply(client,
                            '401 Authorization required',
                            'WWW-Authenticate: Basic realm="%s"' % SCRIPT_NAME,
                            '')
@@ -496,20 +557,157 @@ def urlserver_server_favicon():
     return base64_decode(s)
 
 
-def urlserver_server_reply_list(conn, sort='-time'):
-    """Send list of URLs as HTML page to client."""
+def urlserver_index_entries(key):
+    """Return entries of an URL in the sort indexes."""
+    global urlserver
+    url = urlserver['urls'][key]
+    return (('time', ('', key)),
+            ('nick', (url[1].lower(), key)),
+            ('buffer', (url[2].lower(), key)))
+
+
+def urlserver_index_add(key):
+    """Add an URL in the sort indexes."""
+    global urlserver
+    for name, entry in urlserver_index_entries(key):
+        bisect.insort(urlserver['index'][name], entry)
+
+
+def urlserver_index_remove(key):
+    """Remove an URL from the sort indexes and the cache of HTML rows."""
+    global urlserver
+    for name, entry in urlserver_index_entries(key):
+        index = urlserver['index'][name]
+        pos = bisect.bisect_left(index, entry)
+        if pos < len(index) and index[pos] == entry:
+            del index[pos]
+    urlserver['rows'].pop(key, None)
+
+
+def urlserver_index_rebuild():
+    """Build the sort indexes with all URLs."""
+    global urlserver
+    urlserver['index'] = {'time': [], 'nick': [], 'buffer': []}
+    for key in urlserver['urls']:
+        for name, entry in urlserver_index_entries(key):
+            urlserver['index'][name].append(entry)
+    for index in urlserver['index'].values():
+        index.sort()
+    urlserver['rows'] = {}
+
+
+def urlserver_sorted_keys(sort, start, count):
+    """Return keys of URLs in a page of the list sorted by "sort"."""
+    global urlserver
+    index = urlserver['index'][sort[1:]]
+    if sort.startswith('+'):
+        entries = index[start:start + count]
+    else:
+        end = max(len(index) - start, 0)
+        entries = index[max(end - count, 0):end][::-1]
+    return [entry[1] for entry in entries]
+
+
+def urlserver_server_html_row(key):
+    """Return HTML row for an URL (cached, encoded)."""
+    global urlserver, urlserver_settings
+    row = urlserver['rows'].get(key)
+    if row is not None:
+        return row
+    item = urlserver['urls'][key]
+    row = '  <tr>'
+    url = item[3]
+    obj = ''
+    message = (html.escape(item[4].replace(url, '\x01\x02\x03\x04'))
+               .split('\t', 1))
+    message[0] = '<span class="prefix">%s</span>' % message[0]
+    message[1] = '<span class="message">%s</span>' % message[1]
+
+    strjoin = ('<span class="prefix_suffix"> %s </span>' %
+               urlserver_settings['http_prefix_suffix']
+               .replace(' ', '&nbsp;'))
+
+    target = ''
+    if urlserver_settings['http_open_in_new_page'] == 'on':
+        target = ' target=_blank'
+
+    message = strjoin.join(message).replace(
+        '\x01\x02\x03\x04',
+        '</span><a class="url" href="%s" title="%s"%s>%s'
+        '</a><span class="message">' % (
+            urlserver_short_url(key, False), url, target, url))
+    if urlserver_settings['http_embed_image'] == 'on' and \
+            url.lower().endswith(('.jpg', '.jpeg', '.png', '.gif',
+                                  '.bmp', '.svg')):
+        obj = ('<div class="obj"><img src="%s" title="%s" alt="%s">'
+               '</div>' % (url, url, url))
+    elif urlserver_settings['http_embed_youtube'] == 'on' and \
+            'youtube.com/' in url:
+        m = re.search('v=([\w\d]+)', url)
+        if m:
+            yid = m.group(1)
+            try:
+                size = (urlserver_settings['http_embed_youtube_size']
+                        .split('*'))
+                width = int(size[0])
+                height = int(size[1])
+            except:
+                width = 480
+                height = 350
+            obj = ('<div class="obj youtube">'
+                   '<iframe id="%s" type="text/html" width="%d" '
+                   'height="%d" '
+                   'src="https://www.youtube.com/embed/%s?enablejsapi=1">'
+                   '</iframe></div>' % (yid, width, height, yid))
+    row += ('<td class="timestamp">%s</td>'
+            '<td class="nick">%s</td>'
+            '<td class="buffer">%s</td><td class="message">' % (
+                item[0], item[1], item[2]))
+    row += '%s%s</td></tr>\n' % (message, obj)
+    if sys.version_info >= (3,):
+        # python 3.x
+        row = row.encode('utf-8')
+    urlserver['rows'][key] = row
+    return row
+
+
+def urlserver_server_html_pages(sort, page, pages, limit):
+    """Return HTML links to previous/next pages of list of URLs."""
+    if pages <= 1:
+        return ''
+    if sort.startswith('+'):
+        sort = sort[1:]
+    limit = '&amp;limit=%d' % limit if limit is not None else ''
+    links = []
+    if page > 1:
+        links.append('<a class="page_link" href="sort=%s?page=%d%s">'
+                     '&larr;</a>' % (sort, page - 1, limit))
+    links.append('<span class="page">%d / %d</span>' % (page, pages))
+    if page < pages:
+        links.append('<a class="page_link" href="sort=%s?page=%d%s">'
+                     '&rarr;</a>' % (sort, page + 1, limit))
+    return '<div class="pages">%s</div>\n' % ' '.join(links)
+
+
+def urlserver_server_reply_list(client, sort='-time', page=1, limit=None):
+    """
+    Send a page of the list of URLs as HTML page to client (limit is the
+    number of URLs per page, None = value of option "http_page_size",
+    0 = all URLs).
+    """
     global urlserver, urlserver_settings
     content = '<div class="urls">\n<table id="urls_table">\n'
-    if not sort.startswith('-'):
+    if not sort.startswith(('-', '+')):
         sort = '+%s' % sort
-    if sort[1:] == 'time':
-        urls = sorted(urlserver['urls'].items())
-    else:
-        idx = ['time', 'nick', 'buffer'].index(sort[1:])
-        urls = sorted(urlserver['urls'].items(),
-                      key=lambda url: url[1][idx].lower())
-    if sort.startswith('-'):
-        urls.reverse()
+    if sort[1:] not in ('time', 'nick', 'buffer'):
+        sort = '-time'
+    count = limit
+    if count is None:
+        count = urlserver_setting_int('http_page_size', 100)
+    if count <= 0:
+        count = max(len(urlserver['urls']), 1)
+    pages = max((len(urlserver['urls']) + count - 1) // count, 1)
+    page = min(max(page, 1), pages)
     sortkey = {
         '-': ('', '&uarr;'),
         '+': ('-', '&darr;')
@@ -532,57 +730,10 @@ def urlserver_server_reply_list(conn, sort='-time'):
                             column.capitalize()))
     content += '<th class="unsortable message_header">URLs</th>'
     content += '</tr>\n'
-    for key, item in urls:
-        content += '  <tr>'
-        url = item[3]
-        obj = ''
-        message = (html.escape(item[4].replace(url, '\x01\x02\x03\x04'))
-                   .split('\t', 1))
-        message[0] = '<span class="prefix">%s</span>' % message[0]
-        message[1] = '<span class="message">%s</span>' % message[1]
-
-        strjoin = ('<span class="prefix_suffix"> %s </span>' %
-                   urlserver_settings['http_prefix_suffix']
-                   .replace(' ', '&nbsp;'))
-
-        target = ''
-        if urlserver_settings['http_open_in_new_page'] == 'on':
-            target = ' target=_blank'
-
-        message = strjoin.join(message).replace(
-            '\x01\x02\x03\x04',
-            '</span><a class="url" href="%s" title="%s"%s>%s'
-            '</a><span class="message">' % (
-                urlserver_short_url(key, False), url, target, url))
-        if urlserver_settings['http_embed_image'] == 'on' and \
-                url.lower().endswith(('.jpg', '.jpeg', '.png', '.gif',
-                                      '.bmp', '.svg')):
-            obj = ('<div class="obj"><img src="%s" title="%s" alt="%s">'
-                   '</div>' % (url, url, url))
-        elif urlserver_settings['http_embed_youtube'] == 'on' and \
-                'youtube.com/' in url:
-            m = re.search('v=([\w\d]+)', url)
-            if m:
-                yid = m.group(1)
-                try:
-                    size = (urlserver_settings['http_embed_youtube_size']
-                            .split('*'))
-                    width = int(size[0])
-                    height = int(size[1])
-                except:
-                    width = 480
-                    height = 350
-                obj = ('<div class="obj youtube">'
-                       '<iframe id="%s" type="text/html" width="%d" '
-                       'height="%d" '
-                       'src="https://www.youtube.com/embed/%s?enablejsapi=1">'
-                       '</iframe></div>' % (yid, width, height, yid))
-        content += ('<td class="timestamp">%s</td>'
-                    '<td class="nick">%s</td>'
-                    '<td class="buffer">%s</td><td class="message">' % (
-                        item[0], item[1], item[2]))
-        content += '%s%s</td></tr>\n' % (message, obj)
-    content += '</table>'
+    rows = [urlserver_server_html_row(key)
+            for key in urlserver_sorted_keys(sort, (page - 1) * count, count)]
+    pages_links = urlserver_server_html_pages(sort, page, pages, limit)
+    content_end = '</table>'
     if len(urlserver_settings['http_css_url']) > 0:
         css = ('<link rel="stylesheet" type="text/css" href="%s" />' %
                urlserver_settings['http_css_url'])
@@ -611,13 +762,16 @@ def urlserver_server_reply_list(conn, sort='-time'):
                  '<base href="%s" />\n'
                  '<link rel="icon" type="image/png" href="favicon.png" />\n'
                  '</head>\n'
-                 '<body>\n%s\n</body>\n'
-                 '</html>' % (
+                 '<body>\n%s%s' % (
                      urlserver_settings['http_title'],
                      css,
                      urlserver_get_base_url(),
+                     pages_links,
                      content))
-    urlserver_server_reply(conn, '200 OK', '', html_code)
+    html_end = '%s%s\n</body>\n</html>' % (content_end, pages_links)
+    # rows are sent as they are cached, without building the whole page
+    urlserver_server_reply(client, '200 OK', '',
+                           [html_code] + rows + [html_end])
 
 
 def urlserver_check_auth(data):
@@ -635,26 +789,186 @@ def urlserver_check_auth(data):
 
 
 def urlserver_server_fd_cb(data, fd):
-    """Callback for server socket."""
+    """Callback for server socket: accept new clients."""
     global urlserver, urlserver_settings
     if not urlserver['socket']:
         return weechat.WEECHAT_RC_OK
-    conn, addr = urlserver['socket'].accept()
-    if urlserver_settings['debug'] == 'on':
-        weechat.prnt('', 'urlserver: connection from %s' % str(addr))
-    if urlserver_settings['http_allowed_ips'] and \
-            not re.match(urlserver_settings['http_allowed_ips'], addr[0]):
+    max_connections = urlserver_setting_int('http_max_connections', 20)
+    while True:
+        try:
+            conn, addr = urlserver['socket'].accept()
+        except socket.error:
+            break
         if urlserver_settings['debug'] == 'on':
-            weechat.prnt('', 'urlserver: IP not allowed')
-        conn.close()
-        return weechat.WEECHAT_RC_OK
-    data = None
+            weechat.prnt('', 'urlserver: connection from %s' % str(addr))
+        if urlserver_settings['http_allowed_ips'] and \
+                not re.match(urlserver_settings['http_allowed_ips'], addr[0]):
+            if urlserver_settings['debug'] == 'on':
+                weechat.prnt('', 'urlserver: IP not allowed')
+            conn.close()
+            continue
+        if 0 < max_connections <= len(urlserver['clients']):
+            if urlserver_settings['debug'] == 'on':
+                weechat.prnt('', 'urlserver: too many connections')
+            try:
+                conn.setblocking(False)
+                conn.send(b'HTTP/1.1 503 Service Unavailable\r\n'
+                          b'Content-Length: 0\r\n'
+                          b'Connection: close\r\n'
+                          b'\r\n')
+            except socket.error:
+                pass
+            conn.close()
+            continue
+        conn.setblocking(False)
+        client = {
+            'conn': conn,
+            'fd': conn.fileno(),
+            'hook_fd': None,
+            'write': False,
+            'inbuf': b'',
+            'outbuf': collections.deque(),
+            'close': False,
+            'time': time.time(),
+        }
+        urlserver['clients'][client['fd']] = client
+        urlserver_client_hook(client, False)
+    return weechat.WEECHAT_RC_OK
+
+
+def urlserver_client_hook(client, write):
+    """Wait for client to send a request (or to be ready for our reply)."""
+    if client['hook_fd'] and client['write'] == write:
+        return
+    if client['hook_fd']:
+        weechat.unhook(client['hook_fd'])
+    client['write'] = write
+    client['hook_fd'] = weechat.hook_fd(client['fd'],
+                                        0 if write else 1,
+                                        1 if write else 0,
+                                        0,
+                                        'urlserver_client_fd_cb',
+                                        str(client['fd']))
+
+
+def urlserver_client_close(client):
+    """Close connection with a client."""
+    global urlserver
+    urlserver['clients'].pop(client['fd'], None)
+    if client['hook_fd']:
+        weechat.unhook(client['hook_fd'])
+        client['hook_fd'] = None
+    client['conn'].close()
+
+
+def urlserver_client_flush(client):
+    """Send as much as possible of the replies queued for client."""
+    outbuf = client['outbuf']
     try:
-        conn.settimeout(0.3)
-        data = conn.recv(4096).decode('utf-8')
-        data = data.replace('\r\n', '\n')
-    except:
+        while outbuf:
+            sent = client['conn'].send(outbuf[0])
+            client['time'] = time.time()
+            if sent < len(outbuf[0]):
+                outbuf[0] = outbuf[0][sent:]
+                break
+            outbuf.popleft()
+    except socket.error as e:
+        if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+            urlserver_client_close(client)
+            return
+    if not outbuf and client['close']:
+        urlserver_client_close(client)
+        return
+    urlserver_client_hook(client, bool(outbuf))
+
+
+def urlserver_keep_alive(data):
+    """Return True if the client wants to keep the connection open."""
+    version = re.match(r'^\S+ \S+ HTTP/(\d+\.\d+)', data)
+    connection = re.search(r'^Connection:(.*)$', data,
+                           re.MULTILINE | re.IGNORECASE)
+    connection = connection.group(1).lower() if connection else ''
+    if version and version.group(1) != '1.0':
+        return 'close' not in connection
+    return 'keep-alive' in connection
+
+
+def urlserver_client_read_requests(client):
+    """Reply to all complete requests received from client."""
+    global urlserver_settings
+    while not client['close']:
+        # a request may arrive in many packets: wait for the end of headers
+        end_headers = re.search(b'\r?\n\r?\n', client['inbuf'])
+        if end_headers:
+            length = re.search(b'^Content-Length:[ \t]*([0-9]+)',
+                               client['inbuf'][:end_headers.start()],
+                               re.MULTILINE | re.IGNORECASE)
+            end = end_headers.end() + (int(length.group(1)) if length else 0)
+        else:
+            end = len(client['inbuf'])
+        if end > 65536:
+            client['close'] = True
+            urlserver_server_reply(client, '413 Request too large', '', '')
+            return
+        if not end_headers or len(client['inbuf']) < end:
+            return
+        data = (client['inbuf'][:end_headers.start()]
+                .decode('utf-8', 'replace').replace('\r\n', '\n'))
+        client['inbuf'] = client['inbuf'][end:]
+        client['close'] = (urlserver_settings['http_keep_alive'] != 'on' or
+                           not urlserver_keep_alive(data))
+        urlserver_server_request(client, data)
+
+
+def urlserver_client_fd_cb(data, fd):
+    """Callback for client socket: read requests and send replies."""
+    global urlserver
+    client = urlserver['clients'].get(int(data))
+    if not client:
+        return weechat.WEECHAT_RC_OK
+    if client['write']:
+        urlserver_client_flush(client)
         return weechat.WEECHAT_RC_OK
+    eof = False
+    try:
+        while True:
+            received = client['conn'].recv(65536)
+            if not received:
+                # client closed connection (maybe only its side of it)
+                eof = True
+                break
+            client['inbuf'] += received
+            client['time'] = time.time()
+            if len(client['inbuf']) > 65536:
+                break
+    except socket.error as e:
+        if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+            urlserver_client_close(client)
+            return weechat.WEECHAT_RC_OK
+    # reply to requests received before the end of the connection
+    urlserver_client_read_requests(client)
+    if eof:
+        client['close'] = True
+    urlserver_client_flush(client)
+    return weechat.WEECHAT_RC_OK
+
+
+def urlserver_server_timer_cb(data, remaining_calls):
+    """Close idle client connections."""
+    global urlserver
+    timeout = urlserver_setting_int('http_timeout', 15)
+    now = time.time()
+    for client in list(urlserver['clients'].values()):
+        if now - client['time'] >= timeout:
+            if urlserver_settings['debug'] == 'on':
+                weechat.prnt('', 'urlserver: closing idle connection')
+            urlserver_client_close(client)
+    return weechat.WEECHAT_RC_OK
+
+
+def urlserver_server_request(client, data):
+    """Reply to a HTTP request (data is the request line and headers)."""
+    global urlserver, urlserver_settings
     replysent = False
     sort = '-time'
     referer = re.search('^Referer:', data, re.MULTILINE | re.IGNORECASE)
@@ -664,7 +978,7 @@ def urlserver_server_fd_cb(data, fd):
         if urlserver_settings['debug'] == 'on':
             weechat.prnt('', 'urlserver: %s' % m.group(0))
         if 'favicon.' in url:
-            urlserver_server_reply(conn, '200 OK', '',
+            urlserver_server_reply(client, '200 OK', '',
                                    urlserver_server_favicon(),
                                    mimetype='image/x-icon')
             replysent = True
@@ -680,6 +994,19 @@ def urlserver_server_fd_cb(data, fd):
                     prefixok = False
             # prefix ok, go on with url
             if prefixok:
+                # page of list of urls asked with "?page=N&limit=N"
+                url, _, query = url.partition('?')
+                page = 1
+                limit = None
+                for param in query.split('&'):
+                    name, _, value = param.partition('=')
+                    try:
+                        if name == 'page':
+                            page = int(value)
+                        elif name == 'limit':
+                            limit = int(value)
+                    except ValueError:
+                        pass
                 if url.startswith('sort='):
                     # sort asked for list of urls
                     sort = url[5:]
@@ -702,38 +1029,35 @@ def urlserver_server_fd_cb(data, fd):
                             # otherwise, we can make redirection with HTTP 302
                             if referer:
                                 urlserver_server_reply(
-                                    conn, '200 OK', '',
+                                    client, '200 OK', '',
                                     '<meta name="referrer" content="never">\n'
                                     '<meta http-equiv="refresh" content="0; '
                                     'url=%s">' % urlserver['urls'][number][3])
                             else:
-                                conn.sendall(
-                                    'HTTP/1.1 302\r\n'
-                                    'Location: {}\r\n\r\n'
-                                    .format(urlserver['urls'][number][3])
-                                    .encode('utf-8'))
+                                urlserver_server_reply(
+                                    client, '302 Found',
+                                    'Location: %s' %
+                                    urlserver['urls'][number][3], '')
                         else:
-                            urlserver_server_reply_auth_required(conn)
+                            urlserver_server_reply_auth_required(client)
                         replysent = True
                 else:
                     # page with list of urls
                     if urlserver_check_auth(data):
-                        urlserver_server_reply_list(conn, sort)
+                        urlserver_server_reply_list(client, sort, page, limit)
                     else:
-                        urlserver_server_reply_auth_required(conn)
+                        urlserver_server_reply_auth_required(client)
                     replysent = True
             else:
                 if urlserver_settings['debug'] == 'on':
                     weechat.prnt('', 'urlserver: prefix missing')
     if not replysent:
-        urlserver_server_reply(conn,
+        urlserver_server_reply(client,
                                '404 Not found', '',
                                '<html>\n'
                                '<head><title>Page not found</title></head>\n'
                                '<body><h1>Page not found</h1></body>\n'
                                '</html>')
-    conn.close()
-    return weechat.WEECHAT_RC_OK
 
 
 def urlserver_server_status():
@@ -768,9 +1092,13 @@ def urlserver_server_start():
         urlserver_server_status()
         return
     urlserver['socket'].listen(5)
+    urlserver['socket'].setblocking(False)
     urlserver['hook_fd'] = weechat.hook_fd(urlserver['socket'].fileno(),
                                            1, 0, 0,
                                            'urlserver_server_fd_cb', '')
+    urlserver['hook_timer'] = weechat.hook_timer(1000, 0, 0,
+                                                 'urlserver_server_timer_cb',
+                                                 '')
     urlserver_server_status()
 
 
@@ -784,6 +1112,11 @@ def urlserver_server_stop():
         if urlserver['hook_fd']:
             weechat.unhook(urlserver['hook_fd'])
             urlserver['hook_fd'] = None
+        if urlserver['hook_timer']:
+            weechat.unhook(urlserver['hook_timer'])
+            urlserver['hook_timer'] = None
+        for client in list(urlserver['clients'].values()):
+            urlserver_client_close(client)
         weechat.prnt('', 'URL server stopped')
 
 
@@ -862,6 +1195,15 @@ def urlserver_cmd_cb(data, buffer, args):
     elif args == 'clear':
         urlserver['urls'] = {}
         urlserver['number'] = 0
+        urlserver_index_rebuild()
+        urlserver_journal_cancel_compact()
+        urlserver_journal_close()
+        try:
+            open(urlserver_filename(), 'w').close()
+        except IOError:
+            pass
+        urlserver['journal_lines'] = 0
+        urlserver_journal_open()
         weechat.prnt('', 'urlserver: list cleared')
     else:
         urlserver_open_buffer()
@@ -996,6 +1338,8 @@ def urlserver_update_urllist(buffer_full_name, buffer_short_name, tags, prefix,
                     buffer_short_name,
                     url,
                     '%s\t%s' % (prefix, message))
+                urlserver_index_add(number)
+                urlserver_journal_add(number)
                 urls_short.append(urlserver_short_url(number))
                 if urlserver['buffer']:
                     urlserver_display_url_detail(number)
@@ -1010,8 +1354,10 @@ def urlserver_update_urllist(buffer_full_name, buffer_short_name, tags, prefix,
     except:
         urls_amount = 50
     while len(urlserver['urls']) > urls_amount:
-        keys = sorted(urlserver['urls'])
-        del urlserver['urls'][keys[0]]
+        key = urlserver['index']['time'][0][1]
+        urlserver_index_remove(key)
+        del urlserver['urls'][key]
+        urlserver_journal_remove(key)
 
     return urls_short
 
@@ -1123,6 +1469,8 @@ def urlserver_config_cb(data, option, value):
     if pos > 0:
         name = option[pos+1:]
         if name in urlserver_settings:
+            # HTML rows depend on options
+            urlserver['rows'] = {}
             if name == 'http_allowed_ips':
                 urlserver_settings[name] = re.compile(value)
             else:
@@ -1145,39 +1493,208 @@ def urlserver_filename():
                                          {}, {}, options)
 
 
+def urlserver_journal_write(line):
+    """Append a line to the file with URLs."""
+    global urlserver
+    if not urlserver['journal']:
+        return
+    try:
+        urlserver['journal'].write(line)
+        urlserver['journal'].flush()
+    except IOError as e:
+        weechat.prnt('', '%surlserver: error writing file "%s": %s' % (
+            weechat.prefix('error'), urlserver_filename(), e))
+        return
+    urlserver['journal_lines'] += 1
+    # compact file when most lines are removed URLs
+    if urlserver['journal_lines'] > 2 * len(urlserver['urls']) + 1000:
+        urlserver_journal_compact()
+
+
+def urlserver_journal_add(key):
+    """Append an URL to the file with URLs."""
+    global urlserver
+    urlserver_journal_write('+%d %s\n' % (key, str(urlserver['urls'][key])))
+
+
+def urlserver_journal_remove(key):
+    """Mark an URL as removed in the file with URLs."""
+    urlserver_journal_write('-%d\n' % key)
+
+
+def urlserver_journal_open():
+    """Open file with URLs to append new URLs."""
+    global urlserver
+    try:
+        urlserver['journal'] = open(urlserver_filename(), 'a')
+    except IOError as e:
+        urlserver['journal'] = None
+        weechat.prnt('', '%surlserver: error writing file "%s": %s' % (
+            weechat.prefix('error'), urlserver_filename(), e))
+
+
+def urlserver_journal_close():
+    """Close file with URLs."""
+    global urlserver
+    if urlserver['journal']:
+        urlserver['journal'].close()
+        urlserver['journal'] = None
+
+
+def urlserver_journal_compact():
+    """Rewrite file with URLs in a background process."""
+    global urlserver
+    if urlserver['hook_compact'] or not urlserver['journal']:
+        return
+    # lines appended while the process is running are copied in the new
+    # file when it's done
+    urlserver['compact_pos'] = urlserver['journal'].tell()
+    urlserver['hook_compact'] = weechat.hook_process(
+        'func:urlserver_journal_compact_process', 0,
+        'urlserver_journal_compact_cb', urlserver_filename() + '.compact')
+
+
+def urlserver_journal_compact_process(filename):
+    """Write URLs in a new file (in a forked process)."""
+    try:
+        urlserver_write_urls(filename)
+    except Exception as e:
+        return 'error writing file "%s": %s' % (filename, e)
+    return ''
+
+
+def urlserver_journal_compact_cb(data, command, return_code, out, err):
+    """Callback for end of the process writing a new file with URLs."""
+    global urlserver
+    if return_code == weechat.WEECHAT_HOOK_PROCESS_RUNNING:
+        return weechat.WEECHAT_RC_OK
+    urlserver['hook_compact'] = None
+    if return_code == weechat.WEECHAT_HOOK_PROCESS_ERROR or out or err:
+        weechat.prnt('', '%surlserver: %s' % (
+            weechat.prefix('error'), out or err or 'error writing file'))
+        if os.path.isfile(data):
+            os.remove(data)
+        return weechat.WEECHAT_RC_OK
+    filename = urlserver_filename()
+    urlserver_journal_close()
+    try:
+        with open(filename, 'rb') as journal:
+            journal.seek(urlserver['compact_pos'])
+            lines = journal.read()
+        with open(data, 'ab') as new_journal:
+            new_journal.write(lines)
+        os.rename(data, filename)
+        urlserver['journal_lines'] = (len(urlserver['urls']) +
+                                      lines.count(b'\n'))
+    except (IOError, OSError) as e:
+        weechat.prnt('', '%surlserver: error writing file "%s": %s' % (
+            weechat.prefix('error'), filename, e))
+    urlserver_journal_open()
+    if urlserver_settings['debug'] == 'on':
+        weechat.prnt('', 'urlserver: file compacted (%d URLs)' %
+                     len(urlserver['urls']))
+    return weechat.WEECHAT_RC_OK
+
+
+def urlserver_journal_cancel_compact():
+    """Stop the process writing a new file with URLs."""
+    global urlserver
+    if urlserver['hook_compact']:
+        weechat.unhook(urlserver['hook_compact'])
+        urlserver['hook_compact'] = None
+        filename = urlserver_filename() + '.compact'
+        if os.path.isfile(filename):
+            os.remove(filename)
+
+
 def urlserver_read_urls():
-    """Read file with URLs."""
+    """
+    Read file with URLs: one line by URL added ("+key (url)") or removed
+    ("-key").
+    """
     global urlserver
     filename = urlserver_filename()
+    urlserver['urls'] = {}
+    urlserver['journal_lines'] = 0
+    migrate = False
+    partial = False
     if os.path.isfile(filename):
-        urlserver['number'] = 0
-        try:
-            urlserver['urls'] = ast.literal_eval(open(filename, 'r').read())
-            keys = sorted(urlserver['urls'])
-            if keys:
-                urlserver['number'] = keys[-1] + 1
-            else:
-                urlserver['number'] = 0
-        except:
+        errors = 0
+        with open(filename, 'r') as journal:
+            for line in journal:
+                if not line.endswith('\n'):
+                    # incomplete line (if WeeChat crashed while writing):
+                    # it may still parse, as another key or URL
+                    partial = True
+                    errors += 1
+                    break
+                try:
+                    if line.startswith('+'):
+                        key, url = line[1:].split(' ', 1)
+                        urlserver['urls'][int(key)] = ast.literal_eval(url)
+                    elif line.startswith('-'):
+                        urlserver['urls'].pop(int(line[1:]), None)
+                    elif line.startswith('{'):
+                        # old format: dict with all URLs
+                        migrate = True
+                        break
+                    urlserver['journal_lines'] += 1
+                except (ValueError, SyntaxError):
+                    errors += 1
+        if migrate:
+            try:
+                urlserver['urls'] = ast.literal_eval(open(filename, 'r').read())
+            except:
+                urlserver['urls'] = {}
+                errors += 1
+        if errors:
             weechat.prnt('', '%surlserver: error reading file "%s"' % (
                 weechat.prefix('error'),
                 filename))
+    keys = sorted(urlserver['urls'])
+    if keys:
+        urlserver['number'] = keys[-1] + 1
+    else:
+        urlserver['number'] = 0
+    urlserver_index_rebuild()
+    if migrate:
+        try:
+            urlserver_write_urls(filename + '.compact')
+            os.rename(filename + '.compact', filename)
+            urlserver['journal_lines'] = len(urlserver['urls'])
+        except (IOError, OSError) as e:
+            weechat.prnt('', '%surlserver: error writing file "%s": %s' % (
+                weechat.prefix('error'), filename, e))
+    if partial and not migrate:
+        # drop the incomplete line, so that next URL is on its own line
+        urlserver_journal_truncate(filename)
+    urlserver_journal_open()
+
+
+def urlserver_journal_truncate(filename):
+    """Cut file with URLs after its last complete line."""
+    try:
+        with open(filename, 'rb+') as journal:
+            end = journal.read().rfind(b'\n') + 1
+            journal.truncate(end)
+    except (IOError, OSError) as e:
+        weechat.prnt('', '%surlserver: error writing file "%s": %s' % (
+            weechat.prefix('error'), filename, e))
 
 
-def urlserver_write_urls():
-    """Write file with URLs."""
+def urlserver_write_urls(filename):
+    """Write file with all URLs."""
     global urlserver
-    keys = sorted(urlserver['urls'])
-    content = '{\n%s\n}\n' % '\n'.join([
-        '  %d: %s,' % (key, str(urlserver['urls'][key])) for key in keys
-    ])
-    open(urlserver_filename(), 'w').write(content)
+    with open(filename, 'w') as journal:
+        for key in sorted(urlserver['urls']):
+            journal.write('+%d %s\n' % (key, str(urlserver['urls'][key])))
 
 
 def urlserver_end():
     """Script unloaded (oh no, why?)"""
     urlserver_server_stop()
-    urlserver_write_urls()
+    urlserver_journal_cancel_compact()
+    urlserver_journal_close()
     return weechat.WEECHAT_RC_OK
 
 if __name__ == '__main__' and import_ok:
@@ -14,7 +14,7 @@ import time
 import urllib.request
 import weechat
 
-from collections import namedtuple
+from collections import OrderedDict, deque, namedtuple
 from functools import wraps
 from ssl import SSLWantReadError
 from websocket import (create_connection, WebSocketConnectionClosedException,
@@ -265,6 +265,13 @@ class Config:
             "Location for storing downloaded files",
             "", 0, 0, download_dir, download_dir, 0, "", "", "", "", "", ""), "type": "string" }
 
+        # network
+        self.sections["network"] = weechat.config_new_section(self.file, "network", 0, 0, "", "", "", "", "", "", "", "", "", "")
+        self.options["network.max_concurrent_requests"] = { "pointer": weechat.config_new_option(self.file,
+            self.sections["network"], "max_concurrent_requests", "integer",
+            "Maximum number of requests sent at the same time to a server",
+            "", 1, 64, "4", "4", 0, "", "", "", "", "", ""), "type": "integer" }
+
         # server (user can add options)
         self.sections["server"] = weechat.config_new_section(self.file, "server", 1, 0, "", "", "", "", "", "", "create_server_option_cb", "", "", "")
         self.options["server.autoconnect"] = { "pointer": weechat.config_new_option(self.file,
@@ -384,6 +391,12 @@ commands = [
         description = "disconnect from a server",
         completion = "%(mattermost_server_commands)",
     ),
+    Command(
+        name = "requests",
+        args = "",
+        description = "show the requests queued and in flight for each server",
+        completion = "",
+    ),
     Command(
         name = "slash",
         args = "<mattermost-command>",
@@ -468,6 +481,20 @@ def command_server(args, buffer):
     write_command_error("server {} {}".format(command, args), "Invalid server subcommand")
     return weechat.WEECHAT_RC_ERROR
 
+def command_requests(args, buffer):
+    for server_id in sorted(set(EVENTROUTER.enqueued_requests) | set(EVENTROUTER.in_flight_counts), key=str):
+        weechat.prnt(buffer, "{}: {} queued, {} in flight".format(
+            server_id or "(no server)",
+            len(EVENTROUTER.enqueued_requests.get(server_id, [])),
+            EVENTROUTER.in_flight_counts.get(server_id, 0),
+        ))
+
+    weechat.prnt(buffer, "{} requests sent, max queue depth {}".format(
+        EVENTROUTER.dispatched_count, EVENTROUTER.max_queue_depth
+    ))
+
+    return weechat.WEECHAT_RC_OK
+
 @mattermost_channel_buffer_required
 def command_slash(args, buffer):
     if 0 == len(args.split()):
@@ -935,9 +962,9 @@ def format_markdown_links(text):
 def get_line_data_tags(line_data):
     tags = []
 
-    tags_count = weechat.hdata_integer(weechat.hdata_get("line_data"), line_data, "tags_count")
+    tags_count = weechat.hdata_integer(HDATA["line_data"], line_data, "tags_count")
     for i in range(tags_count):
-        tag = weechat.hdata_string(weechat.hdata_get("line_data"), line_data, "{}|tags_array".format(i))
+        tag = weechat.hdata_string(HDATA["line_data"], line_data, "{}|tags_array".format(i))
         tags.append(tag)
 
     return tags
@@ -950,31 +977,148 @@ def is_post_line_data(line_data, post_id):
         if tag.startswith(post_id_tag):
             return True
 
+def get_buffer_own_lines(buffer):
+    return weechat.hdata_pointer(HDATA["buffer"], buffer, "own_lines")
+
+def get_line_date_printed(line):
+    line_data = weechat.hdata_pointer(HDATA["line"], line, "data")
+    return weechat.hdata_time(HDATA["line_data"], line_data, "date_printed")
+
 def find_buffer_last_post_line_data(buffer, post_id):
-    lines = weechat.hdata_pointer(weechat.hdata_get("buffer"), buffer, "lines")
-    line = weechat.hdata_pointer(weechat.hdata_get("lines"), lines, "last_line")
+    lines = get_buffer_own_lines(buffer)
+    line = weechat.hdata_pointer(HDATA["lines"], lines, "last_line")
 
-    line_data = weechat.hdata_pointer(weechat.hdata_get("line"), line, "data")
-    while True:
+    while line:
+        line_data = weechat.hdata_pointer(HDATA["line"], line, "data")
         if is_post_line_data(line_data, post_id):
             return line_data
-        line = weechat.hdata_pointer(weechat.hdata_get("line"), line, "prev_line")
-        if "" == line:
-            return None
-        line_data = weechat.hdata_pointer(weechat.hdata_get("line"), line, "data")
+        line = weechat.hdata_pointer(HDATA["line"], line, "prev_line")
+
+    return None
 
 def find_buffer_first_post_line_data(buffer, post_id):
-    lines = weechat.hdata_pointer(weechat.hdata_get("buffer"), buffer, "lines")
-    line = weechat.hdata_pointer(weechat.hdata_get("lines"), lines, "first_line")
+    lines = get_buffer_own_lines(buffer)
+    line = weechat.hdata_pointer(HDATA["lines"], lines, "first_line")
 
-    line_data = weechat.hdata_pointer(weechat.hdata_get("line"), line, "data")
-    while True:
+    while line:
+        line_data = weechat.hdata_pointer(HDATA["line"], line, "data")
         if is_post_line_data(line_data, post_id):
             return line_data
-        line = weechat.hdata_pointer(weechat.hdata_get("line"), line, "next_line")
-        if "" == line:
+        line = weechat.hdata_pointer(HDATA["line"], line, "next_line")
+
+    return None
+
+class PostLinesIndex:
+    """
+    Pointers of the buffer lines of each post printed in a channel, in the order
+    the posts were printed
+
+    WeeChat removes lines from the start of a full buffer, so the posts printed
+    first are the ones losing their lines. Posts missing from a complete index
+    are not in the buffer.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self, complete=True):
+        self.posts = OrderedDict()
+        self.posts_printed = {}
+        self.line_post_ids = {}
+        self.first_line = None
+        self.complete = complete
+
+    def add_printed(self, buffer, post_id, previous_last_line):
+        self._forget_removed_lines(buffer)
+
+        pointers = []
+        line = weechat.hdata_pointer(HDATA["lines"], get_buffer_own_lines(buffer), "last_line")
+        while line and line != previous_last_line:
+            pointers.append(line)
+            line = weechat.hdata_pointer(HDATA["line"], line, "prev_line")
+        pointers.reverse()
+
+        self.set(post_id, pointers)
+
+    def set(self, post_id, pointers):
+        self.remove(post_id)
+        if not pointers:
+            return
+
+        for pointer in pointers:
+            if pointer in self.line_post_ids:
+                # memory of a removed line got reused, so the lines printed before it are gone as well
+                self._forget_until(pointer)
+                self._forget_line(pointer)
+
+        self.posts[post_id] = list(pointers)
+        self.posts_printed[post_id] = get_line_date_printed(pointers[0])
+        for pointer in pointers:
+            self.line_post_ids[pointer] = post_id
+
+    def get(self, buffer, post_id):
+        """
+        Returns the lines pointers of the post, or None if the index can't tell
+        """
+        self._forget_removed_lines(buffer)
+
+        pointers = self.posts.get(post_id)
+        if not pointers:
+            return [] if self.complete else None
+
+        line_data = weechat.hdata_pointer(HDATA["line"], pointers[-1], "data")
+        if not is_post_line_data(line_data, post_id):
+            self.clear(complete=False)
             return None
-        line_data = weechat.hdata_pointer(weechat.hdata_get("line"), line, "data")
+
+        return list(pointers)
+
+    def remove(self, post_id):
+        self.posts_printed.pop(post_id, None)
+        for pointer in self.posts.pop(post_id, []):
+            del self.line_post_ids[pointer]
+
+    def _forget_removed_lines(self, buffer):
+        if not self.posts:
+            return
+
+        first_line = weechat.hdata_pointer(HDATA["lines"], get_buffer_own_lines(buffer), "first_line")
+        if first_line == self.first_line:
+            return
+        self.first_line = first_line
+
+        # lines are removed in the order they were printed, so a first line
+        # printed before the oldest post means none of the posts lost a line
+        oldest_post_id = next(iter(self.posts))
+        if first_line and get_line_date_printed(first_line) < self.posts_printed[oldest_post_id]:
+            return
+
+        oldest_line = self.posts[oldest_post_id][0]
+        line = first_line
+        while line and line != oldest_line and line not in self.line_post_ids:
+            line = weechat.hdata_pointer(HDATA["line"], line, "next_line")
+
+        if line:
+            self._forget_until(line)
+        else:
+            self.clear(self.complete)
+
+    def _forget_until(self, pointer):
+        while self.posts:
+            post_id, pointers = next(iter(self.posts.items()))
+            if pointer in pointers:
+                for removed in pointers[:pointers.index(pointer)]:
+                    self._forget_line(removed)
+                return
+            self.remove(post_id)
+
+    def _forget_line(self, pointer):
+        post_id = self.line_post_ids.pop(pointer)
+        pointers = self.posts[post_id]
+        pointers.remove(pointer)
+        if not pointers:
+            del self.posts[post_id]
+            del self.posts_printed[post_id]
 
 CHANNEL_TYPES = {
     "D": "direct",
@@ -1000,6 +1144,7 @@ class ChannelBase:
         self.name = self._format_name(kwargs["display_name"], kwargs["name"])
         self.buffer = None
         self.posts = {}
+        self.lines_index = PostLinesIndex()
         self.users = {}
         self._is_loading = False
         self._is_muted = None
@@ -1064,25 +1209,13 @@ class ChannelBase:
         if not post.files:
             return
 
-        lines = weechat.hdata_pointer(weechat.hdata_get("buffer"), self.buffer, "lines")
-        line = weechat.hdata_pointer(weechat.hdata_get("lines"), lines, "last_line")
-        line_data = weechat.hdata_pointer(weechat.hdata_get("line"), line, "data")
-
-        # find last line of this post
-        while line and not is_post_line_data(line_data, post_id):
-            line = weechat.hdata_pointer(weechat.hdata_get("line"), line, "prev_line")
-            line_data = weechat.hdata_pointer(weechat.hdata_get("line"), line, "data")
+        pointers = self._get_lines_pointers(post_id)
 
-        for file_id in reversed(post.files.keys()):
+        for file_id, pointer in zip(reversed(post.files.keys()), reversed(pointers)):
+            line_data = weechat.hdata_pointer(HDATA["line"], pointer, "data")
             tags = get_line_data_tags(line_data)
             tags.append("file_id_{}".format(file_id))
-            weechat.hdata_update(weechat.hdata_get("line_data"), line_data, {"tags_array": ",".join(tags)})
-
-            line = weechat.hdata_pointer(weechat.hdata_get("line"), line, "prev_line")
-            line_data = weechat.hdata_pointer(weechat.hdata_get("line"), line, "data")
-
-            if not line or not is_post_line_data(line_data, post.id): # safeguard
-                break
+            weechat.hdata_update(HDATA["line_data"], line_data, {"tags_array": ",".join(tags)})
 
     def _prefix_thread_message(self, message, post_id, root):
         prefix_format = config.get_value("format", "thread_prefix_root") if root else config.get_value("format", "thread_prefix")
@@ -1112,6 +1245,7 @@ class ChannelBase:
         del self.posts[post_id]
 
         pointers = self._get_lines_pointers(post_id)
+        self.lines_index.remove(post_id)
         if not pointers:
             return
 
@@ -1119,8 +1253,8 @@ class ChannelBase:
         lines[0] = colorize(config.get_value("look", "deleted_suffix"), config.get_value("color", "deleted"))
 
         for pointer, line in zip(pointers, lines):
-            line_data = weechat.hdata_pointer(weechat.hdata_get("line"), pointer, "data")
-            weechat.hdata_update(weechat.hdata_get("line_data"), line_data, {"message": line, "tags_array":""})
+            line_data = weechat.hdata_pointer(HDATA["line"], pointer, "data")
+            weechat.hdata_update(HDATA["line_data"], line_data, {"message": line, "tags_array":""})
 
     def edit_post(self, post):
         post.edited = True
@@ -1142,27 +1276,32 @@ class ChannelBase:
         lines = message.split("\n")
 
         for pointer, line in zip(pointers, lines):
-            line_data = weechat.hdata_pointer(weechat.hdata_get("line"), pointer, "data")
-            weechat.hdata_update(weechat.hdata_get("line_data"), line_data, {"message": line})
+            line_data = weechat.hdata_pointer(HDATA["line"], pointer, "data")
+            weechat.hdata_update(HDATA["line_data"], line_data, {"message": line})
 
     def _get_lines_pointers(self, post_id):
-        lines = weechat.hdata_pointer(weechat.hdata_get("buffer"), self.buffer, "lines")
-        line = weechat.hdata_pointer(weechat.hdata_get("lines"), lines, "last_line")
-        line_data = weechat.hdata_pointer(weechat.hdata_get("line"), line, "data")
+        pointers = self.lines_index.get(self.buffer, post_id)
+        if pointers is not None:
+            return pointers
+
+        lines = get_buffer_own_lines(self.buffer)
+        line = weechat.hdata_pointer(HDATA["lines"], lines, "last_line")
+        line_data = weechat.hdata_pointer(HDATA["line"], line, "data")
 
         # find last line of this post
         while line and not is_post_line_data(line_data, post_id):
-            line = weechat.hdata_pointer(weechat.hdata_get("line"), line, "prev_line")
-            line_data = weechat.hdata_pointer(weechat.hdata_get("line"), line, "data")
+            line = weechat.hdata_pointer(HDATA["line"], line, "prev_line")
+            line_data = weechat.hdata_pointer(HDATA["line"], line, "data")
 
         # find all lines of this post
         pointers = []
         while line and is_post_line_data(line_data, post_id):
             pointers.append(line)
-            line = weechat.hdata_pointer(weechat.hdata_get("line"), line, "prev_line")
-            line_data = weechat.hdata_pointer(weechat.hdata_get("line"), line, "data")
+            line = weechat.hdata_pointer(HDATA["line"], line, "prev_line")
+            line_data = weechat.hdata_pointer(HDATA["line"], line, "data")
         pointers.reverse()
 
+        # not indexed: the index keeps the posts in the order they were printed
         return pointers
 
     def write_post(self, post):
@@ -1200,7 +1339,9 @@ class ChannelBase:
 
         date = int(post.created_at / 1000)
 
+        last_line = weechat.hdata_pointer(HDATA["lines"], get_buffer_own_lines(self.buffer), "last_line")
         weechat.prnt_date_tags(self.buffer, date, tags, prefix + message)
+        self.lines_index.add_printed(self.buffer, post.id, last_line)
 
         self._update_file_tags(post.id)
 
@@ -1257,17 +1398,17 @@ class ChannelBase:
         weechat.nicklist_add_nick(self.buffer, group, user.nick, color, "", color, 1)
 
     def remove_empty_nick_groups(self):
-        root = weechat.hdata_pointer(weechat.hdata_get("buffer"), self.buffer, "nicklist_root")
-        group = weechat.hdata_pointer(weechat.hdata_get("nick_group"), root, "children")
+        root = weechat.hdata_pointer(HDATA["buffer"], self.buffer, "nicklist_root")
+        group = weechat.hdata_pointer(HDATA["nick_group"], root, "children")
 
         while group:
-            if not weechat.hdata_pointer(weechat.hdata_get("nick_group"), group, "last_nick"):
+            if not weechat.hdata_pointer(HDATA["nick_group"], group, "last_nick"):
                 # tried deleting or marking group as not visible via hdata_update but it doesn't seem to work
-                name = weechat.hdata_string(weechat.hdata_get("nick_group"), group, "name")
+                name = weechat.hdata_string(HDATA["nick_group"], group, "name")
                 g = weechat.nicklist_search_group(self.buffer, "", name)
                 weechat.nicklist_remove_group(self.buffer, g)
 
-            group = weechat.hdata_pointer(weechat.hdata_get("nick_group"), group, "next_group")
+            group = weechat.hdata_pointer(HDATA["nick_group"], group, "next_group")
 
     def set_loading(self, loading):
         self._is_loading = loading
@@ -1317,6 +1458,7 @@ class ChannelBase:
         return config.get_value("look", "channel_prefix_{}".format(self.type)) + final_name
 
     def unload(self):
+        self.lines_index.clear()
         weechat.buffer_close(self.buffer)
         self.buffer = None
 
@@ -1586,6 +1728,15 @@ def buffer_switch_cb(data, signal, buffer):
 
     return weechat.WEECHAT_RC_OK
 
+def buffer_cleared_cb(data, signal, buffer):
+    for server in servers.values():
+        channel = server.get_channel_from_buffer(buffer)
+        if channel:
+            channel.lines_index.clear()
+            break
+
+    return weechat.WEECHAT_RC_OK
+
 def chat_line_event_cb(data, signal, hashtable):
     tags = hashtable["_chat_line_tags"].split(",")
 
@@ -2136,6 +2287,7 @@ def disconnect_server(server_id):
     if rc == weechat.WEECHAT_RC_OK:
         server.unload()
         servers.pop(server_id)
+        EVENTROUTER.remove_server(server_id)
 
     return rc
 
@@ -2148,41 +2300,86 @@ def singularity_cb(buffer, command, rc, out, err):
 
     return weechat.WEECHAT_RC_OK
 
-def build_buffer_cb_data(url, cb, cb_data):
-    return "{}|{}|{}".format(url, cb, cb_data)
+def build_buffer_cb_data(cb, cb_data):
+    return "{}|{}|{}".format(EVENTROUTER.start_request(), cb, cb_data)
 
 class EventRouter:
     def __init__(self):
-        self.enqueued_requests = []
+        self.request_handlers = {name: f for name, f in globals().items() if name.startswith("run_")}
+        self.enqueued_requests = {}
+        self.in_flight_requests = {}
+        self.in_flight_counts = {}
         self.response_buffers = {}
+        self.dispatching_server_id = None
+        self.last_request_id = 0
+        self.dispatched_count = 0
+        self.max_queue_depth = 0
 
     def enqueue_request(self, method, *params):
-        self.enqueued_requests.append([method, params])
+        server = next((p for p in params if isinstance(p, Server)), None)
+        server_id = server.id if server else None
+
+        queue = self.enqueued_requests.setdefault(server_id, deque())
+        queue.append([method, params])
+        self.max_queue_depth = max(self.max_queue_depth, len(queue))
 
     def handle_next(self):
-        if not self.enqueued_requests:
+        for server_id in list(self.enqueued_requests):
+            self.dispatch(server_id)
+
+    def dispatch(self, server_id):
+        queue = self.enqueued_requests.get(server_id)
+        max_requests = config.get_value("network", "max_concurrent_requests")
+
+        while queue and self.in_flight_counts.get(server_id, 0) < max_requests:
+            method, params = queue.popleft()
+            self.dispatching_server_id = server_id
+            try:
+                self.request_handlers[method](*params)
+            finally:
+                self.dispatching_server_id = None
+            self.dispatched_count += 1
+
+    def start_request(self):
+        self.last_request_id += 1
+        request_id = str(self.last_request_id)
+
+        server_id = self.dispatching_server_id
+        if server_id is not None:
+            self.in_flight_requests[request_id] = server_id
+            self.in_flight_counts[server_id] = self.in_flight_counts.get(server_id, 0) + 1
+
+        return request_id
+
+    def finish_request(self, request_id):
+        server_id = self.in_flight_requests.pop(request_id, None)
+        if server_id is None:
             return
 
-        request = self.enqueued_requests.pop(0)
-        eval(request[0])(*request[1])
+        self.in_flight_counts[server_id] -= 1
+        self.dispatch(server_id)
 
-    def buffered_response_cb(self, data, command, rc, out, err):
-        arg_search = re.search("([^\|]*)\|([^\|]*)\|(.*)", data)
-        response_buffer_name = arg_search.group(1)
-        real_cb = arg_search.group(2)
-        real_data = arg_search.group(3)
+    def remove_server(self, server_id):
+        self.enqueued_requests.pop(server_id, None)
+        self.in_flight_counts.pop(server_id, None)
+        for request_id, request_server_id in list(self.in_flight_requests.items()):
+            if request_server_id == server_id:
+                del self.in_flight_requests[request_id]
 
-        if not response_buffer_name in self.response_buffers:
-            self.response_buffers[response_buffer_name] = ""
+    def buffered_response_cb(self, data, command, rc, out, err):
+        request_id, real_cb, real_data = data.split("|", 2)
 
         if rc == weechat.WEECHAT_HOOK_PROCESS_RUNNING:
-            self.response_buffers[response_buffer_name] += out
+            self.response_buffers.setdefault(request_id, []).append(out)
             return weechat.WEECHAT_RC_OK
 
-        response = self.response_buffers[response_buffer_name] + out
-        del self.response_buffers[response_buffer_name]
+        fragments = self.response_buffers.pop(request_id, [])
+        fragments.append(out)
 
-        return eval(real_cb)(real_data, command, rc, response, err)
+        try:
+            return globals()[real_cb](real_data, command, rc, "".join(fragments), err)
+        finally:
+            self.finish_request(request_id)
 
 def handle_queued_request_cb(data, remaining_calls):
     EVENTROUTER.handle_next()
@@ -2198,7 +2395,7 @@ def run_get_user_teams(server, cb, cb_data):
         },
         REQUEST_TIMEOUT_MS,
         "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
+        build_buffer_cb_data(cb, cb_data)
     )
 
 def run_get_team(team_id, server, cb, cb_data):
@@ -2211,7 +2408,7 @@ def run_get_team(team_id, server, cb, cb_data):
         },
         REQUEST_TIMEOUT_MS,
         "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
+        build_buffer_cb_data(cb, cb_data)
     )
 
 def run_get_users(server, page, cb, cb_data):
@@ -2224,7 +2421,7 @@ def run_get_users(server, page, cb, cb_data):
         },
         REQUEST_TIMEOUT_MS,
         "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
+        build_buffer_cb_data(cb, cb_data)
     )
 
 def run_get_user(server, user_id, cb, cb_data):
@@ -2237,7 +2434,7 @@ def run_get_user(server, user_id, cb, cb_data):
         },
         REQUEST_TIMEOUT_MS,
         "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
+        build_buffer_cb_data(cb, cb_data)
     )
 
 def run_get_custom_emojis(server, page, cb, cb_data):
@@ -2250,7 +2447,7 @@ def run_get_custom_emojis(server, page, cb, cb_data):
         },
         REQUEST_TIMEOUT_MS,
         "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
+        build_buffer_cb_data(cb, cb_data)
     )
 
 # Logging out synchronously for usage in shutdown function
@@ -2290,7 +2487,7 @@ def run_user_login(server, cb, cb_data):
         },
         REQUEST_TIMEOUT_MS,
         "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
+        build_buffer_cb_data(cb, cb_data)
     )
 
 def run_get_channel(channel_id, server, cb, cb_data):
@@ -2303,7 +2500,7 @@ def run_get_channel(channel_id, server, cb, cb_data):
         },
         REQUEST_TIMEOUT_MS,
         "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
+        build_buffer_cb_data(cb, cb_data)
     )
 
 def run_get_user_team_channels(team_id, server, cb, cb_data):
@@ -2316,7 +2513,7 @@ def run_get_user_team_channels(team_id, server, cb, cb_data):
         },
         REQUEST_TIMEOUT_MS,
         "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
+        build_buffer_cb_data(cb, cb_data)
     )
 
 def run_post_post(post, server, cb, cb_data):
@@ -2338,7 +2535,7 @@ def run_post_post(post, server, cb, cb_data):
         },
         REQUEST_TIMEOUT_MS,
         "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
+        build_buffer_cb_data(cb, cb_data)
     )
 
 def run_post_command(team_id, channel_id, command, server, cb, cb_data):
@@ -2358,7 +2555,7 @@ def run_post_command(team_id, channel_id, command, server, cb, cb_data):
         },
         REQUEST_TIMEOUT_MS,
         "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
+        build_buffer_cb_data(cb, cb_data)
     )
 
 def run_get_channel_posts_around_oldest_unread(channel_id, server, cb, cb_data):
@@ -2371,7 +2568,7 @@ def run_get_channel_posts_around_oldest_unread(channel_id, server, cb, cb_data):
         },
         REQUEST_TIMEOUT_MS,
         "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
+        build_buffer_cb_data(cb, cb_data)
     )
 
 def run_get_channel_posts_after(post_id, channel_id, server, cb, cb_data):
@@ -2388,7 +2585,7 @@ def run_get_channel_posts_after(post_id, channel_id, server, cb, cb_data):
         },
         REQUEST_TIMEOUT_MS,
         "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
+        build_buffer_cb_data(cb, cb_data)
     )
 
 def run_get_channel_members(channel_id, server, page, cb, cb_data):
@@ -2401,7 +2598,7 @@ def run_get_channel_members(channel_id, server, page, cb, cb_data):
         },
         REQUEST_TIMEOUT_MS,
         "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
+        build_buffer_cb_data(cb, cb_data)
     )
 
 def run_get_user_channel_members(server, page, cb, cb_data):
@@ -2414,7 +2611,7 @@ def run_get_user_channel_members(server, page, cb, cb_data):
         },
         REQUEST_TIMEOUT_MS,
         "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
+        build_buffer_cb_data(cb, cb_data)
     )
 
 def run_post_users_status_ids(user_ids, server, cb, cb_data):
@@ -2428,7 +2625,7 @@ def run_post_users_status_ids(user_ids, server, cb, cb_data):
         },
         REQUEST_TIMEOUT_MS,
         "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
+        build_buffer_cb_data(cb, cb_data)
     )
 
 def run_post_channel_view(channel_id, server, cb, cb_data):
@@ -2446,7 +2643,7 @@ def run_post_channel_view(channel_id, server, cb, cb_data):
         },
         REQUEST_TIMEOUT_MS,
         "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
+        build_buffer_cb_data(cb, cb_data)
     )
 
 def run_post_reaction(emoji_name, post_id, server, cb, cb_data):
@@ -2467,7 +2664,7 @@ def run_post_reaction(emoji_name, post_id, server, cb, cb_data):
         },
         REQUEST_TIMEOUT_MS,
         "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
+        build_buffer_cb_data(cb, cb_data)
     )
 
 def run_delete_reaction(emoji_name, post_id, server, cb, cb_data):
@@ -2482,7 +2679,7 @@ def run_delete_reaction(emoji_name, post_id, server, cb, cb_data):
         },
         REQUEST_TIMEOUT_MS,
         "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
+        build_buffer_cb_data(cb, cb_data)
     )
 
 def run_delete_post(post_id, server, cb, cb_data):
@@ -2497,7 +2694,7 @@ def run_delete_post(post_id, server, cb, cb_data):
         },
         REQUEST_TIMEOUT_MS,
         "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
+        build_buffer_cb_data(cb, cb_data)
     )
 
 def run_get_file(file_id, file_out_path, server, cb, cb_data):
@@ -2512,7 +2709,7 @@ def run_get_file(file_id, file_out_path, server, cb, cb_data):
         },
         REQUEST_TIMEOUT_MS,
         "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
+        build_buffer_cb_data(cb, cb_data)
     )
 
 def run_get_preferences(server, cb, cb_data):
@@ -2526,7 +2723,7 @@ def run_get_preferences(server, cb, cb_data):
         },
         REQUEST_TIMEOUT_MS,
         "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
+        build_buffer_cb_data(cb, cb_data)
     )
 
 class Worker:
@@ -2829,7 +3026,7 @@ mentions = ["@here", "@channel", "@all"]
 WEECHAT_SCRIPT_NAME = "wee_most"
 WEECHAT_SCRIPT_DESCRIPTION = "Mattermost integration"
 WEECHAT_SCRIPT_AUTHOR = "Damien Tardy-Panis <damien.dev@tardypad.me>"
-WEECHAT_SCRIPT_VERSION = "0.3.0"
+WEECHAT_SCRIPT_VERSION = "0.4.0"
 WEECHAT_SCRIPT_LICENSE = "GPL3"
 
 weechat.register(
@@ -2842,6 +3039,8 @@ weechat.register(
     ""
 )
 
+HDATA = {name: weechat.hdata_get(name) for name in ["buffer", "lines", "line", "line_data", "nick_group"]}
+
 load_default_emojis()
 config.setup()
 config.read()
@@ -2870,6 +3069,7 @@ weechat.hook_completion("mentions", "complete @-mentions for Mattermost", "menti
 
 weechat.hook_modifier("input_text_for_buffer", "handle_multiline_message_cb", "")
 weechat.hook_signal("buffer_switch", "buffer_switch_cb", "")
+weechat.hook_signal("buffer_cleared", "buffer_cleared_cb", "")
 weechat.hook_timer(int(0.2 * 1000), 0, 0, "handle_queued_request_cb", "")
 weechat.hook_timer(60 * 1000, 0, 0, "get_buffer_user_status_cb", "")
 weechat.hook_timer(60 * 1000, 0, 0, "get_direct_message_channels_user_status_cb", "")